@@ -0,0 +1,117 @@
+"""
+Benchmark of excluding SRS manifest members from a folder listing.
+
+Usage (from the application directory):
+    python -m benchmarks.manifest_benchmark [--manifests N] [--lods N]
+        [--dir DIR] [--reference]
+
+Generates a folder of N SRS images with their LOD files (20000 files by
+default) and times the listing steps of filesystem.browse: scanning,
+parsing manifests with pyimglib and excluding their members, with a
+cold and a warm manifest cache. --reference also times the former
+exclusion by list membership, which takes minutes on 20000 files.
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+import filesystem.browse
+from filesystem.browse import scan
+
+# LOD file formats, from the largest level
+LOD_SUFFIXES = (".jxl", ".avif", ".webp", ".jpg")
+
+
+def make_folder(directory: pathlib.Path, manifests: int, lods: int):
+    for index in range(manifests):
+        name = "image{:06}".format(index)
+        levels = dict()
+        for level in range(lods):
+            lod_name = "{}.l{}{}".format(
+                name, level + 1, LOD_SUFFIXES[level % len(LOD_SUFFIXES)]
+            )
+            directory.joinpath(lod_name).write_bytes(b"")
+            levels[str(level + 1)] = lod_name
+        manifest = {
+            "ftype": "CLSRS",
+            "content": {"media-type": 0},
+            "streams": {"image": {"levels": levels}},
+        }
+        directory.joinpath(name + ".srs").write_text(json.dumps(manifest))
+
+
+def list_files(directory: pathlib.Path):
+    dirs, files = scan.scan_directory(
+        directory, filesystem.browse.supported_file_extensions
+    )
+    return filesystem.browse.split_manifests(files)
+
+
+def exclude_by_set(directory: pathlib.Path) -> int:
+    filelist, srs_filelist, mpd_filelist = list_files(directory)
+    excluded_files = set()
+    for manifest_file in srs_filelist + mpd_filelist:
+        excluded_files.update(
+            filesystem.browse.get_manifest_members(
+                manifest_file.path, (manifest_file.mtime, manifest_file.size)
+            )
+        )
+    return sum(entry.path not in excluded_files for entry in filelist)
+
+
+def exclude_by_list(directory: pathlib.Path) -> int:
+    """Exclusion as files_processor() did before the set of members."""
+    filelist, srs_filelist, mpd_filelist = list_files(directory)
+    excluded_filelist = []
+    for manifest_file in srs_filelist + mpd_filelist:
+        excluded_filelist.extend(
+            filesystem.browse.get_manifest_files(manifest_file.path)
+        )
+    return sum(entry.path not in excluded_filelist for entry in filelist)
+
+
+def measure(name: str, function, directory: pathlib.Path):
+    start = time.perf_counter()
+    listed = function(directory)
+    elapsed = time.perf_counter() - start
+    print("{}: {:.3f} s, {} files listed".format(name, elapsed, listed))
+    return listed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time exclusion of manifest members from a listing"
+    )
+    parser.add_argument("--manifests", type=int, default=5000)
+    parser.add_argument("--lods", type=int, default=3)
+    parser.add_argument("--dir", type=pathlib.Path, default=None)
+    parser.add_argument("--reference", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        directory = pathlib.Path(directory)
+        make_folder(directory, args.manifests, args.lods)
+        print(
+            "{} files, {} SRS manifests with {} LODs".format(
+                args.manifests * (args.lods + 1), args.manifests, args.lods
+            )
+        )
+        filesystem.browse.manifest_cache = filesystem.browse.ManifestCache(
+            args.manifests
+        )
+        listed = measure("set, cold cache", exclude_by_set, directory)
+        if listed != 0:
+            # LOD files must all be excluded, anything else means the
+            # manifests were not understood by this pyimglib version
+            sys.exit("{} LOD files were not excluded".format(listed))
+        measure("set, warm cache", exclude_by_set, directory)
+        if args.reference:
+            measure("list", exclude_by_list, directory)
+
+
+if __name__ == "__main__":
+    main()
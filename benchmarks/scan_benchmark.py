@@ -0,0 +1,156 @@
+"""
+Benchmark of directory listing for the file browser: system calls and
+time of filesystem.browse.scan against the former pathlib listing.
+
+Usage (from the application directory):
+    python -m benchmarks.scan_benchmark [--files N] [--icons N] [--dirs N]
+        [--dir DIR]
+
+A directory tree is generated in DIR (a temporary directory by
+default), put it on the filesystem of interest, e.g. NFS. System calls
+are counted by wrapping os functions, DirEntry.stat() calls by
+wrapping entries of os.scandir().
+"""
+
+import argparse
+import collections
+import contextlib
+import os
+import pathlib
+import tempfile
+import time
+
+from filesystem.browse import (
+    image_file_extensions,
+    scan,
+    supported_file_extensions,
+    video_file_extensions,
+)
+
+calls: collections.Counter = collections.Counter()
+
+
+class CountedDirEntry:
+    def __init__(self, entry: os.DirEntry):
+        self._entry = entry
+
+    def stat(self, *args, **kwargs):
+        calls["DirEntry.stat"] += 1
+        return self._entry.stat(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+
+class CountedScandir:
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._iterator.close()
+
+    def __iter__(self):
+        return (CountedDirEntry(entry) for entry in self._iterator)
+
+
+@contextlib.contextmanager
+def count_calls():
+    originals = {
+        name: getattr(os, name) for name in ("stat", "listdir", "scandir")
+    }
+
+    def counted(name):
+        def call(*args, **kwargs):
+            calls[name] += 1
+            return originals[name](*args, **kwargs)
+
+        return call
+
+    os.stat = counted("stat")
+    os.listdir = counted("listdir")
+    os.scandir = lambda *args: CountedScandir(counted("scandir")(*args))
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(os, name, function)
+
+
+def list_before(folder: pathlib.Path):
+    """Listing as browse_folder(), the mtime sort and FileExtractor did."""
+    dirs, files = [], []
+    for entry in folder.iterdir():
+        if (
+            entry.is_file()
+            and entry.suffix.lower() in supported_file_extensions
+        ):
+            files.append(entry)
+        elif entry.is_dir() and entry.name[0] != ".":
+            dirs.append(entry)
+    for _dir in dirs:
+        _dir.joinpath(scan.DIR_CONFIG_NAME).exists()
+    files.sort(key=lambda file: file.stat().st_mtime)
+    for file in files:
+        suffix = file.suffix.lower()
+        if suffix in image_file_extensions or suffix in video_file_extensions:
+            icon_path = pathlib.Path("{}.icon".format(file))
+            # probed by FileExtractor and again by make_icon()
+            if icon_path.exists():
+                icon_path.exists()
+
+
+def list_after(folder: pathlib.Path):
+    dirs, files = scan.scan_directory(folder, supported_file_extensions)
+    files.sort(key=lambda entry: entry.mtime)
+
+
+def make_tree(directory: pathlib.Path, files: int, icons: int, dirs: int):
+    for index in range(files):
+        directory.joinpath("image{:06}.jpg".format(index)).write_bytes(b"")
+    for index in range(icons):
+        directory.joinpath("image{:06}.jpg.icon".format(index)).write_bytes(
+            b""
+        )
+    for index in range(dirs):
+        directory.joinpath("dir{:04}".format(index)).mkdir()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Count system calls of directory listing"
+    )
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--icons", type=int, default=500)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--dir", type=pathlib.Path, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        directory = pathlib.Path(directory)
+        make_tree(directory, args.files, args.icons, args.dirs)
+        for name, function in (
+            ("before", list_before),
+            ("after", list_after),
+        ):
+            calls.clear()
+            with count_calls():
+                start = time.perf_counter()
+                function(directory)
+                elapsed = time.perf_counter() - start
+            print(
+                "{}: {}, {:.1f} ms".format(
+                    name,
+                    ", ".join(
+                        "{} {}".format(count, call)
+                        for call, count in sorted(calls.items())
+                    ),
+                    elapsed * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of stealth PNG metadata reading on a large image.
+
+Usage (from the application directory):
+    python -m benchmarks.stealth_png_benchmark [--size WxH] [--payload KB]
+        [--channel rgb|alpha] [--reference]
+
+--reference times the implementation replaced by the NumPy version
+too, which takes more than a minute on a 4K image.
+"""
+
+import argparse
+import os
+import time
+
+from tests import import_standalone, stealth_png_corpus
+from tests import stealth_png_reference
+
+stealth_png = import_standalone("medialib.stealth_png")
+
+
+def measure(function, image, repeat: int) -> tuple[float, object]:
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(image)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time stealth PNG metadata reading"
+    )
+    parser.add_argument("--size", default="3840x2160")
+    parser.add_argument("--payload", type=int, default=210, help="KB")
+    parser.add_argument("--channel", choices=("rgb", "alpha"), default="rgb")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--reference", action="store_true")
+    args = parser.parse_args()
+
+    width, height = (int(side) for side in args.size.split("x"))
+    # random payload does not compress, it is stored as it is
+    payload = os.urandom(args.payload * 1024).hex()[: args.payload * 1024]
+    image = stealth_png_corpus.embed(
+        width,
+        height,
+        args.channel,
+        False,
+        payload.encode(),
+        stealth_png_corpus.PLAIN,
+        0,
+    )
+    implementations = [("numpy", stealth_png)]
+    if args.reference:
+        implementations.append(("reference", stealth_png_reference))
+    for name, module in implementations:
+        # the reference is measured once, it is too slow to repeat
+        repeat = args.repeat if module is stealth_png else 1
+        read_time, info = measure(
+            module.read_info_from_image_stealth, image, repeat
+        )
+        check_time, found = measure(module.stealth_png_check, image, repeat)
+        print(
+            "{}: read {:.4f} s ({} characters), check {:.6f} s ({})".format(
+                name, read_time, len(info or ""), check_time, found
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
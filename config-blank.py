@@ -4,6 +4,16 @@ import pathlib
 
 host_name = '0.0.0.0'
 port = 3709
+# number of pre-forked worker processes, 1 runs a single process server
+server_workers = 4
+
+# str or None, root directory can be also given in command line
+root_dir = None
+
+# Key used to sign session cookies. Set it to keep users logged in
+# after server restart. If None, a random key is generated at start.
+secret_key = None
+
 certificate_file = ''
 private_key_file = ''
 
@@ -15,11 +25,113 @@ valid_password_hash_hex = '5a38afb1a18d408e6cd367f9db91e2ab9bce834cdad3da24183cc
 
 items_per_page = 15
 
+# number of directory listings kept in memory by filesystem.browse
+listing_cache_entries = 32
+# number of SRS and DASH manifests whose member files are kept in memory
+manifest_cache_entries = 100000
+
+# pathlib.Path or None
+# SQLite index of directory entries. Directories with at least
+# dir_index_min_entries entries are listed page by page from the index.
+dir_index_db = None
+dir_index_min_entries = 5000
+
+# Watch root dir with inotify (Linux only) and drop cached listings on
+# changes instead of relying on directory mtime only. Only with a single
+# worker process (server_workers = 1), every worker would need its own
+# watches of the whole tree.
+fs_watch = False
+
 pyimglib.config.jpeg_xl_tools_path = None
 
 # pathlib.Path or None
 thumbnail_cache_dir = None
 
+# pathlib.Path or None
+# cache of thumbnails for files outside of medialib (/thumbnail/ route)
+fs_thumbnail_cache_dir = None
+fs_thumbnail_cache_max_size = 2 * 1024 * 1024 * 1024  # bytes
+
+# base thumbnail sizes (width, height) used by filesystem.prewarm
+prewarm_thumbnail_sizes = [(192, 144)]
+
+# pathlib.Path or None
+# cache of transcoded images (/image/ route)
+transcode_cache_dir = None
+transcode_cache_max_size = 4 * 1024 * 1024 * 1024  # bytes
+
+# pathlib.Path or None
+# SQLite database of source file hashes used as ETag values.
+# If None, hashes are kept in memory only.
+file_digest_db = None
+
+# medialib database connections per worker process
+db_pool_size = 8
+# seconds to wait for a free connection before failing the request
+db_pool_timeout = 30
+
+# seconds tag lookups are remembered; tag changes made by the server
+# drop them at once, changes made outside of it show up after this time
+tag_cache_ttl = 300
+
+# pathlib.Path or None
+# file of generation counters shared by server processes, caches of all
+# of them are dropped on content and tag changes. Set it to make
+# command line tools (medialib.indexer) invalidate server caches too.
+generation_file = None
+
+# cached numbers of found items of medialib queries, dropped on content
+# and tag changes
+item_count_cache_entries = 256
+item_count_cache_ttl = 300
+
+# cached content id lists of tag search queries, bounded by number of
+# queries and by total memory; larger results are paged by the database.
+# Changes made outside of the server show up after the ttl.
+tag_search_cache_entries = 128
+tag_search_cache_bytes = 64 * 1024 * 1024
+tag_search_cache_max_result_ids = 200000
+tag_search_cache_ttl = 300
+# pages of tag search queries up to this offset are queried directly,
+# deeper pages reached without Back/Next links are sliced from the cache
+tag_search_direct_offset = 1000
+
+# images compared by /medialib/compare-by-hash are reduced to at most
+# this many pixels, differences of larger images are estimated
+compare_max_pixels = 2**20
+
+# keep perceptual hashes of all images in memory of every worker for
+# /medialib/similar/ near-duplicate search, loaded at startup
+similarity_index = False
+# seconds between checks whether another process changed stored hashes;
+# changed hashes are read in one query, the index is reloaded completely
+# only after more changes than the change log of generation_file keeps
+similarity_index_reload_interval = 300
+
+# SQLite database of upload post-processing jobs; if set, uploaded
+# images are registered at once and metadata extraction, hashing and
+# encoding run in upload_workers threads of every worker process
+upload_queue_db = None
+upload_workers = 2
+
+# /medialib/upload/bulk: processes analyzing and encoding uploaded files
+# (None is the number of CPUs) and files registered per transaction
+bulk_upload_processes = None
+bulk_upload_chunk_size = 100
+
+# medialib.indexer: processes probing files (None is the number of CPUs),
+# files registered per transaction and SQLite database of files that
+# failed, skipped until they are modified (pathlib.Path or None)
+indexer_processes = None
+indexer_batch_size = 500
+indexer_state_db = None
+
+# pathlib.Path or None
+# directory of locks and progress of background jobs (/medialib-index),
+# so one runs at a time across worker processes. If None, a temporary
+# directory is used; set it to exclude command line tools too.
+job_state_dir = None
+
 # Do not change this value
 ACLMMP_COMPATIBILITY_LEVEL = -1
 
@@ -1,2 +1,3 @@
 from . import browse
+from . import thumbnails
 
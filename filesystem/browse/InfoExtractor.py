@@ -62,9 +62,16 @@ class DataclassInfoExtractor(abc.ABC):
 
 
 class FileExtractor(InfoExtractor):
-    def __init__(self, file: pathlib.Path, items_count=0):
+    def __init__(
+        self, file: pathlib.Path, items_count=0, has_icon: bool | None = None
+    ):
         super().__init__(items_count)
         self.file = file
+        # presence of <file>.icon, probed on demand if the caller
+        # did not get it from a directory scan
+        if has_icon is None:
+            has_icon = pathlib.Path("{}.icon".format(file)).exists()
+        self.has_icon = has_icon
 
         base32path = shared_code.str_to_base32(str(file))
         self.filemeta |= {
@@ -77,7 +84,6 @@ class FileExtractor(InfoExtractor):
             "suffix": file.suffix,
             "content_id": None,
         }
-        icon_path = pathlib.Path("{}.icon".format(file))
         if (file.suffix.lower() in image_file_extensions) or (
             file.suffix.lower() in video_file_extensions
         ):
@@ -116,7 +122,7 @@ class FileExtractor(InfoExtractor):
             )
             shared_code.access_tokens[self.filemeta["link"]] = access_token
             self.filemeta["link"] += "?access_token={}".format(access_token)
-            if icon_path.exists():
+            if self.has_icon:
                 self.make_icon(file, self.filemeta)
         if file.suffix == ".mkv":
             self.filemeta["link"] = "/vp8/{}".format(base32path)
@@ -128,8 +134,8 @@ class FileExtractor(InfoExtractor):
             shared_enums.LoadAcceleration.BOTH,
         }
         icon_base32path = filemeta["base32path"]
-        icon_path = pathlib.Path("{}.icon".format(file))
-        if icon_path.exists():
+        if self.has_icon:
+            icon_path = pathlib.Path("{}.icon".format(file))
             filemeta["custom_icon"] = True
             icon_base32path = shared_code.str_to_base32(
                 str(icon_path.relative_to(shared_code.root_dir))
@@ -1,11 +1,16 @@
+import bisect
+import collections
 import dataclasses
+import threading
 from typing import Type
 
 import flask
 import json
 import pathlib
 import math
+import os
 
+import config
 import medialib_db
 import shared_code
 import shared_code.enums as shared_enums
@@ -31,166 +36,347 @@ supported_file_extensions = (
     .union({".mpd", ".srs", ".m3u8"})
 )
 
-from . import InfoExtractor
+from . import InfoExtractor, scan, directory_index
 
 items_per_page = 1
 
 
-class PageCache:
-    def __init__(self, path, cache, glob_pattern):
-        self._path = path
-        self._cache = cache
-        self._glob_pattern = glob_pattern
+class ListingCache:
+    """
+    LRU cache of built directory listings.
+
+    Entries are keyed by (directory, glob pattern, thumbnail size), since
+    filemeta contains thumbnail URLs of the session thumbnail size. An
+    entry is valid while the directory mtime is unchanged. If the
+    directory is watched by shared_code.fs_watch, the entry is trusted
+    without stat() until a change event drops it. Listings are built
+    outside of the lock, so a slow scan does not block other
+    directories; concurrent builds of the same key are harmless.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # incremented by every invalidation, see put()
+        self.generation = 0
+
+    def get(self, key, directory: pathlib.Path):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        mtime_ns, watched, listing = entry
+        if not (watched and shared_code.fs_watch.is_watched(directory)):
+            if directory.stat().st_mtime_ns != mtime_ns:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return listing
+
+    def put(self, key, mtime_ns: int, watched: bool, generation, listing):
+        """
+        Store listing built from a scan started at cache generation.
+
+        watched tells whether the directory was watched when the scan
+        started. If anything was invalidated meanwhile, the listing may
+        miss that change and is validated by mtime only.
+        """
+        with self._lock:
+            watched = watched and generation == self.generation
+            self._entries[key] = (mtime_ns, watched, listing)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(
+        self, path: pathlib.Path, event_type: shared_code.fs_watch.EventType
+    ):
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries):
+                directory, glob_pattern = key[0], key[1]
+                if (
+                    directory == path.parent
+                    or directory == path
+                    or path in directory.parents
+                    or glob_pattern is not None
+                    and directory in path.parents
+                ):
+                    del self._entries[key]
 
-    def is_cached(self, path, glob_pattern):
-        return path == self._path and glob_pattern == self._glob_pattern
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
 
-    def get_cache(self, path, glob_pattern):
-        if self.is_cached(path, glob_pattern):
-            return self._cache
-        else:
-            return list(), list(), list()
 
+listing_cache = ListingCache(config.listing_cache_entries)
 
-page_cache = PageCache(None, None, None)
+# index of huge directories, set up by server.create_app()
+dir_index: directory_index.DirectoryIndex | None = None
 
 
-def browse_folder(folder):
-    path_dir_objects = []
+def split_manifests(files: list[scan.ScanEntry]):
     path_file_objects = []
     path_srs_objects = []
     path_mpd_objects = []
-    for entry in folder.iterdir():
-        if entry.is_file() and entry.suffix.lower() == ".srs":
+    for entry in files:
+        if entry.suffix == ".srs":
             path_srs_objects.append(entry)
-        elif entry.is_file() and entry.suffix.lower() == ".mpd":
+        elif entry.suffix == ".mpd":
             path_mpd_objects.append(entry)
-        elif (
-            entry.is_file()
-            and entry.suffix.lower() in supported_file_extensions
-        ):
+        else:
             path_file_objects.append(entry)
-        elif entry.is_dir() and entry.name[0] != ".":
-            path_dir_objects.append(entry)
-    return (
-        path_dir_objects,
-        path_file_objects,
-        path_srs_objects,
-        path_mpd_objects,
+    return path_file_objects, path_srs_objects, path_mpd_objects
+
+
+def browse_folder(folder):
+    path_dir_objects, files = scan.scan_directory(
+        folder, supported_file_extensions
     )
+    return (path_dir_objects, *split_manifests(files))
 
 
-def extract_mtime_key(file: pathlib.Path):
-    return file.stat().st_mtime
+def extract_mtime_key(entry: scan.ScanEntry):
+    # newest first, ties by name: the order of DirectoryIndex.get_files(),
+    # so a folder lists the same either way
+    return -entry.mtime, entry.name
 
 
-def browse(dir):
-    global page_cache
-    items_per_page = int(
-        flask.request.args.get("per_page", flask.session["items_per_page"])
+def get_manifest_files(manifest_file: pathlib.Path) -> list[pathlib.Path]:
+    """Files of SRS or DASH manifest, which are not listed by themselves."""
+    if manifest_file.suffix.lower() == ".srs":
+        f = manifest_file.open("r")
+        content, streams, cl_level = pyimglib.ACLMMP.srs_parser.parseJSON(f)
+        f.close()
+        return pyimglib.ACLMMP.srs_parser.get_files_list(
+            manifest_file, content, streams
+        )
+    else:
+        dash_handler = (
+            pyimglib.transcoding.encoders.dash_encoder.DashVideoEncoder(1)
+        )
+        dash_handler.set_manifest_file(manifest_file)
+        return dash_handler.get_files()[:-1]
+
+
+class ManifestCache:
+    """
+    Members of SRS and DASH manifests keyed by manifest path.
+
+    Entries are validated by manifest (mtime, size), so a folder listing
+    parses only manifests which changed since the previous listing.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, manifest_file: pathlib.Path, stat_key):
+        with self._lock:
+            entry = self._entries.get(manifest_file)
+            if entry is None or entry[0] != stat_key:
+                return None
+            self._entries.move_to_end(manifest_file)
+            return entry[1]
+
+    def put(self, manifest_file: pathlib.Path, stat_key, members):
+        with self._lock:
+            self._entries[manifest_file] = (stat_key, members)
+            self._entries.move_to_end(manifest_file)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+manifest_cache = ManifestCache(config.manifest_cache_entries)
+
+
+def get_manifest_members(
+    manifest_file: pathlib.Path, stat_key: tuple[float, int] | None = None
+) -> frozenset[pathlib.Path]:
+    """
+    Normalized paths of manifest files, cached per manifest mtime.
+
+    stat_key is (mtime, size) of the manifest, if already known from a
+    directory scan. Paths are normalized lexically, without syscalls, so
+    they compare equal to paths of scanned entries.
+    """
+    if stat_key is None:
+        manifest_stat = manifest_file.stat()
+        stat_key = (manifest_stat.st_mtime, manifest_stat.st_size)
+    members = manifest_cache.get(manifest_file, stat_key)
+    if members is None:
+        members = frozenset(
+            pathlib.Path(
+                os.path.normpath(manifest_file.parent.joinpath(member))
+            )
+            for member in get_manifest_files(manifest_file)
+        )
+        manifest_cache.put(manifest_file, stat_key, members)
+    return members
+
+
+def make_updir_item(dir):
+    updir_item = {
+        "icon": flask.url_for("static", filename="images/updir_icon.svg"),
+        "name": "..",
+    }
+    if dir.parent == shared_code.root_dir:
+        updir_item["link"] = "/"
+    else:
+        updir_item["link"] = "/browse/{}".format(
+            dir.parent.relative_to(shared_code.root_dir)
+        )
+    return updir_item
+
+
+def make_dirmeta(dir_entry: scan.ScanEntry, items_count):
+    _dir = dir_entry.path
+    dirmeta = {
+        "link": "/browse/{}".format(_dir.relative_to(shared_code.root_dir)),
+        "icon": flask.url_for("static", filename="images/folder icon.svg"),
+        "object_icon": False,
+        "name": shared_code.simplify_filename(_dir.name),
+        "sources": None,
+        "item_index": items_count,
+        "type": "dir",
+    }
+    if dir_entry.has_dir_config:
+        dirmeta["object_icon"] = True
+        dirmeta["icon"] = "/folder_icon_paint/{}".format(
+            _dir.relative_to(shared_code.root_dir)
+        )
+    return dirmeta
+
+
+def get_listing(dir, glob_pattern):
+    cache_key = (
+        dir,
+        glob_pattern,
+        flask.session["thumbnail_width"],
+        flask.session["thumbnail_height"],
     )
+    listing = listing_cache.get(cache_key, dir)
+    if listing is not None:
+        return listing
+    generation = listing_cache.generation
+    watched = shared_code.fs_watch.is_watched(dir)
+    dir_mtime_ns = dir.stat().st_mtime_ns
     dirlist, filelist, srs_filelist, mpd_filelist = [], [], [], []
-    glob_pattern = flask.request.args.get("glob", None)
-    itemslist, dirmeta_list, filemeta_list = page_cache.get_cache(
-        dir, glob_pattern
-    )
-    if len(itemslist) == 0:
-        items_count: int = 0
-
-        if glob_pattern is None:
-            dirlist, filelist, srs_filelist, mpd_filelist = browse_folder(dir)
-            if dir != shared_code.root_dir:
-                itemslist.append(
-                    {
-                        "icon": flask.url_for(
-                            "static", filename="images/updir_icon.svg"
-                        ),
-                        "name": "..",
-                    }
-                )
-                if dir.parent == shared_code.root_dir:
-                    itemslist[0]["link"] = "/"
-                else:
-                    itemslist[0]["link"] = "/browse/{}".format(
-                        dir.parent.relative_to(shared_code.root_dir)
-                    )
-                items_count += 1
-            for _dir in dirlist:
-                dirmeta = {
-                    "link": "/browse/{}".format(
-                        _dir.relative_to(shared_code.root_dir)
-                    ),
-                    "icon": flask.url_for(
-                        "static", filename="images/folder icon.svg"
-                    ),
-                    "object_icon": False,
-                    "name": shared_code.simplify_filename(_dir.name),
-                    "sources": None,
-                    "item_index": items_count,
-                    "type": "dir",
-                }
-                try:
-                    if _dir.joinpath(".imgview-dir-config.json").exists():
-                        dirmeta["object_icon"] = True
-                        dirmeta["icon"] = "/folder_icon_paint/{}".format(
-                            _dir.relative_to(shared_code.root_dir)
-                        )
-                except PermissionError:
-                    pass
-                itemslist.append(dirmeta)
-                items_count += 1
-        else:
-            itemslist.append(
-                {
-                    "icon": flask.url_for(
-                        "static", filename="images/updir_icon.svg"
-                    ),
-                    "name": ".",
-                    "link": flask.request.path,
-                }
-            )
+    itemslist, dirmeta_list, filemeta_list = list(), list(), list()
+    items_count: int = 0
+
+    if glob_pattern is None:
+        dirlist, filelist, srs_filelist, mpd_filelist = browse_folder(dir)
+        # by name, as DirectoryIndex.get_dirs()
+        dirlist.sort(key=lambda dir_entry: dir_entry.name)
+        if dir != shared_code.root_dir:
+            itemslist.append(make_updir_item(dir))
             items_count += 1
-            for file in dir.glob(glob_pattern):
-                if file.is_file() and file.suffix.lower() == ".srs":
-                    srs_filelist.append(file)
-                elif file.is_file() and file.suffix.lower() == ".mpd":
-                    mpd_filelist.append(file)
-                elif (
-                    file.is_file()
-                    and file.suffix.lower() in supported_file_extensions
-                ):
-                    filelist.append(file)
-        excluded_filelist = []
-        for srs_file in srs_filelist:
-            f = srs_file.open("r")
-            content, streams, cl_level = pyimglib.ACLMMP.srs_parser.parseJSON(
-                f
-            )
-            f.close()
-            excluded_filelist.extend(
-                pyimglib.ACLMMP.srs_parser.get_files_list(
-                    srs_file, content, streams
-                )
-            )
-            filelist.append(srs_file)
-        for mpd_file in mpd_filelist:
-            dash_handler = (
-                pyimglib.transcoding.encoders.dash_encoder.DashVideoEncoder(1)
+        for dir_entry in dirlist:
+            itemslist.append(make_dirmeta(dir_entry, items_count))
+            items_count += 1
+    else:
+        itemslist.append(
+            {
+                "icon": flask.url_for(
+                    "static", filename="images/updir_icon.svg"
+                ),
+                "name": ".",
+                "link": flask.request.path,
+            }
+        )
+        items_count += 1
+        filelist, srs_filelist, mpd_filelist = split_manifests(
+            scan.scan_paths(dir.glob(glob_pattern), supported_file_extensions)
+        )
+    excluded_files = set()
+    for manifest_file in srs_filelist + mpd_filelist:
+        excluded_files.update(
+            get_manifest_members(
+                manifest_file.path, (manifest_file.mtime, manifest_file.size)
             )
-            dash_handler.set_manifest_file(mpd_file)
-            files = dash_handler.get_files()[:-1]
-            excluded_filelist.extend(files)
-            filelist.append(mpd_file)
-        filelist.sort(key=extract_mtime_key, reverse=True)
-
-        filemeta_list, items_count = files_processor(
-            filelist, excluded_filelist, items_count
         )
+        filelist.append(manifest_file)
+    filelist.sort(key=extract_mtime_key)
+
+    filemeta_list, items_count = files_processor(
+        filelist, excluded_files, items_count
+    )
+
+    itemslist.extend(filemeta_list)
+    listing = (itemslist, dirmeta_list, filemeta_list)
+    listing_cache.put(cache_key, dir_mtime_ns, watched, generation, listing)
+    return listing
+
+
+def browse_indexed(dir, min_index, max_index):
+    """
+    Build items of one page from dir_index.
+
+    Returns page items, filemeta of the page and total number of items.
+    Item indexes are absolute, as in the full listing.
+    """
+    itemslist = list()
+    items_count = 0
+    if dir != shared_code.root_dir:
+        if min_index == 0:
+            itemslist.append(make_updir_item(dir))
+        items_count += 1
+    dirs_count = dir_index.count_dirs(dir)
+    if min_index < items_count + dirs_count:
+        dirs_offset = max(min_index - items_count, 0)
+        for dir_entry in dir_index.get_dirs(
+            dir, dirs_offset, max_index - items_count - dirs_offset
+        ):
+            itemslist.append(
+                make_dirmeta(dir_entry, items_count + dirs_offset)
+            )
+            dirs_offset += 1
+    items_count += dirs_count
+    files_offset = max(min_index - items_count, 0)
+    filemeta_list, _ = files_processor(
+        dir_index.get_files(
+            dir, files_offset, max(max_index - items_count - files_offset, 0)
+        ),
+        set(),
+        items_count + files_offset,
+    )
+    itemslist.extend(filemeta_list)
+    items_total = items_count + dir_index.count(dir) - dirs_count
+    return itemslist, filemeta_list, items_total
 
-        itemslist.extend(filemeta_list)
-        page_cache = PageCache(
-            dir, (itemslist, dirmeta_list, filemeta_list), glob_pattern
+
+def browse(dir):
+    items_per_page = int(
+        flask.request.args.get("per_page", flask.session["items_per_page"])
+    )
+    glob_pattern = flask.request.args.get("glob", None)
+    page = int(flask.request.args.get("page", 0))
+    min_index = page * items_per_page
+    max_index = min_index + items_per_page
+    dirmeta_list = list()
+    if (
+        glob_pattern is None
+        and dir_index is not None
+        and dir_index.refresh(dir) >= config.dir_index_min_entries
+    ):
+        # huge directory: filemeta is built for the requested page only
+        itemslist, filemeta_list, items_total = browse_indexed(
+            dir, min_index, max_index
+        )
+    else:
+        itemslist, dirmeta_list, filemeta_list = get_listing(
+            dir, glob_pattern
         )
+        items_total = len(itemslist)
+        itemslist = itemslist[min_index:max_index]
     title = ""
     if dir == shared_code.root_dir:
         title = "root"
@@ -203,10 +389,7 @@ def browse(dir):
         "args": "",
         "enable_external_scripts": shared_code.enable_external_scripts,
     }
-    page = int(flask.request.args.get("page", 0))
-    max_pages = math.ceil(len(itemslist) / items_per_page)
-    min_index = page * items_per_page
-    max_index = min_index + items_per_page
+    max_pages = math.ceil(items_total / items_per_page)
     final_filemeta_list = list()
     final_dirmeta_list = list()
 
@@ -218,7 +401,7 @@ def browse(dir):
     )
     return flask.render_template(
         "index.html",
-        itemslist=itemslist[min_index:max_index],
+        itemslist=itemslist,
         dirmeta=json.dumps(final_dirmeta_list),
         filemeta=json.dumps(final_filemeta_list),
         query_data=json.dumps(shared_code.tag_query_placeholder),
@@ -232,22 +415,28 @@ def browse(dir):
 
 
 def calc_item_page_index(item_list, output_list, min_index, max_index):
-    for item in item_list:
-        if min_index <= item["item_index"] < max_index:
-            final_item = item.copy()
-            final_item["item_index"] -= min_index
-            output_list.append(final_item)
-        elif item["item_index"] >= max_index:
+    # item_list is ordered by item_index, so the page is found by bisection
+    start = bisect.bisect_left(
+        item_list, min_index, key=lambda item: item["item_index"]
+    )
+    for item in item_list[start:]:
+        if item["item_index"] >= max_index:
             break
+        final_item = item.copy()
+        final_item["item_index"] -= min_index
+        output_list.append(final_item)
 
 
-def files_processor(filelist, excluded_filelist, initial_item_count):
+def files_processor(
+    filelist, excluded_files: set[pathlib.Path], initial_item_count
+):
     items_count = initial_item_count
     filemeta_list = list()
-    for file in filelist:
-        if file not in excluded_filelist:
-
-            filemeta_list.append(get_file_info(file, items_count))
+    for entry in filelist:
+        if entry.path not in excluded_files:
+            filemeta_list.append(
+                get_file_info(entry.path, items_count, entry.has_icon)
+            )
             items_count += 1
     return filemeta_list, items_count
 
@@ -304,8 +493,10 @@ def db_dataclass_processing(
     return content_data_list
 
 
-def get_file_info(file: pathlib.Path, items_count=0):
-    extractor = InfoExtractor.FileExtractor(file, items_count)
+def get_file_info(
+    file: pathlib.Path, items_count=0, has_icon: bool | None = None
+):
+    extractor = InfoExtractor.FileExtractor(file, items_count, has_icon)
     return extractor.get_filemeta()
 
 
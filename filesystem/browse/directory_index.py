@@ -0,0 +1,252 @@
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from typing import Callable, Iterable
+
+from . import scan
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS directory ("
+    "path TEXT PRIMARY KEY, "
+    "mtime_ns INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entry ("
+    "directory TEXT NOT NULL, "
+    "name TEXT NOT NULL, "
+    "is_dir INTEGER NOT NULL, "
+    "mtime REAL NOT NULL, "
+    "size INTEGER NOT NULL, "
+    "has_icon INTEGER NOT NULL, "
+    "has_dir_config INTEGER NOT NULL, "
+    # file is a part of SRS or DASH manifest and is not listed
+    "excluded INTEGER NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (directory, name))",
+    "CREATE INDEX IF NOT EXISTS entry_by_mtime "
+    "ON entry (directory, is_dir, excluded, mtime DESC, name)",
+    "CREATE TABLE IF NOT EXISTS manifest_member ("
+    "directory TEXT NOT NULL, "
+    "manifest TEXT NOT NULL, "
+    "member TEXT NOT NULL, "
+    "PRIMARY KEY (directory, manifest, member))",
+)
+
+
+class DirectoryIndex:
+    """
+    SQLite index of directory entries for paginated listings.
+
+    A directory is rescanned only when its mtime differs from the stored
+    one. The rescan diffs the listing against stored rows, so only new or
+    changed manifests are parsed again. Pages are then read with
+    LIMIT/OFFSET, files ordered by mtime like the in-memory listing.
+
+    manifest_files(path) returns the files referenced by an .srs or .mpd
+    manifest, those files are hidden from listings.
+    """
+
+    def __init__(
+        self,
+        db_file: pathlib.Path,
+        file_extensions: set[str],
+        manifest_files: Callable[[pathlib.Path], Iterable[pathlib.Path]],
+    ):
+        self._db_file = db_file
+        self._file_extensions = file_extensions
+        self._manifest_files = manifest_files
+        self._local = threading.local()
+        connection = self._get_connection()
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self._db_file, timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _stored_mtime(self, connection, directory: str) -> int | None:
+        row = connection.execute(
+            "SELECT mtime_ns FROM directory WHERE path = ?", (directory,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def refresh(self, folder: pathlib.Path) -> int:
+        """
+        Bring the index of folder up to date.
+
+        Returns the number of listed entries (subdirectories and files
+        which are not parts of manifests).
+        """
+        directory = str(folder)
+        mtime_ns = folder.stat().st_mtime_ns
+        connection = self._get_connection()
+        if self._stored_mtime(connection, directory) != mtime_ns:
+            # IMMEDIATE takes the write lock, so only one thread or process
+            # rescans, the others find the updated mtime afterwards
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if self._stored_mtime(connection, directory) != mtime_ns:
+                    self._rescan(connection, folder, directory, mtime_ns)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return self.count(folder)
+
+    def _rescan(self, connection, folder, directory: str, mtime_ns: int):
+        dirs, files = scan.scan_directory(folder, self._file_extensions)
+        stored = {
+            row[0]: tuple(row[1:])
+            for row in connection.execute(
+                "SELECT name, is_dir, mtime, size, has_icon, has_dir_config "
+                "FROM entry WHERE directory = ?",
+                (directory,),
+            )
+        }
+        current = {
+            entry.name: (
+                int(entry.is_dir),
+                entry.mtime,
+                entry.size,
+                int(entry.has_icon),
+                int(entry.has_dir_config),
+            )
+            for entry in dirs + files
+        }
+        removed = stored.keys() - current.keys()
+        changed = [
+            name
+            for name, values in current.items()
+            if stored.get(name) != values
+        ]
+        connection.executemany(
+            "DELETE FROM entry WHERE directory = ? AND name = ?",
+            ((directory, name) for name in removed),
+        )
+        connection.executemany(
+            "INSERT OR REPLACE INTO entry (directory, name, is_dir, mtime, "
+            "size, has_icon, has_dir_config) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((directory, name, *current[name]) for name in changed),
+        )
+        for name in removed.union(changed):
+            connection.execute(
+                "DELETE FROM manifest_member "
+                "WHERE directory = ? AND manifest = ?",
+                (directory, name),
+            )
+        for name in changed:
+            if pathlib.PurePath(name).suffix.lower() not in {".srs", ".mpd"}:
+                continue
+            members = set()
+            for member in self._manifest_files(folder.joinpath(name)):
+                member = pathlib.Path(member)
+                if member.parent == folder:
+                    members.add(member.name)
+            connection.executemany(
+                "INSERT OR IGNORE INTO manifest_member "
+                "(directory, manifest, member) VALUES (?, ?, ?)",
+                ((directory, name, member) for member in members),
+            )
+        connection.execute(
+            "UPDATE entry SET excluded = (name IN ("
+            "SELECT member FROM manifest_member WHERE directory = ?"
+            ")) WHERE directory = ?",
+            (directory, directory),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO directory (path, mtime_ns) VALUES (?, ?)",
+            (directory, mtime_ns),
+        )
+        logger.info(
+            "indexed {}: {} entries, {} changed, {} removed".format(
+                directory, len(current), len(changed), len(removed)
+            )
+        )
+
+    def invalidate(self, path: pathlib.Path, event_type):
+        """
+        Force rescan of directories affected by a change of path.
+
+        Suitable as shared_code.fs_watch invalidator: changing a file in
+        place does not change the mtime of its directory.
+        """
+        directory = str(path)
+        self._get_connection().execute(
+            "UPDATE directory SET mtime_ns = -1 "
+            "WHERE path = ? OR path = ? OR path LIKE ? ESCAPE '\\'",
+            (
+                str(path.parent),
+                directory,
+                directory.replace("\\", "\\\\")
+                .replace("%", "\\%")
+                .replace("_", "\\_")
+                + "/%",
+            ),
+        )
+
+    def count(self, folder: pathlib.Path) -> int:
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT COUNT(*) FROM entry "
+                "WHERE directory = ? AND excluded = 0",
+                (str(folder),),
+            )
+            .fetchone()[0]
+        )
+
+    def count_dirs(self, folder: pathlib.Path) -> int:
+        return (
+            self._get_connection()
+            .execute(
+                "SELECT COUNT(*) FROM entry "
+                "WHERE directory = ? AND is_dir = 1",
+                (str(folder),),
+            )
+            .fetchone()[0]
+        )
+
+    def _entries(self, rows, folder: pathlib.Path) -> list[scan.ScanEntry]:
+        return [
+            scan.ScanEntry(
+                folder.joinpath(name),
+                bool(is_dir),
+                size,
+                mtime,
+                bool(has_icon),
+                bool(has_dir_config),
+            )
+            for name, is_dir, mtime, size, has_icon, has_dir_config in rows
+        ]
+
+    def get_dirs(
+        self, folder: pathlib.Path, offset: int, limit: int
+    ) -> list[scan.ScanEntry]:
+        rows = self._get_connection().execute(
+            "SELECT name, is_dir, mtime, size, has_icon, has_dir_config "
+            "FROM entry WHERE directory = ? AND is_dir = 1 "
+            "ORDER BY name LIMIT ? OFFSET ?",
+            (str(folder), limit, offset),
+        )
+        return self._entries(rows, folder)
+
+    def get_files(
+        self, folder: pathlib.Path, offset: int, limit: int
+    ) -> list[scan.ScanEntry]:
+        """Files newest first, as in the in-memory listing."""
+        rows = self._get_connection().execute(
+            "SELECT name, is_dir, mtime, size, has_icon, has_dir_config "
+            "FROM entry WHERE directory = ? AND is_dir = 0 AND excluded = 0 "
+            "ORDER BY mtime DESC, name LIMIT ? OFFSET ?",
+            (str(folder), limit, offset),
+        )
+        return self._entries(rows, folder)
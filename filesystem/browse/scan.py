@@ -0,0 +1,128 @@
+import dataclasses
+import os
+import pathlib
+import stat
+from typing import Iterable
+
+ICON_SUFFIX = ".icon"
+DIR_CONFIG_NAME = ".imgview-dir-config.json"
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ScanEntry:
+    path: pathlib.Path
+    is_dir: bool
+    size: int
+    mtime: float
+    # <file>.icon exists next to the file
+    has_icon: bool = False
+    # the directory contains .imgview-dir-config.json
+    has_dir_config: bool = False
+
+    @property
+    def name(self) -> str:
+        return self.path.name
+
+    @property
+    def suffix(self) -> str:
+        return self.path.suffix.lower()
+
+
+def _has_dir_config(path: str) -> bool:
+    # also False for unreadable directories
+    return os.path.exists(os.path.join(path, DIR_CONFIG_NAME))
+
+
+def scan_directory(
+    folder: pathlib.Path, file_extensions: set[str]
+) -> tuple[list[ScanEntry], list[ScanEntry]]:
+    """
+    List visible subdirectories and files with one of file_extensions.
+
+    Entry type comes from the directory listing itself and sidecar icons
+    are looked up in the set of listed names, so a file costs a single
+    stat() call (for size and mtime) and a directory one probe for the
+    directory config file.
+    """
+    dirs: list[ScanEntry] = []
+    files: list[ScanEntry] = []
+    with os.scandir(folder) as it:
+        entries = list(it)
+    names = {entry.name for entry in entries}
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if entry.name[0] == ".":
+                    continue
+                dirs.append(
+                    ScanEntry(
+                        pathlib.Path(entry.path),
+                        True,
+                        0,
+                        0.0,
+                        has_dir_config=_has_dir_config(entry.path),
+                    )
+                )
+            elif entry.is_file():
+                if (
+                    os.path.splitext(entry.name)[1].lower()
+                    not in file_extensions
+                ):
+                    continue
+                file_stat = entry.stat()
+                files.append(
+                    ScanEntry(
+                        pathlib.Path(entry.path),
+                        False,
+                        file_stat.st_size,
+                        file_stat.st_mtime,
+                        has_icon=entry.name + ICON_SUFFIX in names,
+                    )
+                )
+        except FileNotFoundError:
+            # removed during the scan
+            continue
+    return dirs, files
+
+
+def scan_paths(
+    paths: Iterable[pathlib.Path], file_extensions: set[str]
+) -> list[ScanEntry]:
+    """
+    Build entries of regular files from paths, e.g. glob results.
+
+    Names of each parent directory are listed once to detect sidecar
+    icons, icons in directories that can't be listed are probed.
+    """
+    parent_names: dict[pathlib.Path, set[str] | None] = dict()
+    files: list[ScanEntry] = []
+    for path in paths:
+        if path.suffix.lower() not in file_extensions:
+            continue
+        try:
+            file_stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+        if path.parent not in parent_names:
+            try:
+                parent_names[path.parent] = set(os.listdir(path.parent))
+            except PermissionError:
+                # searchable but not readable, icons are probed instead
+                parent_names[path.parent] = None
+        names = parent_names[path.parent]
+        if names is None:
+            has_icon = os.path.exists(str(path) + ICON_SUFFIX)
+        else:
+            has_icon = path.name + ICON_SUFFIX in names
+        files.append(
+            ScanEntry(
+                path,
+                False,
+                file_stat.st_size,
+                file_stat.st_mtime,
+                has_icon=has_icon,
+            )
+        )
+    return files
@@ -0,0 +1,451 @@
+"""
+Thumbnail cache pre-generation.
+
+Walks a directory tree or a medialib tag query and generates thumbnails
+of every configured size and format in a process pool. Thumbnails that
+are already cached are skipped, so an interrupted run can be simply
+started again.
+
+Usage (from the application directory):
+    python -m filesystem.prewarm ROOT_DIR [--dir SUBDIR] [--size WxH]
+    python -m filesystem.prewarm ROOT_DIR --medialib [--tags a,b] [--not-tags c]
+"""
+
+import argparse
+import array
+import concurrent.futures
+import dataclasses
+import io
+import logging
+import multiprocessing
+import os
+import pathlib
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+import config
+import medialib
+import medialib_db
+import shared_code
+from . import thumbnails
+from .browse import (
+    get_manifest_members,
+    image_file_extensions,
+    video_file_extensions,
+    supported_file_extensions,
+)
+from .browse.InfoExtractor import THUMBNAIL_FORMATS, THUMBNAIL_SCALES
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_CONTENT_TYPES = {"image", "video", "video-loop"}
+REPORT_INTERVAL = 100
+
+
+def make_variants(
+    base_sizes: Iterable[tuple[int, int]],
+) -> list[tuple[str, int, int]]:
+    variants = []
+    for width, height in base_sizes:
+        for _format in THUMBNAIL_FORMATS:
+            for scale in THUMBNAIL_SCALES:
+                variant = (_format, int(width * scale), int(height * scale))
+                if variant not in variants:
+                    variants.append(variant)
+    return variants
+
+
+def iter_directory_sources(directory: pathlib.Path) -> Iterator[pathlib.Path]:
+    """Yield files which get a thumbnail in the file browser."""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        # sorted order makes progress of interrupted runs predictable
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames if dirname[0] != "."
+        )
+        # normalized as members of get_manifest_members()
+        current_dir = pathlib.Path(os.path.normpath(dirpath))
+        names = set(filenames)
+        # members of SRS and DASH manifests, skipped as the browser does
+        excluded_files: set[pathlib.Path] = set()
+        for filename in filenames:
+            if filename.lower().endswith((".srs", ".mpd")):
+                excluded_files.update(
+                    get_manifest_members(current_dir.joinpath(filename))
+                )
+        for filename in sorted(filenames):
+            file = current_dir.joinpath(filename)
+            suffix = file.suffix.lower()
+            if suffix not in supported_file_extensions:
+                continue
+            if file in excluded_files:
+                continue
+            if filename + ".icon" in names:
+                yield current_dir.joinpath(filename + ".icon")
+            elif (
+                suffix in image_file_extensions
+                or suffix in video_file_extensions
+                or suffix == ".srs"
+            ):
+                yield file
+
+
+def iter_tag_query_sources(
+    tags_groups: list[dict[str, Any]] | None, hidden_filtering: int
+) -> Iterator[int]:
+    """Yield content IDs matching the medialib tag query."""
+    filter_hidden = medialib_db.files_by_tag_search.HIDDEN_FILTERING(
+        hidden_filtering
+    )
+    order_by = medialib_db.files_by_tag_search.ORDERING_BY.NO_SORT
+    connection = medialib_db.common.make_connection()
+    # one query for all results: OFFSET paging rescans skipped rows of
+    # every page, quadratic in the number of results
+    try:
+        if tags_groups is None:
+            number_of_items = medialib_db.files_by_tag_search.get_total_count(
+                connection, filter_hidden=filter_hidden
+            )
+            raw_content_list = medialib_db.files_by_tag_search.get_all_media(
+                connection,
+                limit=number_of_items,
+                offset=0,
+                order_by=order_by,
+                filter_hidden=filter_hidden,
+            )
+        else:
+            number_of_items = (
+                medialib_db.files_by_tag_search.count_media_by_tags(
+                    connection, *tags_groups, filter_hidden=filter_hidden
+                )
+            )
+            raw_content_list = (
+                medialib_db.files_by_tag_search.get_media_by_tags(
+                    connection,
+                    *tags_groups,
+                    limit=number_of_items,
+                    offset=0,
+                    order_by=order_by,
+                    filter_hidden=filter_hidden,
+                )
+            )
+    finally:
+        connection.close()
+    content_ids = array.array(
+        "q",
+        (
+            content_id
+            for content_id, file_str, content_type, title in raw_content_list
+            if content_type in THUMBNAIL_CONTENT_TYPES
+        ),
+    )
+    del raw_content_list
+    yield from content_ids
+
+
+def init_worker(
+    root_dir: pathlib.Path,
+    cache_dir: pathlib.Path | None,
+    cache_max_size: int | None,
+):
+    shared_code.root_dir = root_dir
+    # the pool already runs a process per CPU
+    shared_code.encoder_threads = 1
+    if cache_dir is not None:
+        shared_code.fs_thumbnail_cache = shared_code.disk_cache.DiskCache(
+            cache_dir, cache_max_size
+        )
+
+
+def prewarm_file(
+    path: pathlib.Path, variants: list[tuple[str, int, int]]
+) -> tuple[int, int]:
+    source_stat = path.stat()
+    missing_variants = [
+        variant
+        for variant in variants
+        if not thumbnails.is_thumbnail_cached(path, source_stat, *variant)
+    ]
+    if len(missing_variants) == 0:
+        return 0, len(variants)
+    largest_variant = max(missing_variants, key=lambda v: v[1] * v[2])
+    img = thumbnails.open_thumbnail_source(
+        path, largest_variant[1], largest_variant[2]
+    )
+    try:
+        for _format, width, height in missing_variants:
+            thumbnails.get_cached_thumbnail(
+                path, _format, width, height, source_stat, img.copy()
+            )
+    finally:
+        img.close()
+    return len(missing_variants), len(variants) - len(missing_variants)
+
+
+def prewarm_content(
+    content_id: int, variants: list[tuple[str, int, int]]
+) -> tuple[int, int]:
+    # worker processes reuse pooled connections between content items
+    with shared_code.db_pool.checkout() as connection:
+        missing_variants = [
+            (_format, width, height)
+            for _format, width, height in variants
+            if medialib_db.get_thumbnail_by_content_id(
+                content_id, width, height, _format, connection
+            )[0]
+            is None
+        ]
+        if len(missing_variants) == 0:
+            return 0, len(variants)
+        content_metadata = medialib_db.content.get_content_metadata_by_id(
+            content_id, connection
+        )
+        file_path = shared_code.root_dir.joinpath(content_metadata.file_path)
+        if file_path.suffix == ".srs":
+            file_path = medialib.load_representations(
+                content_id, file_path, connection
+            )[-1].file_path
+        largest_variant = max(missing_variants, key=lambda v: v[1] * v[2])
+        img = medialib.complex_formats_processing(
+            medialib.open_thumbnail_source(
+                file_path, largest_variant[1], largest_variant[2]
+            )
+        )
+        try:
+            allow_hashing = medialib.check_hashing_allowed(content_metadata)
+            for _format, width, height in missing_variants:
+                buffer, mime = medialib.store_thumbnail(
+                    content_id,
+                    img.copy(),
+                    allow_hashing,
+                    _format,
+                    width,
+                    height,
+                    connection,
+                )
+                # image hash is stored by the first variant
+                allow_hashing = False
+                if isinstance(buffer, io.BytesIO):
+                    buffer.close()
+        finally:
+            img.close()
+    return len(missing_variants), len(variants) - len(missing_variants)
+
+
+@dataclasses.dataclass
+class PrewarmProgress:
+    queued: int = 0
+    processed: int = 0
+    failed: int = 0
+    generated_thumbnails: int = 0
+    skipped_thumbnails: int = 0
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    finished: bool = False
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def as_dict(self) -> dict[str, Any]:
+        elapsed = self.elapsed()
+        return dataclasses.asdict(self) | {
+            "elapsed": elapsed,
+            "sources_per_second": self.processed / elapsed,
+            "thumbnails_per_second": self.generated_thumbnails / elapsed,
+        }
+
+    def report(self) -> str:
+        elapsed = self.elapsed()
+        return (
+            "{} of {} sources processed ({} failed), {} thumbnails "
+            "generated, {} already cached, {:.1f} s, {:.2f} sources/s, "
+            "{:.2f} thumbnails/s".format(
+                self.processed,
+                self.queued,
+                self.failed,
+                self.generated_thumbnails,
+                self.skipped_thumbnails,
+                elapsed,
+                self.processed / elapsed,
+                self.generated_thumbnails / elapsed,
+            )
+        )
+
+
+def run_prewarm(
+    sources: Iterable,
+    worker_function: Callable[[Any, list], tuple[int, int]],
+    variants: list[tuple[str, int, int]],
+    progress: PrewarmProgress,
+    workers: int | None = None,
+):
+    if workers is None:
+        workers = os.cpu_count()
+    cache = shared_code.fs_thumbnail_cache
+
+    def collect(done_futures):
+        for future in done_futures:
+            source = futures_sources.pop(future)
+            try:
+                generated, skipped = future.result()
+                progress.generated_thumbnails += generated
+                progress.skipped_thumbnails += skipped
+            except Exception:
+                logger.exception(
+                    "thumbnail generation failed for {}".format(source)
+                )
+                progress.failed += 1
+            progress.processed += 1
+            if progress.processed % REPORT_INTERVAL == 0:
+                logger.info(progress.report())
+
+    futures_sources = {}
+    # spawn: forking a threaded web server process is unsafe
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(
+            shared_code.root_dir,
+            cache.cache_dir if cache is not None else None,
+            cache.max_size if cache is not None else None,
+        ),
+    ) as executor:
+        pending = set()
+        for source in sources:
+            future = executor.submit(worker_function, source, variants)
+            futures_sources[future] = source
+            pending.add(future)
+            progress.queued += 1
+            # bounded queue keeps memory flat for huge trees
+            if len(pending) >= workers * 4:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+        collect(concurrent.futures.wait(pending).done)
+    progress.finished = True
+    logger.info(progress.report())
+
+
+class PrewarmJob(threading.Thread):
+    """Pre-generation of a server process, state acquired by the caller."""
+
+    def __init__(
+        self,
+        sources: Iterable,
+        worker_function: Callable[[Any, list], tuple[int, int]],
+        variants: list[tuple[str, int, int]],
+        state: shared_code.job_state.JobState,
+    ):
+        super().__init__(daemon=True)
+        self._sources = sources
+        self._worker_function = worker_function
+        self._variants = variants
+        self._state = state
+        self.progress = PrewarmProgress()
+
+    def run(self):
+        self._state.run(
+            self.progress,
+            lambda: run_prewarm(
+                self._sources,
+                self._worker_function,
+                self._variants,
+                self.progress,
+            ),
+        )
+
+
+def parse_size(size_str: str) -> tuple[int, int]:
+    width, height = size_str.split("x", maxsplit=1)
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate thumbnails into the thumbnail cache"
+    )
+    parser.add_argument("root_dir")
+    parser.add_argument(
+        "--dir", help="directory to walk, relative to root_dir", default="."
+    )
+    parser.add_argument(
+        "--medialib",
+        help="generate thumbnails of medialib content instead of files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tags",
+        help="comma separated tags of a group, any of them matches",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--not-tags",
+        help="comma separated tags of an excluding group",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--hidden-filtering",
+        type=int,
+        default=medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER.value,
+    )
+    parser.add_argument(
+        "--size",
+        help="base thumbnail size, WxH (default: prewarm_thumbnail_sizes)",
+        action="append",
+        type=parse_size,
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s::%(levelname)s::%(name)s::%(message)s",
+    )
+    os.chdir(args.root_dir)
+    shared_code.root_dir = pathlib.Path(".").absolute()
+    variants = make_variants(args.size or config.prewarm_thumbnail_sizes)
+    progress = PrewarmProgress()
+    if args.medialib:
+        if config.thumbnail_cache_dir is None:
+            parser.error("thumbnail_cache_dir is not configured")
+        tags_groups = []
+        for group_str, is_not in [(tags, False) for tags in args.tags] + [
+            (tags, True) for tags in args.not_tags
+        ]:
+            tags = [
+                int(tag) if tag.isdigit() else tag
+                for tag in group_str.split(",")
+            ]
+            tags_groups.append(
+                {"not": is_not, "tags": tags, "count": len(tags)}
+            )
+        run_prewarm(
+            iter_tag_query_sources(
+                tags_groups if len(tags_groups) else None,
+                args.hidden_filtering,
+            ),
+            prewarm_content,
+            variants,
+            progress,
+            args.workers,
+        )
+    else:
+        if config.fs_thumbnail_cache_dir is None:
+            parser.error("fs_thumbnail_cache_dir is not configured")
+        shared_code.fs_thumbnail_cache = shared_code.disk_cache.DiskCache(
+            config.fs_thumbnail_cache_dir, config.fs_thumbnail_cache_max_size
+        )
+        run_prewarm(
+            iter_directory_sources(shared_code.root_dir.joinpath(args.dir)),
+            prewarm_file,
+            variants,
+            progress,
+            args.workers,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import logging
+import os
+import pathlib
+
+import PIL.Image
+
+import pyimglib
+import shared_code
+
+logger = logging.getLogger(__name__)
+
+
+def select_srs_lod(img, width, height):
+    lods: list[pathlib.Path] = img.progressive_lods()
+    current_lod = lods.pop(0)
+    current_lod_img = pyimglib.decoders.open_image(current_lod)
+    while len(lods):
+        if isinstance(
+            current_lod_img, pyimglib.decoders.frames_stream.FramesStream
+        ):
+            current_lod_img = current_lod_img.next_frame()
+        if current_lod_img.width < width and current_lod_img.height < height:
+            current_lod = lods.pop()
+            logger.debug("CURRENT_LOD: {}".format(current_lod))
+            current_lod_img.close()
+            current_lod_img = pyimglib.decoders.open_image(current_lod)
+        else:
+            break
+    return current_lod_img
+
+
+def open_thumbnail_source(
+    path: pathlib.Path, width: int, height: int
+) -> PIL.Image.Image:
+    img = pyimglib.decoders.open_image(
+        shared_code.root_dir.joinpath(path), (width, height)
+    )
+    if isinstance(img, pyimglib.decoders.srs.ClImage):
+        img = select_srs_lod(img, width, height)
+    if isinstance(img, pyimglib.decoders.frames_stream.FramesStream):
+        img = shared_code.extract_frame_from_video(img)
+    return img
+
+
+def make_cache_key(
+    path: pathlib.Path,
+    source_stat: os.stat_result,
+    _format: str,
+    width: int,
+    height: int,
+) -> str:
+    return shared_code.disk_cache.make_key(
+        shared_code.root_dir.joinpath(path),
+        source_stat.st_size,
+        source_stat.st_mtime_ns,
+        shared_code.normalize_thumbnail_format(_format),
+        width,
+        height,
+    )
+
+
+def get_cached_thumbnail(
+    path: pathlib.Path,
+    _format: str,
+    width: int,
+    height: int,
+    source_stat: os.stat_result | None = None,
+    img: PIL.Image.Image | None = None,
+) -> pathlib.Path:
+    """
+    Return the cached thumbnail file, generating it on a cache miss.
+
+    img may be passed to reuse an already decoded source image, it is
+    consumed only if the thumbnail has to be generated.
+    Requires shared_code.fs_thumbnail_cache to be set.
+    """
+    if source_stat is None:
+        source_stat = shared_code.root_dir.joinpath(path).stat()
+    thumbnail_format = shared_code.normalize_thumbnail_format(_format)
+
+    def generate() -> bytes:
+        source_img = img
+        if source_img is None:
+            source_img = open_thumbnail_source(path, width, height)
+        buffer, mime, _ = shared_code.generate_thumbnail_image(
+            source_img, thumbnail_format, width, height
+        )
+        return buffer.getvalue()
+
+    return shared_code.fs_thumbnail_cache.get_or_create(
+        make_cache_key(path, source_stat, thumbnail_format, width, height),
+        "." + thumbnail_format,
+        generate,
+    )
+
+
+def is_thumbnail_cached(
+    path: pathlib.Path,
+    source_stat: os.stat_result,
+    _format: str,
+    width: int,
+    height: int,
+) -> bool:
+    thumbnail_format = shared_code.normalize_thumbnail_format(_format)
+    return (
+        shared_code.fs_thumbnail_cache.get(
+            make_cache_key(path, source_stat, thumbnail_format, width, height),
+            "." + thumbnail_format,
+        )
+        is not None
+    )
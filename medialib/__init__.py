@@ -18,84 +18,18 @@ import PIL.Image
 import config
 import logging
 import multiprocessing.managers
-import enum
 
 from shared_code import jpeg_xl_fast_decode
-from . import album, tag_manager, upload
+from . import album, tag_manager, upload, bulk_upload
+from . import image_compare, queries, random_order, search_cache
+from .search_cache import ItemCountCache
+from .hash_index import similarity_index
+from .tag_cache import tag_dictionary
 
 logger = logging.getLogger(__name__)
 
 
-class ItemCountCache:
-    class State(enum.Enum):
-        EMPTY = enum.auto()
-        TOTAL = enum.auto()
-        TAGS = enum.auto()
-
-    def __init__(self):
-        self._number_of_items = 0
-        self._tags_groups = None
-        self._state: ItemCountCache.State = ItemCountCache.State.EMPTY
-
-    def get_items_count(
-        self,
-        db_connection,
-        hidden_filtering,
-        tags_groups: list | list[dict[str, Any]] = None,
-    ):
-        expected_state = (
-            ItemCountCache.State.TOTAL
-            if tags_groups is None
-            else ItemCountCache.State.TAGS
-        )
-        if expected_state is ItemCountCache.State.TAGS:
-            tags_group_tulpified = tuple(tags_groups)
-            if (
-                self._state == expected_state
-                and self._tags_groups == tags_group_tulpified
-            ):
-                return self._number_of_items
-            self._state = expected_state
-            self._number_of_items = medialib_db.files_by_tag_search.count_media_by_tags(
-                db_connection,
-                *tags_groups,
-                filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING(
-                    hidden_filtering
-                ),
-            )
-            return self._number_of_items
-        elif (
-            expected_state is ItemCountCache.State.TOTAL
-            and self._state == expected_state
-        ):
-            return self._number_of_items
-        elif expected_state is ItemCountCache.State.TOTAL:
-            self._state = expected_state
-            self._number_of_items = medialib_db.files_by_tag_search.get_total_count(
-                db_connection,
-                filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING(
-                    hidden_filtering
-                ),
-            )
-            return self._number_of_items
-        else:
-            raise NotImplementedError("Unknown state")
-
-    def count_pages(
-        self,
-        db_connection,
-        items_per_page,
-        hidden_filtering,
-        tags_groups: list | list[dict[str, Any]] = None,
-    ) -> int:
-        items_count = self.get_items_count(
-            db_connection, hidden_filtering, tags_groups
-        )
-        print("ITEMS COUNT", items_count)
-        return math.ceil(items_count / items_per_page)
-
-
-ITEM_COUNT_CACHE = ItemCountCache()
+ITEM_COUNT_CACHE = search_cache.item_count_cache
 
 process: multiprocessing.Process | None = None
 manager = None
@@ -113,10 +47,12 @@ medialib_blueprint.register_blueprint(tag_manager.tag_manager_blueprint)
 medialib_blueprint.register_blueprint(upload.upload_blueprint)
 
 
-@medialib_blueprint.route("/tag-search")
-@shared_code.login_validation
-def medialib_tag_search():
-    EMPTY_GROUP = {"not": False, "tags": [], "count": 0}
+def parse_tags_groups(args) -> list[dict[str, Any]] | None:
+    """
+    Build tags groups from tag search query arguments.
+
+    Returns None if the query is empty, which means all media.
+    """
 
     def check_empty_group(tags_count, tags_list, not_tag) -> bool:
         return (
@@ -134,9 +70,38 @@ def medialib_tag_search():
             and tags_list[0] == ""
         )
 
-    tags_count = flask.request.args.getlist("tags_count")
-    tags_list = flask.request.args.getlist("tags")
-    not_tag = flask.request.args.getlist("not")
+    tags_count = args.getlist("tags_count")
+    tags_list = args.getlist("tags")
+    not_tag = args.getlist("not")
+    if check_empty_group(tags_count, tags_list, not_tag) or check_empty_tag(
+        tags_count, tags_list
+    ):
+        return None
+    tags_groups = [
+        {
+            "not": bool(int(not_tag[i])),
+            "tags": [],
+            "count": int(tags_count[i]),
+        }
+        for i in range(len(tags_count))
+    ]
+    for tag in tags_groups:
+        tags_count = tag["count"]
+        for i in range(tags_count):
+            value = tags_list.pop(0)
+            if value.isdigit():
+                value = int(value)
+            tag["tags"].append(value)
+    return tags_groups
+
+
+# query arguments which select the page, not carried by page links
+PAGE_POSITION_ARGS = {"page", "after", "before"}
+
+
+@medialib_blueprint.route("/tag-search")
+@shared_code.login_validation
+def medialib_tag_search():
     page = int(flask.request.args.get("page", 0))
     order_by = int(
         flask.request.args.get(
@@ -155,81 +120,67 @@ def medialib_tag_search():
     )
     itemslist, dirmeta_list, content_list = [], [], []
 
-    connection = medialib_db.common.make_connection()
-
-    if check_empty_group(tags_count, tags_list, not_tag) or check_empty_tag(
-        tags_count, tags_list
-    ):
-        raw_content_list = medialib_db.files_by_tag_search.get_all_media(
+    connection = shared_code.db_pool.get_connection()
+
+    ordering = medialib_db.files_by_tag_search.ORDERING_BY(order_by)
+    # random pages are consistent while they share the seed
+    seed = None
+    if ordering is medialib_db.files_by_tag_search.ORDERING_BY.RANDOM:
+        if "random_seed" not in flask.session:
+            flask.session["random_seed"] = random_order.new_seed()
+        seed = flask.request.args.get("seed", flask.session["random_seed"])
+
+    _args = ""
+    if seed is not None and "seed" not in flask.request.args:
+        _args += "&seed={}".format(urllib.parse.quote_plus(seed))
+    for key in flask.request.args:
+        if key not in PAGE_POSITION_ARGS:
+            for value in flask.request.args.getlist(key):
+                _args += "&{}={}".format(
+                    urllib.parse.quote_plus(key),
+                    urllib.parse.quote_plus(value),
+                )
+    filter_hidden = medialib_db.files_by_tag_search.HIDDEN_FILTERING(
+        hidden_filtering
+    )
+    tags_groups = parse_tags_groups(flask.request.args)
+    found_items_count = ITEM_COUNT_CACHE.get_items_count(
+        connection, filter_hidden, tags_groups
+    )
+    # Back and Next links carry the id of the content next to the page,
+    # other pages are found by offset
+    raw_content_list, found_items_count = (
+        search_cache.tag_search_cache.get_page(
             connection,
+            tags_groups,
+            ordering,
+            filter_hidden,
+            seed,
             limit=items_per_page,
             offset=items_per_page * page,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY(order_by),
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING(
-                hidden_filtering
-            ),
+            items_count=found_items_count,
+            after=flask.request.args.get("after", None, type=int),
+            before=flask.request.args.get("before", None, type=int),
         )
-        tags_groups = None
-        max_pages = ITEM_COUNT_CACHE.count_pages(
-            connection,
-            items_per_page,
-            medialib_db.files_by_tag_search.HIDDEN_FILTERING(hidden_filtering),
-        )
-        _args = ""
+    )
+    max_pages = math.ceil(found_items_count / items_per_page)
+    prev_cursor, next_cursor = None, None
+    if len(raw_content_list):
+        prev_cursor = raw_content_list[0][0]
+        next_cursor = raw_content_list[-1][0]
+    if tags_groups is None:
         query_data = {
             "tags_groups": [{"not": False, "tags": [], "count": 1}],
             "order_by": order_by,
             "hidden_filtering": hidden_filtering,
         }
     else:
-        tags_groups = [
-            {
-                "not": bool(int(not_tag[i])),
-                "tags": [],
-                "count": int(tags_count[i]),
-            }
-            for i in range(len(tags_count))
-        ]
-        for tag in tags_groups:
-            tags_count = tag["count"]
-            for i in range(tags_count):
-                value = tags_list.pop(0)
-                if value.isdigit():
-                    value = int(value)
-                tag["tags"].append(value)
         query_data = {
             "tags_groups": tags_groups,
             "order_by": order_by,
             "hidden_filtering": hidden_filtering,
         }
 
-        _args = ""
-        for key in flask.request.args:
-            if key != "page":
-                for value in flask.request.args.getlist(key):
-                    _args += "&{}={}".format(
-                        urllib.parse.quote_plus(key),
-                        urllib.parse.quote_plus(value),
-                    )
-
-        max_pages = 0
-        raw_content_list = medialib_db.files_by_tag_search.get_media_by_tags(
-            connection,
-            *tags_groups,
-            limit=items_per_page,
-            offset=items_per_page * page,
-            order_by=medialib_db.files_by_tag_search.ORDERING_BY(order_by),
-            filter_hidden=medialib_db.files_by_tag_search.HIDDEN_FILTERING(
-                hidden_filtering
-            ),
-        )
-        max_pages = ITEM_COUNT_CACHE.count_pages(
-            connection,
-            items_per_page,
-            medialib_db.files_by_tag_search.HIDDEN_FILTERING(hidden_filtering),
-            tags_groups,
-        )
-
     items_count = 0
     itemslist.append(
         {
@@ -254,11 +205,11 @@ def medialib_tag_search():
             for tag in tags_group["tags"]:
                 if type(tag) is int:
                     group_list.append(
-                        medialib_db.get_tag_name_by_id(connection, tag)
+                        tag_dictionary.get_tag_name_by_id(connection, tag)
                     )
                 else:
                     group_list.append(
-                        medialib_db.get_tag_name_by_alias(connection, tag)
+                        tag_dictionary.get_tag_name_by_alias(connection, tag)
                     )
             tags_group["group_str"] = " or ".join([tag for tag in group_list])
 
@@ -283,8 +234,6 @@ def medialib_tag_search():
         "enable_external_scripts": shared_code.enable_external_scripts,
     }
 
-    connection.close()
-
     return flask.render_template(
         "index.html",
         itemslist=itemslist,
@@ -294,6 +243,8 @@ def medialib_tag_search():
         page=page,
         max_pages=max_pages,
         items_per_page=items_per_page,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         thumbnail=shared_code.get_thumbnail_size(),
         **template_kwargs,
     )
@@ -356,11 +307,10 @@ def register_tags():
         tag_index += 1
 
     tag_ids = set()
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     for tag in enabled_tags:
-        tag_id = medialib_db.tags_indexer.get_tag_id_by_alias(tag, connection)
+        tag_id = tag_dictionary.get_tag_id_by_alias(connection, tag)
         if tag_id is None:
-            connection.close()
             return flask.make_response(f"Not found tag {tag}", 500)
         tag_ids.add(tag_id)
 
@@ -404,7 +354,7 @@ def register_tags():
         content_id, list(tag_ids), connection
     )
     connection.commit()
-    connection.close()
+    search_cache.invalidate()
 
     return flask.redirect(f"/content_metadata/mlid{content_id}")
 
@@ -412,7 +362,7 @@ def register_tags():
 @medialib_blueprint.route("/show-duplicates/")
 @shared_code.login_validation
 def medialib_show_duplicates():
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
 
     show_alternates = bool(int(flask.request.args.get("show_alternates", 0)))
 
@@ -465,12 +415,11 @@ def medialib_show_duplicates():
 @shared_code.login_validation
 def ml_update_content(content_id: int):
     if flask.request.method == "POST":
-        medialib_db_connection = medialib_db.common.make_connection()
+        medialib_db_connection = shared_code.db_pool.get_connection()
         content_data = medialib_db.get_content_metadata_by_content_id(
             content_id, medialib_db_connection
         )
         if content_data is None:
-            medialib_db_connection.close()
             return flask.abort(404)
 
         old_file_path = medialib_db.config.relative_to.joinpath(
@@ -509,7 +458,11 @@ def ml_update_content(content_id: int):
         medialib_db.update_file_path(
             content_id, file_path, image_hash, medialib_db_connection
         )
-        medialib_db_connection.close()
+        if image_hash is not None:
+            similarity_index.add(content_id, image_hash)
+        else:
+            similarity_index.remove(content_id)
+        search_cache.invalidate()
         return "file uploaded successfully"
 
 
@@ -518,9 +471,8 @@ def ml_update_content(content_id: int):
 )
 @shared_code.login_validation
 def drop_thumbnails(content_id):
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.drop_thumbnails(content_id, connection)
-    connection.close()
     return "OK"
 
 
@@ -569,6 +521,60 @@ def check_max_size(size, compatibility_level) -> bool:
     return size <= COMPATIBILITY_LEVEL_MAX_SIZE[compatibility_level]
 
 
+def check_hashing_allowed(content_metadata: medialib_db.content.Content):
+    return (
+        content_metadata.content_type == "image"
+        and content_metadata.file_path.suffix != ".svg"
+    )
+
+
+def open_thumbnail_source(file_path: pathlib.Path, width: int, height: int):
+    if file_path.suffix == ".jxl":
+        jpeg_buffer = io.BytesIO(jpeg_xl_fast_decode(file_path))
+        return PIL.Image.open(jpeg_buffer)
+    elif file_path.suffix == ".avif":
+        return pyimglib.decoders.avif.decode(file_path)
+    else:
+        return pyimglib.decoders.open_image(file_path, (width, height))
+
+
+def store_thumbnail(
+    content_id: int,
+    img: PIL.Image.Image,
+    allow_hashing: bool,
+    _format: str,
+    width: int,
+    height: int,
+    db_connection,
+) -> tuple[io.BytesIO | pathlib.Path, str]:
+    if allow_hashing:
+        existing_image_hash = medialib_db.get_image_hash(
+            content_id, db_connection
+        )
+        if existing_image_hash is None:
+            image_hash = pyimglib.calc_image_hash(img)
+            medialib_db.set_image_hash(content_id, image_hash, db_connection)
+            similarity_index.add(content_id, image_hash)
+
+    buffer, mime, _format = shared_code.generate_thumbnail_image(
+        img, _format, width, height
+    )
+    if config.thumbnail_cache_dir is not None:
+        thumbnail_file_name = medialib_db.register_thumbnail_by_content_id(
+            content_id, width, height, _format, db_connection
+        )
+        if thumbnail_file_name is not None:
+            thumbnail_file_path = pathlib.Path(
+                config.thumbnail_cache_dir
+            ).joinpath(thumbnail_file_name)
+            f = thumbnail_file_path.open("bw")
+            f.write(buffer.getvalue())
+            f.close()
+            buffer.close()
+            buffer = thumbnail_file_path
+    return buffer, mime
+
+
 @medialib_blueprint.route(
     "/thumbnail/<string:_format>/<int:width>x<int:height>/id<int:content_id>"
 )
@@ -580,7 +586,7 @@ def gen_thumbnail(
         flask.abort(404)
     allow_origin = bool(flask.request.args.get("allow_origin", False))
     content_id = int(content_id)
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
     if config.thumbnail_cache_dir is not None:
         thumbnail_file_path, thumbnail_format = (
             medialib_db.get_thumbnail_by_content_id(
@@ -588,7 +594,6 @@ def gen_thumbnail(
             )
         )
         if thumbnail_file_path is not None:
-            db_connection.close()
             return flask.send_file(
                 config.thumbnail_cache_dir.joinpath(thumbnail_file_path),
                 mimetype=shared_code.MIME_TYPES_BY_FORMAT[thumbnail_format],
@@ -607,13 +612,7 @@ def gen_thumbnail(
         raise ValueError("Unexpected value of compatibility level")
 
     img = None
-    allow_hashing = True
-
-    if content_metadata.content_type == "image":
-        if file_path.suffix == ".svg":
-            allow_hashing = False
-    else:
-        allow_hashing = False
+    allow_hashing = check_hashing_allowed(content_metadata)
 
     if file_path.suffix == ".srs":
         representations = load_representations(
@@ -625,7 +624,6 @@ def gen_thumbnail(
                     representation.compatibility_level >= compatibility_level
                     and representation.format == _format
                 ):
-                    db_connection.close()
                     base32path = shared_code.str_to_base32(
                         str(representation.file_path)
                     )
@@ -633,7 +631,6 @@ def gen_thumbnail(
                         "{}orig/{}".format(flask.request.host_url, base32path)
                     )
             if representations[-1].format in {"webp", "jpeg", "png"}:
-                db_connection.close()
                 base32path = shared_code.str_to_base32(
                     str(representations[-1].file_path)
                 )
@@ -659,64 +656,36 @@ def gen_thumbnail(
     else:
         logger.info("default thumbnail generation")
 
-    if file_path.suffix == ".jxl":
+    if file_path.suffix == ".jxl" and allow_origin:
         jpeg_buffer = io.BytesIO(jpeg_xl_fast_decode(file_path))
-        if allow_origin:
-            return flask.send_file(jpeg_buffer, mimetype="image/jpeg")
-        img = PIL.Image.open(jpeg_buffer)
-    elif file_path.suffix == ".avif":
-        img = pyimglib.decoders.avif.decode(file_path)
-        if (
-            allow_origin
-            and _format == "avif"
-            and check_max_size(img.width, compatibility_level)
-            and check_max_size(img.height, compatibility_level)
-        ):
-
-            return flask.redirect(
-                "{}orig/{}".format(
-                    flask.request.host_url,
-                    shared_code.str_to_base32(str(file_path)),
-                )
+        return flask.send_file(jpeg_buffer, mimetype="image/jpeg")
+    img = open_thumbnail_source(file_path, width, height)
+    if (
+        file_path.suffix == ".avif"
+        and allow_origin
+        and _format == "avif"
+        and check_max_size(img.width, compatibility_level)
+        and check_max_size(img.height, compatibility_level)
+    ):
+        return flask.redirect(
+            "{}orig/{}".format(
+                flask.request.host_url,
+                shared_code.str_to_base32(str(file_path)),
             )
-    else:
-        img = pyimglib.decoders.open_image(file_path, (width, height))
+        )
 
     extracted_img = complex_formats_processing(img, file_path, allow_origin)
     logger.debug("extracted_img: {}".format(extracted_img.__repr__()))
     if isinstance(extracted_img, flask.Response):
-        db_connection.close()
         return extracted_img
     elif isinstance(extracted_img, PIL.Image.Image):
         img = extracted_img
     else:
         raise NotImplementedError(type(extracted_img))
 
-    if allow_hashing:
-        existing_image_hash = medialib_db.get_image_hash(
-            content_id, db_connection
-        )
-        if existing_image_hash is None:
-            image_hash = pyimglib.calc_image_hash(img)
-            medialib_db.set_image_hash(content_id, image_hash, db_connection)
-
-    buffer, mime, _format = shared_code.generate_thumbnail_image(
-        img, _format, width, height
+    buffer, mime = store_thumbnail(
+        content_id, img, allow_hashing, _format, width, height, db_connection
     )
-    if config.thumbnail_cache_dir is not None:
-        thumbnail_file_name = medialib_db.register_thumbnail_by_content_id(
-            content_id, width, height, _format, db_connection
-        )
-        if thumbnail_file_name is not None:
-            thumbnail_file_path = pathlib.Path(
-                config.thumbnail_cache_dir
-            ).joinpath(thumbnail_file_name)
-            f = thumbnail_file_path.open("bw")
-            f.write(buffer.getvalue())
-            f.close()
-            buffer.close()
-            buffer = thumbnail_file_path
-    db_connection.close()
     return flask.send_file(
         buffer,
         mimetype=mime,
@@ -728,11 +697,11 @@ def gen_thumbnail(
 @shared_code.login_validation
 def post_tags():
     data = flask.request.json
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
     medialib_db.add_tags_for_content_by_tag_ids(
         data["content_id"], data["tag_ids"], db_connection
     )
-    db_connection.close()
+    search_cache.invalidate()
     return "OK"
 
 
@@ -787,9 +756,6 @@ def custom_dumper(obj):
         raise TypeError("Unknown type {}".format(type(obj)))
 
 
-RGBA_BANDS_COUNT = 4
-
-
 @medialib_blueprint.route("/compare-by-hash")
 @shared_code.login_validation
 def compare_image():
@@ -799,11 +765,12 @@ def compare_image():
     if value_hash is None or hue_hash is None or saturation_hash is None:
         flask.abort(404)
 
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
     content_id_list = medialib_db.find_content_by_hash(
         value_hash, hue_hash, saturation_hash, db_connection
     )
     image_data_list: list[ImageData] = list()
+    comparison_sources: list[image_compare.ComparisonSource] = list()
 
     for content_id, alternate_version in content_id_list:
         db_content = medialib_db.content.get_content_metadata_by_id(
@@ -836,6 +803,9 @@ def compare_image():
         if not isinstance(img, PILimageClass):
             raise TypeError("Unidentified image type: {}".format(type(img)))
 
+        comparison_sources.append(image_compare.prepare(img))
+        img.close()
+
         content_origin = None
         origins = medialib_db.origin.get_origins_of_content(
             db_connection, content_id
@@ -855,14 +825,14 @@ def compare_image():
                 shared_code.str_to_base32(str(db_content.file_path)),
                 db_content.content_type,
                 file_path.suffix,
-                img.width,
-                img.height,
+                comparison_sources[-1].width,
+                comparison_sources[-1].height,
                 representations,
                 content_origin.origin_name,
                 content_origin.origin_id,
                 db_content.addition_date,
                 alternate_version,
-                image=img,
+                image=None,
             )
         else:
             image_data = ImageData(
@@ -870,18 +840,20 @@ def compare_image():
                 shared_code.str_to_base32(str(db_content.file_path)),
                 db_content.content_type,
                 file_path.suffix,
-                img.width,
-                img.height,
+                comparison_sources[-1].width,
+                comparison_sources[-1].height,
                 representations,
                 None,
                 None,
                 db_content.addition_date,
                 alternate_version,
-                image=img,
+                image=None,
             )
 
         image_data_list.append(image_data)
 
+    differences = image_compare.pairwise_differences(comparison_sources)
+    comparison_sources.clear()
     compare_results: list[CompareResult] = []
 
     for first_index in range(len(image_data_list)):
@@ -891,35 +863,9 @@ def compare_image():
             size_equal: bool = (
                 first_image_data.calc_size() == second_image_data.calc_size()
             )
-            difference: float | None = None
-            no_difference = False
-            if size_equal:
-                import PIL.ImageMath
-
-                max_value = (
-                    first_image_data.calc_size() * 255 * (RGBA_BANDS_COUNT - 1)
-                )
-                pixels_sum = 0
-                first_rgba_image_bands = first_image_data.image.convert(
-                    mode="RGBA"
-                ).split()
-                second_rgba_image_bands = second_image_data.image.convert(
-                    mode="RGBA"
-                ).split()
-                bands_diff = []
-                for i in range(RGBA_BANDS_COUNT):
-                    diff_image: PIL.Image.Image = PIL.ImageMath.eval(
-                        "abs(a - b)",
-                        a=first_rgba_image_bands[i],
-                        b=second_rgba_image_bands[i],
-                    )
-                    diff_histogram = diff_image.histogram()
-                    for value in range(256):
-                        pixels_sum += value * diff_histogram[value]
-                    diff_image.close()
-                if pixels_sum == 0:
-                    no_difference = True
-                difference = pixels_sum / max_value
+            no_difference, difference = differences.get(
+                (first_index, second_index), (False, None)
+            )
             compare_result = CompareResult(
                 first_image_data.content_id,
                 second_image_data.content_id,
@@ -940,7 +886,6 @@ def compare_image():
         "image_data": image_data_list,
         "compare_results": compare_results,
     }
-    db_connection.close()
     return flask.render_template(
         "compare_images.html",
         title="Compare images",
@@ -948,15 +893,35 @@ def compare_image():
     )
 
 
+@medialib_blueprint.route("/similar/id<int:content_id>")
+@shared_code.login_validation
+def find_similar(content_id: int):
+    """Contents with perceptual hash within max_distance bits."""
+    max_distance = flask.request.args.get("max_distance", 8, type=int)
+    if not similarity_index.loaded.is_set():
+        return flask.make_response("Similarity index is loading", 503)
+    found = similarity_index.search(content_id, max_distance)
+    if found is None:
+        flask.abort(404)
+    return flask.Response(
+        json.dumps(
+            [
+                {"content_id": similar_id, "distance": distance}
+                for similar_id, distance in found
+            ]
+        ),
+        mimetype="application/json",
+    )
+
+
 @medialib_blueprint.route("/mark_alternate")
 @shared_code.login_validation
 def mark_alternate():
     content_id_list = flask.request.args.getlist("content_id", type=int)
     if len(content_id_list) != 2:
         return "function takes exactly 2 content IDs"
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.mark_alternate_version(
         content_id_list[0], content_id_list[1], connection
     )
-    connection.close()
     return "OK"
@@ -5,6 +5,8 @@ import flask
 import filesystem
 import medialib_db
 import shared_code
+from . import queries
+from .tag_cache import tag_dictionary
 
 album_blueprint = flask.Blueprint("album", __name__, url_prefix="/album")
 
@@ -17,14 +19,15 @@ def _get_content_list(
     ),
     items_count,
 ):
+    origins = queries.get_origins_of_contents(
+        db_connection,
+        [db_content.content_id for db_content in ordered_content_list],
+    )
     content_data_elements: list[filesystem.browse.DataElement] = []
     for db_content in ordered_content_list:
         content_data_elements.append(
             filesystem.browse.DataElement(
-                db_content,
-                medialib_db.origin.get_origins_of_content(
-                    db_connection, db_content.content_id
-                ),
+                db_content, origins[db_content.content_id]
             )
         )
 
@@ -40,7 +43,7 @@ def _get_content_list(
 @album_blueprint.route("/show/id<int:album_id>")
 @shared_code.login_validation
 def show_album(album_id: int):
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
 
     _album_title = medialib_db.album.get_album_title(
         album_id, connection=db_connection
@@ -96,7 +99,7 @@ def show_album(album_id: int):
 @album_blueprint.route("/show")
 @shared_code.login_validation
 def show_album_gallery():
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
 
     title = "Album Gallery"
     raw_content_list = medialib_db.album.get_album_covers(db_connection)
@@ -148,7 +151,7 @@ def show_album_gallery():
 @album_blueprint.route("/get-album/id<int:album_id>.json")
 @shared_code.login_validation
 def medialib_get_album(album_id: int):
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
 
     ordered_content_list = None
     if album_id is not None:
@@ -181,7 +184,7 @@ def medialib_get_album(album_id: int):
 @album_blueprint.route("/edit/id<int:album_id>")
 @shared_code.login_validation
 def show_album_edit_from(album_id: int):
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
 
     ordered_content_list: (
         list[medialib_db.album.OptionallyOrderedContent]
@@ -206,8 +209,10 @@ def show_album_edit_from(album_id: int):
         ordered_content_list = medialib_db.album.get_album_related_content(
             set_tag_id, artist_tag_id, connection=db_connection
         )
-        set_name = medialib_db.get_tag_name_by_id(db_connection, set_tag_id)
-        artist = medialib_db.get_tag_name_by_id(db_connection, artist_tag_id)
+        set_name = tag_dictionary.get_tag_name_by_id(db_connection, set_tag_id)
+        artist = tag_dictionary.get_tag_name_by_id(
+            db_connection, artist_tag_id
+        )
         title = "{} by {}".format(set_name, artist)
 
     items_count = 0
@@ -232,7 +237,7 @@ def album_commit():
     if data is None:
         flask.abort(400, "JSON input expected")
     print(data)
-    db_connection = medialib_db.common.make_connection()
+    db_connection = shared_code.db_pool.get_connection()
     set_id = data["set_id"]
     artist_id = data["artist_id"]
     album_id = medialib_db.album.get_album_id(set_id, artist_id, db_connection)
@@ -245,5 +250,4 @@ def album_commit():
             album_id, content["id"], content["order"], db_connection
         )
     db_connection.commit()
-    db_connection.close()
     return "OK"
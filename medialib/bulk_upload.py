@@ -0,0 +1,538 @@
+import concurrent.futures
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import pathlib
+import tarfile
+import typing
+import zipfile
+
+import flask
+import medialib_db
+import PIL.Image
+import pillow_heif
+import pyimglib
+
+import config
+import shared_code
+from shared_code import EXTENSIONS_BY_MIME
+from . import queries, search_cache, upload, upload_jobs
+from .hash_index import similarity_index
+
+logger = logging.getLogger(__name__)
+
+BULK_JOB = "bulk"
+REGISTERED = "registered"
+DUPLICATE = "duplicate"
+UNSUPPORTED = "unsupported"
+FAILED = "failed"
+# saved by upload jobs only: the file is stored, its registration is
+# in progress
+STORED = "stored"
+REGISTERING = "registering"
+
+
+@dataclasses.dataclass
+class AnalyzedFile:
+    mime: str | None = None
+    file_type: str | None = None
+    image_hash: tuple | None = None
+    image_metadata: typing.Any = None
+    rgba_to_rgb: bool = False
+    error: str | None = None
+
+
+@dataclasses.dataclass
+class BulkItem:
+    name: str
+    spool: upload.SpooledUploadFile | None
+    request_mimetype: str | None
+    analysis: AnalyzedFile | None = None
+    status: str | None = None
+    content_id: int | None = None
+    duplicates: list[int] = dataclasses.field(default_factory=list)
+    # name of an earlier file of the same upload with the same hash
+    duplicate_of: str | None = None
+    file_path: pathlib.Path | None = None
+    saved_name: str | None = None
+    is_srs: bool = False
+    error: str | None = None
+
+    def report(self) -> dict[str, typing.Any]:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "content_id": self.content_id,
+            "duplicates": self.duplicates,
+            "duplicate_of": self.duplicate_of,
+            "error": self.error,
+        }
+
+    def save(self) -> dict[str, typing.Any]:
+        """Report with the stored file, progress of upload jobs."""
+        return self.report() | {
+            "file_path": (
+                str(self.file_path) if self.file_path is not None else None
+            ),
+            "saved_name": self.saved_name,
+            "is_srs": self.is_srs,
+        }
+
+    def restore(self, saved: dict[str, typing.Any]):
+        self.status = saved["status"]
+        self.content_id = saved["content_id"]
+        self.duplicates = saved["duplicates"]
+        self.duplicate_of = saved["duplicate_of"]
+        self.error = saved["error"]
+        if saved["file_path"] is not None:
+            self.file_path = pathlib.Path(saved["file_path"])
+        self.saved_name = saved["saved_name"]
+        self.is_srs = saved["is_srs"]
+
+
+def _open_image(file_path: pathlib.Path, mime: str) -> PIL.Image.Image:
+    if mime == upload.AVIF_MIMETYPE:
+        return pillow_heif.open_heif(file_path).to_pillow()
+    return PIL.Image.open(file_path)
+
+
+def analyze_file(
+    file_path: str, request_mimetype: str | None, origin_name: str | None
+) -> AnalyzedFile:
+    """Runs in the process pool: type detection, metadata, hash."""
+    try:
+        with open(file_path, "br") as f:
+            header = f.read(upload.MAGIC_HEADER_LENGTH)
+        mime, file_type, is_image = upload.detect_file_type(
+            header, request_mimetype
+        )
+    except Exception as e:
+        return AnalyzedFile(error=str(e))
+    analysis = AnalyzedFile(mime, file_type)
+    if mime not in EXTENSIONS_BY_MIME or not is_image:
+        return analysis
+    try:
+        with _open_image(pathlib.Path(file_path), mime) as img:
+            analysis.image_metadata, analysis.rgba_to_rgb = (
+                upload.extract_metadata_from_image(img, mime, origin_name)
+            )
+            analysis.image_hash = pyimglib.calc_image_hash(img)
+    except Exception as e:
+        analysis.error = str(e)
+    return analysis
+
+
+def encode_png(
+    file_path: str, file_size: int, outdir: str, rgba_to_rgb: bool
+) -> tuple[pathlib.Path, str, bool]:
+    """Runs in the process pool: PNG to WebP or SRS, as save_image() does."""
+    with PIL.Image.open(file_path) as img:
+        return upload.save_image(
+            None,
+            file_size,
+            upload.PNG_MIMETYPE,
+            pathlib.Path(outdir),
+            img,
+            rgba_to_rgb,
+        )
+
+
+_process_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_process_pool_pid: int | None = None
+
+
+def get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Process pool of the current server process."""
+    global _process_pool, _process_pool_pid
+    if _process_pool is None or _process_pool_pid != os.getpid():
+        _process_pool = concurrent.futures.ProcessPoolExecutor(
+            config.bulk_upload_processes
+        )
+        _process_pool_pid = os.getpid()
+    return _process_pool
+
+
+def iter_archive(
+    archive: upload.SpooledUploadFile, outdir: pathlib.Path
+) -> typing.Iterator[tuple[str, upload.SpooledUploadFile]]:
+    """
+    Spool regular files of zip or tar archive one by one, without
+    extracting the whole archive first.
+    """
+
+    def spool_member(stream) -> upload.SpooledUploadFile:
+        spool = upload.SpooledUploadFile(outdir)
+        buffer = stream.read(upload.SPOOL_BLOCK_SIZE)
+        while len(buffer):
+            spool.write(buffer)
+            buffer = stream.read(upload.SPOOL_BLOCK_SIZE)
+        spool.flush()
+        return spool
+
+    def is_hidden(name: str) -> bool:
+        return any(
+            part.startswith((".", "__MACOSX")) for part in name.split("/")
+        )
+
+    archive.flush()
+    if zipfile.is_zipfile(archive.path):
+        with zipfile.ZipFile(archive.path) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir() or is_hidden(info.filename):
+                    continue
+                with zip_file.open(info) as stream:
+                    yield info.filename, spool_member(stream)
+    else:
+        # stream mode reads members in order without seeking
+        with tarfile.open(archive.path, mode="r|*") as tar_file:
+            for member in tar_file:
+                if not member.isfile() or is_hidden(member.name):
+                    continue
+                yield member.name, spool_member(tar_file.extractfile(member))
+
+
+def find_duplicates(connection, items: list[BulkItem]):
+    """
+    Fill duplicates of images with a hash: with contents in medialib,
+    as find_content_by_hash() finds them, and with images earlier in
+    the same upload.
+    """
+    found = queries.find_contents_by_hashes(
+        connection,
+        [
+            item.analysis.image_hash
+            for item in items
+            if item.analysis.image_hash is not None
+        ],
+    )
+    seen: dict[tuple, BulkItem] = dict()
+    for item in items:
+        image_hash = item.analysis.image_hash
+        if image_hash is None:
+            continue
+        key = (bytes(image_hash[1]), image_hash[2], image_hash[3])
+        item.duplicates = list(found[key])
+        if key in seen:
+            item.duplicate_of = seen[key].name
+        else:
+            seen[key] = item
+
+
+def store_files(items: list[BulkItem], outdir: pathlib.Path):
+    """Encode PNG images in the process pool, rename the rest into place."""
+    pool = get_process_pool()
+    encodings = dict()
+    for item in items:
+        if item.analysis.mime == upload.PNG_MIMETYPE:
+            encodings[
+                pool.submit(
+                    encode_png,
+                    str(item.spool.path),
+                    item.spool.size,
+                    str(outdir),
+                    item.analysis.rgba_to_rgb,
+                )
+            ] = item
+        else:
+            filename, item.saved_name = upload.generate_filename(
+                item.analysis.mime
+            )
+            item.file_path = outdir.joinpath(filename)
+            item.spool.move_to(item.file_path)
+            shared_code.file_digests.set_digest(
+                item.file_path, item.spool.hexdigest()
+            )
+    for future in concurrent.futures.as_completed(encodings):
+        item = encodings[future]
+        try:
+            item.file_path, item.saved_name, item.is_srs = future.result()
+        except Exception as e:
+            item.status = FAILED
+            item.error = str(e)
+
+
+def register_chunk(
+    connection,
+    items: list[BulkItem],
+    outdir: pathlib.Path,
+    origin_name: str | None,
+    save_progress: typing.Callable[[], None],
+):
+    """
+    Register contents of the chunk in one transaction. The items are
+    saved as REGISTERING with their content ids before the commit, see
+    recover_items().
+    """
+    try:
+        for item in items:
+            analysis = item.analysis
+            title = str(
+                pathlib.Path(item.name).stem[: upload.MAX_TITLE_LENGTH]
+            )
+            item_origin_name, origin_id = upload.detect_source(
+                title, origin_name, None
+            )
+            description = None
+            if isinstance(analysis.image_metadata, upload.PlainTextData):
+                description = analysis.image_metadata.data
+            item.content_id = medialib_db.content_register(
+                content_title=title,
+                file_path=item.file_path,
+                content_type=analysis.file_type,
+                addition_date=datetime.datetime.now(),
+                content_id=None,
+                origin_name=item_origin_name,
+                origin_id=origin_id,
+                hidden=False,
+                description=description,
+                connection=connection,
+            )
+            upload.store_metadata_attachment(
+                connection,
+                item.content_id,
+                analysis.image_metadata,
+                outdir,
+                item.saved_name,
+            )
+            if item.is_srs:
+                upload.register_srs_representations(
+                    connection, item.content_id, item.file_path, outdir
+                )
+            if analysis.image_hash is not None:
+                medialib_db.set_image_hash(
+                    item.content_id, analysis.image_hash, connection
+                )
+            item.status = REGISTERING
+        save_progress()
+        connection.commit()
+    except Exception as e:
+        logger.exception("bulk upload chunk failed")
+        connection.rollback()
+        for item in items:
+            item.content_id = None
+            item.status = FAILED
+            item.error = str(e)
+            upload.remove_stored_files(
+                item.file_path, item.saved_name, item.is_srs
+            )
+        save_progress()
+        return
+    for item in items:
+        item.status = REGISTERED
+        if item.analysis.image_hash is not None:
+            similarity_index.add(item.content_id, item.analysis.image_hash)
+    save_progress()
+
+
+def recover_items(connection, items: list[BulkItem]):
+    """
+    Finish files of an interrupted upload job which were stored or
+    being registered: registered if their content was committed, the
+    stored files are removed otherwise.
+    """
+    recovered = False
+    for item in items:
+        if item.status == REGISTERING:
+            content = medialib_db.content.get_content_metadata_by_id(
+                item.content_id, connection
+            )
+            if (
+                content is not None
+                and content.file_path.name == item.file_path.name
+            ):
+                item.status = REGISTERED
+                image_hash = medialib_db.get_image_hash(
+                    item.content_id, connection
+                )
+                if image_hash is not None:
+                    similarity_index.add(item.content_id, image_hash)
+                recovered = True
+                continue
+        if item.status in (STORED, REGISTERING):
+            upload.remove_stored_files(
+                item.file_path, item.saved_name, item.is_srs
+            )
+            item.content_id = None
+            item.status = FAILED
+            item.error = "the job was interrupted before registration"
+    if recovered:
+        search_cache.invalidate()
+
+
+def process_items(
+    connection,
+    items: list[BulkItem],
+    outdir: pathlib.Path,
+    origin_name: str | None,
+    allow_duplicates: bool,
+    report: upload_jobs.Report,
+):
+    """
+    Analyze, store and register spooled files, filling their status.
+    Statuses of all items are reported as progress whenever they change,
+    items which have one already are not processed again.
+    """
+
+    def save_progress():
+        report("register", {"files": [item.save() for item in items]})
+
+    recover_items(connection, items)
+    pending = [item for item in items if item.status is None]
+    report("analyze")
+    pool = get_process_pool()
+    for item, analysis in zip(
+        pending,
+        pool.map(
+            analyze_file,
+            [str(item.spool.path) for item in pending],
+            [item.request_mimetype for item in pending],
+            [origin_name] * len(pending),
+        ),
+    ):
+        item.analysis = analysis
+        if analysis.error is not None:
+            item.status = FAILED
+            item.error = analysis.error
+        elif analysis.mime not in EXTENSIONS_BY_MIME:
+            item.status = UNSUPPORTED
+
+    accepted = [item for item in pending if item.status is None]
+    find_duplicates(connection, accepted)
+    if not allow_duplicates:
+        for item in accepted:
+            if len(item.duplicates) or item.duplicate_of is not None:
+                item.status = DUPLICATE
+        accepted = [item for item in accepted if item.status is None]
+    report("store", {"files": [item.save() for item in items]})
+
+    store_files(accepted, outdir)
+    accepted = [item for item in accepted if item.status is None]
+    for item in accepted:
+        item.status = STORED
+    save_progress()
+    chunk_size = config.bulk_upload_chunk_size
+    for start in range(0, len(accepted), chunk_size):
+        register_chunk(
+            connection,
+            accepted[start : start + chunk_size],
+            outdir,
+            origin_name,
+            save_progress,
+        )
+    if len(accepted):
+        search_cache.invalidate()
+
+
+def process_bulk_upload(
+    params: dict[str, typing.Any],
+    stage: str | None,
+    progress: dict[str, typing.Any] | None,
+    report: upload_jobs.Report,
+) -> dict[str, typing.Any]:
+    """
+    Upload job: the part of bulk_upload() done after spooling. A run
+    after an interruption restores statuses saved by the earlier one
+    and processes the remaining files.
+    """
+    saved_files = progress["files"] if progress is not None else None
+    items: list[BulkItem] = []
+    for index, item_params in enumerate(params["items"]):
+        item = BulkItem(item_params["name"], None, item_params["mimetype"])
+        if saved_files is not None and saved_files[index]["status"]:
+            item.restore(saved_files[index])
+        try:
+            spool = upload.SpooledUploadFile.reattach(item_params["spool"])
+        except FileNotFoundError:
+            # moved into place or removed by an earlier run
+            if item.status is None:
+                item.status = FAILED
+                item.error = "file is gone, the job was interrupted"
+        else:
+            if item.status is None:
+                item.spool = spool
+            else:
+                # rejected or encoded by the earlier run, removed now
+                spool.close()
+        items.append(item)
+    try:
+        with shared_code.db_pool.checkout() as connection:
+            process_items(
+                connection,
+                items,
+                pathlib.Path(params["outdir"]),
+                params["origin_name"],
+                params["allow_duplicates"],
+                report,
+            )
+    finally:
+        for item in items:
+            if item.spool is not None:
+                item.spool.close()
+    return {"files": [item.report() for item in items]}
+
+
+@upload.upload_blueprint.route("/bulk", methods=["POST"])
+@shared_code.login_validation
+def bulk_upload():
+    """
+    Upload of many files ("files") and zip or tar archives ("archive").
+
+    Files are analyzed and PNG images encoded in a process pool,
+    registered in one transaction per config.bulk_upload_chunk_size
+    files. With the upload job queue configured the files are only
+    spooled in the request and the rest is done by a job, the response
+    links its status, which has the report when it is done. Otherwise
+    returns JSON report with status of every file.
+    """
+    origin_name = flask.request.form.get("origin_name") or None
+    allow_duplicates = "alternate_version" in flask.request.form
+    outdir = shared_code.get_output_directory()
+    outdir.mkdir(parents=True, exist_ok=True)
+    items: list[BulkItem] = []
+    try:
+        for file in flask.request.files.getlist("files"):
+            items.append(
+                BulkItem(file.filename, upload.spool_file(file), file.mimetype)
+            )
+        for archive in flask.request.files.getlist("archive"):
+            for name, spool in iter_archive(
+                upload.spool_file(archive), outdir
+            ):
+                items.append(BulkItem(name, spool, None))
+
+        if upload_jobs.queue is not None:
+            job_id = upload_jobs.queue.enqueue(
+                BULK_JOB,
+                {
+                    "items": [
+                        {
+                            "name": item.name,
+                            "mimetype": item.request_mimetype,
+                            "spool": item.spool.detach(),
+                        }
+                        for item in items
+                    ],
+                    "outdir": str(outdir),
+                    "origin_name": origin_name,
+                    "allow_duplicates": allow_duplicates,
+                },
+            )
+            return upload.make_job_response(job_id, {"files": len(items)})
+
+        process_items(
+            shared_code.db_pool.get_connection(),
+            items,
+            outdir,
+            origin_name,
+            allow_duplicates,
+            lambda stage, progress=None: None,
+        )
+    finally:
+        for item in items:
+            item.spool.close()
+    return flask.Response(
+        json.dumps([item.report() for item in items]),
+        mimetype="application/json",
+    )
@@ -0,0 +1,270 @@
+import itertools
+import logging
+import math
+import threading
+import time
+
+import config
+import shared_code
+from . import queries
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BITS = 16
+# larger distances would check most of the index for every search
+MAX_DISTANCE = 16
+GENERATION = "image_hashes"
+
+
+def _to_int(value_hash) -> tuple[int, int]:
+    """Value hash as (integer, number of bits)."""
+    if isinstance(value_hash, str):
+        value_hash = bytes.fromhex(value_hash)
+    value_hash = bytes(value_hash)
+    return int.from_bytes(value_hash, "big"), len(value_hash) * 8
+
+
+def _neighbours(value: int, bits: int, radius: int):
+    """All values within Hamming distance radius of value."""
+    for distance in range(radius + 1):
+        for positions in itertools.combinations(range(bits), distance):
+            flipped = value
+            for position in positions:
+                flipped ^= 1 << position
+            yield flipped
+
+
+def _chunk_widths(bits: int) -> list[int]:
+    """
+    Widths of bits // CHUNK_BITS chunks covering all bits, as equal as
+    possible: a bit outside of every chunk would break the pigeonhole
+    argument of the search.
+    """
+    number_of_chunks = max(1, bits // CHUNK_BITS)
+    width, wider = divmod(bits, number_of_chunks)
+    return [width + 1] * wider + [width] * (number_of_chunks - wider)
+
+
+def _count_neighbours(bits: int, radius: int) -> int:
+    return sum(math.comb(bits, distance) for distance in range(radius + 1))
+
+
+class HammingIndex:
+    """
+    Near-neighbour index of perceptual image hashes.
+
+    Distance of two images is the Hamming distance of value hashes
+    plus the numbers of differing bits of hue and saturation hashes.
+    Value hashes are split into chunks of about CHUNK_BITS bits, a table
+    per chunk (multi-index hashing): items within distance k have at
+    least one chunk within k // number of chunks of the query, so only
+    those buckets are checked.
+
+    Buckets are replaced on change, not modified, so searches read them
+    without holding the lock.
+    """
+
+    def __init__(self):
+        self._hashes: dict[int, tuple[int, int, int]] = dict()
+        self._tables: list[dict[int, frozenset[int]]] = []
+        # (shift, width) of the chunk of every table
+        self._chunk_layout: list[tuple[int, int]] = []
+        self._bits: int | None = None
+        self._lock = threading.Lock()
+        self.generation: int | None = None
+        self.loaded = threading.Event()
+
+    def _chunks(self, value: int):
+        for index, (shift, width) in enumerate(self._chunk_layout):
+            yield index, (value >> shift) & ((1 << width) - 1)
+
+    def _add(self, content_id: int, value_hash, hue: int, saturation: int):
+        value, bits = _to_int(value_hash)
+        if self._bits is None:
+            self._bits = bits
+            shift = 0
+            for width in _chunk_widths(bits):
+                self._chunk_layout.append((shift, width))
+                self._tables.append(dict())
+                shift += width
+        elif bits != self._bits:
+            logger.warning(
+                "content {}: value hash of {} bits, index has {}".format(
+                    content_id, bits, self._bits
+                )
+            )
+            return
+        self._remove(content_id)
+        self._hashes[content_id] = (value, hue, saturation)
+        for index, chunk in self._chunks(value):
+            table = self._tables[index]
+            table[chunk] = table.get(chunk, frozenset()) | {content_id}
+
+    def _remove(self, content_id: int):
+        old_hash = self._hashes.pop(content_id, None)
+        if old_hash is None:
+            return
+        for index, chunk in self._chunks(old_hash[0]):
+            table = self._tables[index]
+            bucket = table[chunk] - {content_id}
+            if len(bucket):
+                table[chunk] = bucket
+            else:
+                del table[chunk]
+
+    def load(self, connection, generation: int):
+        """
+        Replace the index with hashes stored in medialib database.
+        The new index is built aside, searches keep using the old one
+        until it is complete.
+        """
+        new_index = HammingIndex()
+        for content_id, image_hash in queries.get_all_image_hashes(connection):
+            new_index._add(
+                content_id, image_hash[1], image_hash[2], image_hash[3]
+            )
+        with self._lock:
+            self._hashes = new_index._hashes
+            self._tables = new_index._tables
+            self._chunk_layout = new_index._chunk_layout
+            self._bits = new_index._bits
+            self.generation = generation
+        self.loaded.set()
+        logger.info(
+            "similarity index loaded: {} hashes".format(len(new_index))
+        )
+
+    def update(self, connection, content_ids: set[int], generation: int):
+        """
+        Apply changes of hashes of content_ids made by other processes,
+        stored hashes are read in one query.
+        """
+        image_hashes = queries.get_image_hashes(connection, content_ids)
+        with self._lock:
+            for content_id in content_ids:
+                image_hash = image_hashes.get(content_id)
+                if image_hash is None:
+                    self._remove(content_id)
+                else:
+                    self._add(
+                        content_id, image_hash[1], image_hash[2], image_hash[3]
+                    )
+            self.generation = generation
+        logger.debug(
+            "similarity index: {} changed hashes".format(len(content_ids))
+        )
+
+    def add(self, content_id: int, image_hash):
+        """
+        Add or replace hash of content, image_hash as returned by
+        pyimglib.calc_image_hash(). Call it after the hash is committed,
+        indexes of other processes read it from the database.
+        """
+        with self._lock:
+            if self.loaded.is_set():
+                self._add(
+                    content_id, image_hash[1], image_hash[2], image_hash[3]
+                )
+        shared_code.generations.bump(GENERATION, content_id)
+
+    def remove(self, content_id: int):
+        with self._lock:
+            if self.loaded.is_set():
+                self._remove(content_id)
+        shared_code.generations.bump(GENERATION, content_id)
+
+    def search(
+        self, content_id: int, max_distance: int
+    ) -> list[tuple[int, int]] | None:
+        """
+        (content id, distance) of other contents within max_distance,
+        nearest first. None if the content has no hash in the index.
+        max_distance is limited to MAX_DISTANCE.
+        """
+        max_distance = min(max_distance, MAX_DISTANCE)
+        with self._lock:
+            query = self._hashes.get(content_id)
+            if query is None:
+                return None
+            # a reload replaces these, updates only replace their items
+            hashes = self._hashes
+            tables = self._tables
+            chunk_layout = self._chunk_layout
+        value, hue, saturation = query
+        radius = max_distance // len(tables)
+        candidates = set()
+        for index, (shift, width) in enumerate(chunk_layout):
+            chunk = (value >> shift) & ((1 << width) - 1)
+            table = tables[index]
+            if _count_neighbours(width, radius) < len(table):
+                for neighbour in _neighbours(chunk, width, radius):
+                    bucket = table.get(neighbour)
+                    if bucket is not None:
+                        candidates.update(bucket)
+            else:
+                with self._lock:
+                    buckets = list(table.items())
+                for other_chunk, bucket in buckets:
+                    if (chunk ^ other_chunk).bit_count() <= radius:
+                        candidates.update(bucket)
+        candidates.discard(content_id)
+        found = []
+        for candidate in candidates:
+            other_hash = hashes.get(candidate)
+            if other_hash is None:
+                # removed since its bucket was read
+                continue
+            other_value, other_hue, other_saturation = other_hash
+            distance = (
+                (value ^ other_value).bit_count()
+                + (hue ^ other_hue).bit_count()
+                + (saturation ^ other_saturation).bit_count()
+            )
+            if distance <= max_distance:
+                found.append((candidate, distance))
+        found.sort(key=lambda item: (item[1], item[0]))
+        return found
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+similarity_index = HammingIndex()
+
+
+def start_loading() -> threading.Thread:
+    """
+    Load the index from medialib database in a background thread, then
+    apply hashes changed by other processes. The index is loaded again
+    only if the changes are not known, because there were more than
+    the change log keeps. Failed loads are retried, until the first one
+    succeeds the index is not loaded.
+    """
+
+    def load():
+        while True:
+            try:
+                if similarity_index.generation is None:
+                    changed = None
+                    generation = shared_code.generations.get(GENERATION)
+                else:
+                    generation, changed = shared_code.generations.changes(
+                        GENERATION, similarity_index.generation
+                    )
+                if generation != similarity_index.generation:
+                    with shared_code.db_pool.checkout() as connection:
+                        if changed is None:
+                            similarity_index.load(connection, generation)
+                        else:
+                            similarity_index.update(
+                                connection, changed, generation
+                            )
+            except Exception:
+                logger.exception("similarity index loading failed")
+            time.sleep(config.similarity_index_reload_interval)
+
+    thread = threading.Thread(
+        target=load, name="similarity-index-loader", daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,90 @@
+import dataclasses
+import hashlib
+import math
+
+import numpy
+import PIL.Image
+
+import config
+
+RGBA_BANDS_COUNT = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class ComparisonSource:
+    width: int
+    height: int
+    # digest of full resolution RGBA pixels, equal digests mean equal
+    # images
+    digest: bytes
+    # RGBA pixels reduced by scale in both dimensions
+    pixels: numpy.ndarray
+    scale: int
+
+
+def prepare(img: PIL.Image.Image) -> ComparisonSource:
+    """
+    Decode image once into what comparison needs.
+
+    Full resolution pixels are only kept while the digest and the
+    reduced copy are made, so memory used by a group of candidates is
+    bounded by config.compare_max_pixels per image.
+    """
+    rgba_image = img.convert(mode="RGBA")
+    digest = hashlib.blake2b(rgba_image.tobytes()).digest()
+    scale = max(
+        1,
+        math.ceil(
+            math.sqrt(img.width * img.height / config.compare_max_pixels)
+        ),
+    )
+    if scale > 1:
+        reduced_image = rgba_image.reduce(scale)
+        rgba_image.close()
+        rgba_image = reduced_image
+    pixels = numpy.asarray(rgba_image)
+    rgba_image.close()
+    return ComparisonSource(img.width, img.height, digest, pixels, scale)
+
+
+def pairwise_differences(
+    sources: list[ComparisonSource],
+) -> dict[tuple[int, int], tuple[bool, float]]:
+    """
+    (no difference, difference) of every pair of equal-shaped sources,
+    keyed by (first index, second index), first index < second index.
+
+    Difference is the sum of absolute differences of RGBA values
+    divided by width * height * 255 * 3. For reduced images it is
+    estimated from the reduced pixels.
+    """
+    groups: dict[tuple, list[int]] = dict()
+    for index, source in enumerate(sources):
+        groups.setdefault(
+            (source.width, source.height, source.scale), []
+        ).append(index)
+    results = dict()
+    for (width, height, scale), indexes in groups.items():
+        if len(indexes) < 2:
+            continue
+        max_value = width * height * 255 * (RGBA_BANDS_COUNT - 1)
+        stack = numpy.stack([sources[index].pixels for index in indexes])
+        for position, first_index in enumerate(indexes[:-1]):
+            first = stack[position].astype(numpy.int16)
+            # sums against all following images at once
+            sums = (
+                numpy.abs(stack[position + 1 :] - first)
+                .reshape(len(indexes) - position - 1, -1)
+                .sum(axis=1, dtype=numpy.int64)
+            )
+            for second_index, pixels_sum in zip(
+                indexes[position + 1 :], sums.tolist()
+            ):
+                if sources[first_index].digest == sources[second_index].digest:
+                    results[(first_index, second_index)] = (True, 0.0)
+                else:
+                    results[(first_index, second_index)] = (
+                        False,
+                        pixels_sum * scale * scale / max_value,
+                    )
+    return results
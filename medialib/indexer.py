@@ -0,0 +1,392 @@
+"""
+Bulk registration of files into medialib.
+
+Walks a directory tree and registers every supported file that is not
+in medialib yet. Content types are probed (ffprobe for videos) and
+perceptual hashes of images computed in a process pool, contents are
+registered in one transaction per batch. Files already in medialib are
+skipped by path; files that failed are remembered with their
+modification time in indexer_state_db and skipped until they change,
+so an interrupted run can be simply started again.
+
+Usage (from the application directory):
+    python -m medialib.indexer ROOT_DIR [--dir SUBDIR] [--workers N]
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import logging
+import multiprocessing
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Any, Iterator
+
+import medialib_db
+import pyimglib
+
+import config
+import medialib
+import shared_code
+from filesystem.browse import (
+    audio_file_extensions,
+    image_file_extensions,
+    video_file_extensions,
+)
+from . import queries, search_cache
+from .hash_index import similarity_index
+
+logger = logging.getLogger(__name__)
+
+INDEXED_FILE_EXTENSIONS = (
+    image_file_extensions | video_file_extensions | audio_file_extensions
+) | {".srs"}
+# images are decoded at about this size for hashing
+HASH_SOURCE_SIZE = 1024
+REPORT_INTERVAL = 1000
+
+
+@dataclasses.dataclass
+class IndexedFile:
+    path: pathlib.Path
+    mtime_ns: int
+
+
+@dataclasses.dataclass
+class ProbeResult:
+    content_type: str | None = None
+    image_hash: tuple | None = None
+    error: str | None = None
+
+
+def iter_unknown_files(
+    directory: pathlib.Path,
+    known_paths: set[pathlib.Path],
+    failed_files: dict[pathlib.Path, int],
+    progress: "IndexerProgress",
+) -> Iterator[IndexedFile]:
+    """
+    Yield supported files which are neither in medialib nor failed
+    before with the same modification time. Files referenced by SRS
+    manifests are their representations, not contents of their own.
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        # sorted order makes progress of interrupted runs predictable
+        dirnames[:] = sorted(
+            dirname for dirname in dirnames if dirname[0] != "."
+        )
+        current_dir = pathlib.Path(os.path.abspath(dirpath))
+        excluded_files: set[pathlib.Path] = set()
+        for filename in filenames:
+            if filename.lower().endswith(".srs"):
+                srs_file = current_dir.joinpath(filename)
+                try:
+                    with srs_file.open("r") as f:
+                        content, streams, cl_level = (
+                            pyimglib.ACLMMP.srs_parser.parseJSON(f)
+                        )
+                except Exception:
+                    logger.exception("can't read {}".format(srs_file))
+                    continue
+                excluded_files.update(
+                    pathlib.Path(os.path.abspath(file))
+                    for file in pyimglib.ACLMMP.srs_parser.get_files_list(
+                        srs_file, content, streams
+                    )
+                )
+        for filename in sorted(filenames):
+            file = current_dir.joinpath(filename)
+            if file.suffix.lower() not in INDEXED_FILE_EXTENSIONS:
+                continue
+            if file in excluded_files or file in known_paths:
+                progress.skipped += 1
+                continue
+            try:
+                mtime_ns = file.stat().st_mtime_ns
+            except OSError:
+                # removed or unreadable since the directory was listed
+                logger.exception("can't stat {}".format(file))
+                progress.skipped += 1
+                continue
+            if failed_files.get(file) == mtime_ns:
+                progress.skipped += 1
+                continue
+            yield IndexedFile(file, mtime_ns)
+
+
+def probe_file(path: pathlib.Path) -> ProbeResult:
+    """Runs in the process pool: content type and image hash."""
+    try:
+        result = ProbeResult(medialib.detect_content_type(path))
+        if result.content_type == "image" and path.suffix not in {
+            ".svg",
+            ".srs",
+        }:
+            img = medialib.complex_formats_processing(
+                medialib.open_thumbnail_source(
+                    path, HASH_SOURCE_SIZE, HASH_SOURCE_SIZE
+                )
+            )
+            result.image_hash = pyimglib.calc_image_hash(img)
+            img.close()
+    except Exception as e:
+        return ProbeResult(error=repr(e))
+    return result
+
+
+class FailedFiles:
+    """Files that failed to index, by path, with modification time."""
+
+    def __init__(self, db_file: pathlib.Path | None):
+        self._connection = None
+        if db_file is not None:
+            self._connection = sqlite3.connect(db_file)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS failed_file ("
+                "path TEXT PRIMARY KEY, "
+                "mtime_ns INTEGER NOT NULL, "
+                "error TEXT)"
+            )
+            self._connection.commit()
+
+    def load(self) -> dict[pathlib.Path, int]:
+        if self._connection is None:
+            return dict()
+        return {
+            pathlib.Path(path): mtime_ns
+            for path, mtime_ns in self._connection.execute(
+                "SELECT path, mtime_ns FROM failed_file"
+            )
+        }
+
+    def add(self, file: IndexedFile, error: str):
+        if self._connection is None:
+            return
+        self._connection.execute(
+            "INSERT OR REPLACE INTO failed_file (path, mtime_ns, error) "
+            "VALUES (?, ?, ?)",
+            (str(file.path), file.mtime_ns, error),
+        )
+
+    def commit(self):
+        if self._connection is not None:
+            self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+
+@dataclasses.dataclass
+class IndexerProgress:
+    queued: int = 0
+    skipped: int = 0
+    registered: int = 0
+    failed: int = 0
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    finished: bool = False
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def processed(self) -> int:
+        return self.registered + self.failed
+
+    def as_dict(self) -> dict[str, Any]:
+        elapsed = self.elapsed()
+        return dataclasses.asdict(self) | {
+            "elapsed": elapsed,
+            "files_per_second": self.processed() / elapsed,
+        }
+
+    def report(self) -> str:
+        elapsed = self.elapsed()
+        return (
+            "{} of {} files registered ({} failed), {} skipped, {:.1f} s, "
+            "{:.2f} files/s".format(
+                self.registered,
+                self.queued,
+                self.failed,
+                self.skipped,
+                elapsed,
+                self.processed() / elapsed,
+            )
+        )
+
+
+def register_batch(
+    connection,
+    batch: list[tuple[IndexedFile, ProbeResult]],
+    failed_files: FailedFiles,
+    progress: IndexerProgress,
+):
+    """Register contents of the batch in one transaction."""
+    registered = []
+    try:
+        for file, result in batch:
+            content_id = medialib_db.content_register(
+                content_title=file.path.stem,
+                file_path=file.path.relative_to(shared_code.root_dir),
+                content_type=result.content_type,
+                addition_date=datetime.datetime.fromtimestamp(
+                    file.mtime_ns / 10**9
+                ),
+                content_id=None,
+                origin_name=None,
+                origin_id=None,
+                hidden=False,
+                description=None,
+                connection=connection,
+            )
+            if result.image_hash is not None:
+                medialib_db.set_image_hash(
+                    content_id, result.image_hash, connection
+                )
+                registered.append((content_id, result.image_hash))
+        connection.commit()
+    except Exception as e:
+        logger.exception("indexer batch failed")
+        connection.rollback()
+        for file, result in batch:
+            failed_files.add(file, repr(e))
+        failed_files.commit()
+        progress.failed += len(batch)
+        return
+    progress.registered += len(batch)
+    for content_id, image_hash in registered:
+        similarity_index.add(content_id, image_hash)
+
+
+def run_indexer(
+    directory: pathlib.Path,
+    progress: IndexerProgress,
+    workers: int | None = None,
+    batch_size: int | None = None,
+):
+    if workers is None:
+        workers = config.indexer_processes or os.cpu_count()
+    if batch_size is None:
+        batch_size = config.indexer_batch_size
+    connection = medialib_db.common.make_connection()
+    failed_files = FailedFiles(config.indexer_state_db)
+    known_paths = {
+        medialib_db.config.relative_to.joinpath(file_path).absolute()
+        for file_path in queries.get_all_content_paths(connection)
+    }
+    batch: list[tuple[IndexedFile, ProbeResult]] = []
+    next_report = REPORT_INTERVAL
+
+    def collect(done_futures):
+        nonlocal next_report
+        for future in done_futures:
+            file = futures_files.pop(future)
+            result = future.result()
+            if result.error is not None:
+                logger.warning("{}: {}".format(file.path, result.error))
+                failed_files.add(file, result.error)
+                progress.failed += 1
+            else:
+                batch.append((file, result))
+        if len(batch) >= batch_size:
+            while len(batch) >= batch_size:
+                register_batch(
+                    connection, batch[:batch_size], failed_files, progress
+                )
+                del batch[:batch_size]
+            failed_files.commit()
+            search_cache.invalidate()
+        if progress.processed() >= next_report:
+            logger.info(progress.report())
+            next_report = progress.processed() + REPORT_INTERVAL
+
+    futures_files = {}
+    try:
+        # spawn: forking a threaded web server process is unsafe
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            pending = set()
+            for file in iter_unknown_files(
+                directory, known_paths, failed_files.load(), progress
+            ):
+                future = executor.submit(probe_file, file.path)
+                futures_files[future] = file
+                pending.add(future)
+                progress.queued += 1
+                # bounded queue keeps memory flat for huge trees
+                if len(pending) >= workers * 4:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    collect(done)
+            collect(concurrent.futures.wait(pending).done)
+        if len(batch):
+            register_batch(connection, batch, failed_files, progress)
+            search_cache.invalidate()
+        failed_files.commit()
+    finally:
+        failed_files.close()
+        connection.close()
+    progress.finished = True
+    logger.info(progress.report())
+
+
+class IndexerJob(threading.Thread):
+    """Indexer run of a server process, state acquired by the caller."""
+
+    def __init__(
+        self, directory: pathlib.Path, state: shared_code.job_state.JobState
+    ):
+        super().__init__(daemon=True)
+        self._directory = directory
+        self._state = state
+        self.progress = IndexerProgress()
+
+    def run(self):
+        self._state.run(
+            self.progress,
+            lambda: run_indexer(self._directory, self.progress),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Register files of a directory tree in medialib"
+    )
+    parser.add_argument("root_dir")
+    parser.add_argument(
+        "--dir", help="directory to walk, relative to root_dir", default="."
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s::%(levelname)s::%(name)s::%(message)s",
+    )
+    if config.job_state_dir is not None:
+        state = shared_code.job_state.JobState(config.job_state_dir, "indexer")
+        if not state.acquire():
+            parser.error("indexer is already running")
+    os.chdir(args.root_dir)
+    shared_code.root_dir = pathlib.Path(".").absolute()
+    if config.generation_file is not None:
+        shared_code.generations = shared_code.generation.SharedGenerations(
+            config.generation_file
+        )
+    run_indexer(
+        shared_code.root_dir.joinpath(args.dir),
+        IndexerProgress(),
+        args.workers,
+        args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+from typing import Any, Iterator
+
+import medialib_db
+
+from . import random_order
+
+
+def get_origins_of_contents(
+    connection, content_ids: list[int]
+) -> dict[int, list[medialib_db.origin.Origin]]:
+    """
+    Origins of many contents in one query.
+
+    Same result as get_origins_of_content() for every content id,
+    content without origins maps to an empty list.
+    """
+    origins: dict[int, list[medialib_db.origin.Origin]] = {
+        content_id: [] for content_id in content_ids
+    }
+    if not len(origins):
+        return origins
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT content_id, origin_name, origin_id, alternate "
+        "FROM content_origin WHERE content_id = ANY(%s)",
+        (list(origins.keys()),),
+    )
+    for content_id, origin_name, origin_id, alternate in cursor.fetchall():
+        origins[content_id].append(
+            medialib_db.origin.Origin(
+                origin_name=origin_name,
+                origin_id=origin_id,
+                alternate=alternate,
+            )
+        )
+    cursor.close()
+    return origins
+
+
+MEDIA_COLUMNS = "id, file_path, content_type, title"
+
+
+def get_contents_by_ids(connection, content_ids: list[int]) -> list[tuple]:
+    """
+    Rows as get_all_media() returns them, in order of content_ids,
+    in one query.
+    """
+    if not len(content_ids):
+        return []
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT {} FROM content WHERE id = ANY(%s)".format(MEDIA_COLUMNS),
+        (list(content_ids),),
+    )
+    rows = {row[0]: row for row in cursor.fetchall()}
+    cursor.close()
+    return [
+        rows[content_id] for content_id in content_ids if content_id in rows
+    ]
+
+
+# sort key and descending flag of ORDERING_BY names. NO_SORT is ordered
+# by id: rows without an order can't be paged consistently.
+ORDER_KEYS = {
+    "DATE_DECREASING": ("addition_date", True),
+    "DATE_INCREASING": ("addition_date", False),
+    "NO_SORT": ("id", False),
+    "RANDOM": (random_order.ORDER_KEY_SQL, False),
+}
+
+HIDDEN_FILTER_CONDITIONS = {
+    "FILTER": "hidden = FALSE",
+    "SHOW": "TRUE",
+    "ONLY_HIDDEN": "hidden = TRUE",
+}
+
+
+def find_media(
+    connection,
+    tags_groups: list[dict[str, Any]] | None,
+    order_by,
+    filter_hidden,
+    limit: int,
+    offset: int = 0,
+    seed: str | None = None,
+    after: int | None = None,
+    before: int | None = None,
+    columns: str = MEDIA_COLUMNS,
+) -> list[tuple]:
+    """
+    Page of media found by tags_groups, all media if None, rows as
+    get_media_by_tags() returns them.
+
+    Tags are tag ids, aliases are resolved by the caller; an alias left
+    unresolved names no tag and matches no content. after and before
+    are ids of the content right before or right after the page, the
+    page is sought by the (sort key, id) pair of that content, so it
+    costs the same at any depth. The ordering is one of ORDER_KEYS,
+    ties are ordered by id. RANDOM ordering is the order of the hash of
+    seed and content id, the same for every page of the seed.
+    """
+    key, descending = ORDER_KEYS[order_by.name]
+    # parameters of the sort key
+    key_parameters = [seed] if order_by.name == "RANDOM" else []
+    conditions = [HIDDEN_FILTER_CONDITIONS[filter_hidden.name]]
+    parameters: list[Any] = []
+    for tags_group in tags_groups or ():
+        conditions.append(
+            "id {} (SELECT content_id FROM content_tags_list "
+            "WHERE tag_id = ANY(%s))".format(
+                "NOT IN" if tags_group["not"] else "IN"
+            )
+        )
+        parameters.append(
+            [tag for tag in tags_group["tags"] if isinstance(tag, int)]
+        )
+    backwards = after is None and before is not None
+    anchor = after if after is not None else before
+    # the page runs from the anchor in the direction of the ordering, or
+    # against it for a page before the anchor
+    descending_scan = descending != backwards
+    if anchor is not None:
+        conditions.append(
+            "({key}, id) {operator} "
+            "((SELECT {key} FROM content WHERE id = %s), %s)".format(
+                key=key, operator="<" if descending_scan else ">"
+            )
+        )
+        parameters.extend(key_parameters * 2 + [anchor, anchor])
+    direction = "DESC" if descending_scan else "ASC"
+    parameters.extend(key_parameters + [limit, offset])
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT {columns} FROM content WHERE {conditions} "
+        "ORDER BY {key} {direction}, id {direction} "
+        "LIMIT %s OFFSET %s".format(
+            columns=columns,
+            conditions=" AND ".join(conditions),
+            key=key,
+            direction=direction,
+        ),
+        parameters,
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    if backwards:
+        rows.reverse()
+    return rows
+
+
+def _iter_all_media(connection) -> list[tuple]:
+    """Rows of all contents, hidden ones too, in one query."""
+    filter_hidden = medialib_db.files_by_tag_search.HIDDEN_FILTERING.SHOW
+    number_of_items = medialib_db.files_by_tag_search.get_total_count(
+        connection, filter_hidden=filter_hidden
+    )
+    return medialib_db.files_by_tag_search.get_all_media(
+        connection,
+        limit=number_of_items,
+        offset=0,
+        order_by=medialib_db.files_by_tag_search.ORDERING_BY.NO_SORT,
+        filter_hidden=filter_hidden,
+    )
+
+
+# stored hash columns in the order of pyimglib.calc_image_hash() values
+IMAGE_HASH_COLUMNS = "aspect_ratio, value_hash, hue_hash, saturation_hash"
+
+
+def get_all_image_hashes(connection) -> Iterator[tuple[int, tuple]]:
+    """
+    (content id, image hash) of every content with a stored hash, the
+    hash in the form pyimglib.calc_image_hash() returns. One query on
+    the imagehash table of medialib_db.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT content_id, {} FROM imagehash".format(IMAGE_HASH_COLUMNS)
+    )
+    for row in cursor:
+        yield row[0], row[1:]
+    cursor.close()
+
+
+def get_image_hashes(connection, content_ids) -> dict[int, tuple]:
+    """Stored hashes of content_ids, in one query."""
+    if not len(content_ids):
+        return dict()
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT content_id, {} FROM imagehash "
+        "WHERE content_id = ANY(%s)".format(IMAGE_HASH_COLUMNS),
+        (list(content_ids),),
+    )
+    image_hashes = {row[0]: row[1:] for row in cursor.fetchall()}
+    cursor.close()
+    return image_hashes
+
+
+def find_contents_by_hashes(
+    connection, image_hashes
+) -> dict[tuple[bytes, int, int], list[int]]:
+    """
+    Ids of contents with the same hash as each of image_hashes, as
+    find_content_by_hash() finds them for one hash, in one query.
+    Keyed by (value hash, hue hash, saturation hash) of image_hashes.
+    """
+    found: dict[tuple[bytes, int, int], list[int]] = {
+        (bytes(image_hash[1]), image_hash[2], image_hash[3]): []
+        for image_hash in image_hashes
+    }
+    if not len(found):
+        return found
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT content_id, value_hash, hue_hash, saturation_hash "
+        "FROM imagehash WHERE value_hash = ANY(%s) ORDER BY content_id",
+        (list({key[0] for key in found}),),
+    )
+    for content_id, value_hash, hue_hash, saturation_hash in cursor:
+        key = (bytes(value_hash), hue_hash, saturation_hash)
+        if key in found:
+            found[key].append(content_id)
+    cursor.close()
+    return found
+
+
+def get_all_content_paths(connection) -> list[str]:
+    """File paths of all contents, relative to medialib_db relative_to."""
+    return [
+        file_str
+        for content_id, file_str, content_type, title in _iter_all_media(
+            connection
+        )
+    ]
@@ -0,0 +1,10 @@
+import secrets
+
+# sort key of a content in random ordering of a seed, the md5 hex digest
+# of "<seed>:<content id>"; computed by the database, so results of any
+# size are ordered and paged the same way
+ORDER_KEY_SQL = "md5(%s || ':' || id::text)"
+
+
+def new_seed() -> str:
+    return secrets.token_hex(4)
@@ -0,0 +1,311 @@
+import array
+import collections
+import logging
+import math
+import threading
+import time
+from typing import Any
+
+import medialib_db
+
+import config
+import shared_code
+from . import queries
+from .tag_cache import tag_dictionary
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_tags_groups(tags_groups: list[dict[str, Any]] | None):
+    """
+    Hashable form of tags groups which does not depend on order of
+    groups and of tags inside a group.
+    """
+    if tags_groups is None:
+        return None
+    return tuple(
+        sorted(
+            (
+                (
+                    tags_group["not"],
+                    tuple(
+                        sorted(
+                            set(tags_group["tags"]),
+                            key=lambda tag: (isinstance(tag, str), str(tag)),
+                        )
+                    ),
+                )
+                for tags_group in tags_groups
+            ),
+            key=repr,
+        )
+    )
+
+
+GENERATION = "content"
+
+
+class ItemCountCache:
+    """
+    LRU cache of numbers of items found by medialib queries.
+
+    Keyed by normalized tags groups (None for all media) and hidden
+    filtering. Counts expire after ttl seconds and when the shared
+    "content" generation changes, which invalidate() does on content
+    and tag writes of any server process.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_items_count(
+        self,
+        db_connection,
+        hidden_filtering,
+        tags_groups: list | list[dict[str, Any]] = None,
+    ) -> int:
+        key = (normalize_tags_groups(tags_groups), hidden_filtering)
+        # counts queried before a write are stored with the old
+        # generation, so they are never served after it
+        generation = shared_code.generations.get(GENERATION)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[1] == generation
+                and time.monotonic() - entry[0] <= self.ttl
+            ):
+                self._entries.move_to_end(key)
+                return entry[2]
+        filter_hidden = medialib_db.files_by_tag_search.HIDDEN_FILTERING(
+            hidden_filtering
+        )
+        if tags_groups is None:
+            number_of_items = medialib_db.files_by_tag_search.get_total_count(
+                db_connection, filter_hidden=filter_hidden
+            )
+        else:
+            number_of_items = (
+                medialib_db.files_by_tag_search.count_media_by_tags(
+                    db_connection, *tags_groups, filter_hidden=filter_hidden
+                )
+            )
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic(),
+                generation,
+                number_of_items,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return number_of_items
+
+    def count_pages(
+        self,
+        db_connection,
+        items_per_page,
+        hidden_filtering,
+        tags_groups: list | list[dict[str, Any]] = None,
+    ) -> int:
+        items_count = self.get_items_count(
+            db_connection, hidden_filtering, tags_groups
+        )
+        logger.debug("items count: {}".format(items_count))
+        return math.ceil(items_count / items_per_page)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TagSearchCache:
+    """
+    LRU cache of content id lists found by tag search queries and of
+    all media.
+
+    Keyed by the query with aliases resolved to tag ids, ordering, seed
+    of random ordering and hidden filtering. Ids of the whole result
+    are fetched once for a page deeper than direct_offset reached
+    without a cursor, then a page costs one query of its own rows.
+    Bounded by number of entries and by total bytes of stored ids;
+    results larger than max_result_ids are not cached and paged by the
+    database. Entries expire after ttl seconds and when the shared
+    "content" generation changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_bytes: int,
+        max_result_ids: int,
+        ttl: float,
+        direct_offset: int,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_result_ids = max_result_ids
+        self.ttl = ttl
+        self.direct_offset = direct_offset
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _resolve_aliases(connection, tags_groups: list[dict[str, Any]] | None):
+        if tags_groups is None:
+            return None
+        resolved_groups = []
+        for tags_group in tags_groups:
+            tags = []
+            for tag in tags_group["tags"]:
+                if isinstance(tag, str):
+                    tag_id = tag_dictionary.get_tag_id_by_alias(
+                        connection, tag
+                    )
+                    if tag_id is not None:
+                        tag = tag_id
+                tags.append(tag)
+            resolved_groups.append(tags_group | {"tags": tags})
+        return resolved_groups
+
+    def _pop(self, key):
+        _, _, old_ids = self._entries.pop(key)
+        self._bytes -= old_ids.itemsize * len(old_ids)
+
+    def _get(self, key, generation: int) -> array.array | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if (
+                entry[1] != generation
+                or time.monotonic() - entry[0] > self.ttl
+            ):
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def _put(self, key, generation: int, ids: array.array):
+        size = ids.itemsize * len(ids)
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.monotonic(), generation, ids)
+            self._bytes += size
+            while (
+                len(self._entries) > self.max_entries
+                or self._bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def get_page(
+        self,
+        connection,
+        tags_groups: list[dict[str, Any]] | None,
+        order_by,
+        filter_hidden,
+        seed: str | None,
+        limit: int,
+        offset: int,
+        items_count: int,
+        after: int | None = None,
+        before: int | None = None,
+    ) -> tuple[list[tuple], int]:
+        """
+        Rows of the page as get_media_by_tags() returns them and the
+        number of found items. tags_groups None is all media.
+
+        after and before are ids of the content next to the page, see
+        queries.find_media(); pages reached by one are sought by the
+        database at any depth. Without one, pages within direct_offset
+        items are queried directly. Deeper pages are sliced from the
+        cached ids of the whole result, results larger than
+        max_result_ids are paged by offset.
+
+        items_count is the number of items found by the query, see
+        ItemCountCache. For a cached result the returned number of items
+        is its length, so page count and pages always match.
+        Random ordering is ordered by the database by a hash of the seed,
+        so pages of the same seed are consistent at any result size.
+        Every seed is a cache entry of its own, filled only by deep pages
+        reached without a cursor.
+        """
+        random_ordering = (
+            order_by is medialib_db.files_by_tag_search.ORDERING_BY.RANDOM
+        )
+        tags_groups = self._resolve_aliases(connection, tags_groups)
+
+        def query(**kwargs) -> list[tuple]:
+            return queries.find_media(
+                connection,
+                tags_groups,
+                order_by,
+                filter_hidden,
+                seed=seed,
+                **kwargs,
+            )
+
+        if after is not None or before is not None:
+            rows = query(limit=limit, after=after, before=before)
+            # empty if the content of the cursor is gone
+            if len(rows):
+                return rows, items_count
+        if offset < self.direct_offset or items_count > self.max_result_ids:
+            return query(limit=limit, offset=offset), items_count
+        key = (
+            normalize_tags_groups(tags_groups),
+            order_by,
+            seed if random_ordering else None,
+            filter_hidden,
+        )
+        generation = shared_code.generations.get(GENERATION)
+        ids = self._get(key, generation)
+        if ids is None:
+            # the limit does not depend on the count, which may be older
+            # than the result
+            rows = query(limit=self.max_result_ids + 1, columns="id")
+            if len(rows) > self.max_result_ids:
+                return query(limit=limit, offset=offset), items_count
+            ids = array.array("q", (row[0] for row in rows))
+            self._put(key, generation, ids)
+        return (
+            queries.get_contents_by_ids(
+                connection, ids[offset : offset + limit].tolist()
+            ),
+            len(ids),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+item_count_cache = ItemCountCache(
+    config.item_count_cache_entries, config.item_count_cache_ttl
+)
+
+tag_search_cache = TagSearchCache(
+    config.tag_search_cache_entries,
+    config.tag_search_cache_bytes,
+    config.tag_search_cache_max_result_ids,
+    config.tag_search_cache_ttl,
+    config.tag_search_direct_offset,
+)
+
+
+def invalidate():
+    """
+    Drop cached search data of all server processes, call after content
+    or tags are written.
+    """
+    shared_code.generations.bump(GENERATION)
+    item_count_cache.clear()
+    tag_search_cache.clear()
@@ -1,191 +1,121 @@
 import gzip
+import math
+import zlib
+
+import numpy
 from PIL import Image
 
+# stealth pnginfo format:
+# https://github.com/catboxanon/comfyui_stealth_pnginfo/blob/726de7e51d7b950a3342b3a20ab231ed317f71a7/scripts/stealth_pnginfo.py#L70
+# Least significant bits of pixels are read column by column, either
+# of alpha channel (one bit per pixel) or of RGB channels (three bits
+# per pixel). The bit stream is a 15 byte signature, 32 bit big-endian
+# length of payload in bits and the payload, gzip compressed in "comp"
+# variants.
+ALPHA_SIGNATURES = {b"stealth_pnginfo": False, b"stealth_pngcomp": True}
+RGB_SIGNATURES = {b"stealth_rgbinfo": False, b"stealth_rgbcomp": True}
+SIGNATURE_BITS = len(b"stealth_pnginfo") * 8
+LENGTH_BITS = 32
+HEADER_BITS = SIGNATURE_BITS + LENGTH_BITS
 
-def read_info_from_image_stealth(image: Image.Image) -> str | None:
-    # source code taken here: https://github.com/catboxanon/comfyui_stealth_pnginfo/blob/726de7e51d7b950a3342b3a20ab231ed317f71a7/scripts/stealth_pnginfo.py#L70
-    # possible_sigs = {'stealth_pnginfo', 'stealth_pngcomp', 'stealth_rgbinfo', 'stealth_rgbcomp'}
 
-    # trying to read stealth pnginfo
+def _read_lsb(image: Image.Image, pixel_count: int) -> numpy.ndarray:
+    """
+    Least significant bits of the first pixel_count pixels in column
+    order, shape (pixels, channels). Only the needed columns are
+    converted to an array.
+    """
     width, height = image.size
-    if image.mode in {"P", "L", "LA"}:
-        return None
-    pixels = image.load()
+    columns = min(width, math.ceil(pixel_count / height))
+    pixels = numpy.asarray(image.crop((0, 0, columns, height)))
+    pixels = pixels.transpose(1, 0, 2).reshape(-1, pixels.shape[2])
+    return pixels[:pixel_count] & 1
+
+
+def _bits_to_bytes(bits: numpy.ndarray) -> bytearray:
+    # trailing bits which do not fill a byte make a byte of their own
+    # value, as the reference implementation does
+    full_length = len(bits) - len(bits) % 8
+    data = bytearray(numpy.packbits(bits[:full_length]).tobytes())
+    if full_length < len(bits):
+        data.append(int("".join(map(str, bits[full_length:])), 2))
+    return data
+
 
-    has_alpha = True if image.mode == "RGBA" else False
-    mode = None
-    compressed = False
-    binary_data = ""
-    buffer_a = ""
-    buffer_rgb = ""
-    index_a = 0
-    index_rgb = 0
-    sig_confirmed = False
-    confirming_signature = True
-    reading_param_len = False
-    reading_param = False
-    read_end = False
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
-            else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if mode is None and y > 120:
-                    # Force stop to prevent reading the entire image
-                    read_end = True
-                    return None
-                if index_a == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_a[i : i + 8], 2)
-                        for i in range(0, len(buffer_a), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_pnginfo", "stealth_pngcomp"}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = "alpha"
-                        if decoded_sig == "stealth_pngcomp":
-                            compressed = True
-                        buffer_a = ""
-                        index_a = 0
-                    else:
-                        read_end = True
-                        break
-                elif index_rgb == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_rgb[i : i + 8], 2)
-                        for i in range(0, len(buffer_rgb), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_rgbinfo", "stealth_rgbcomp"}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = "rgb"
-                        if decoded_sig == "stealth_rgbcomp":
-                            compressed = True
-                        buffer_rgb = ""
-                        index_rgb = 0
-            elif reading_param_len:
-                if mode == "alpha":
-                    if index_a == 32:
-                        param_len = int(buffer_a, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_a = ""
-                        index_a = 0
-                else:
-                    if index_rgb == 33:
-                        pop = buffer_rgb[-1]
-                        buffer_rgb = buffer_rgb[:-1]
-                        param_len = int(buffer_rgb, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_rgb = pop
-                        index_rgb = 1
-            elif reading_param:
-                if mode == "alpha":
-                    if index_a == param_len:
-                        binary_data = buffer_a
-                        read_end = True
-                        break
-                else:
-                    if index_rgb >= param_len:
-                        diff = param_len - index_rgb
-                        if diff < 0:
-                            buffer_rgb = buffer_rgb[:diff]
-                        binary_data = buffer_rgb
-                        read_end = True
-                        break
-            else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
-            break
-    if sig_confirmed and binary_data != "":
-        # Convert binary string to UTF-8 encoded text
-        byte_data = bytearray(
-            int(binary_data[i : i + 8], 2)
-            for i in range(0, len(binary_data), 8)
+def _find_signature(image: Image.Image):
+    """
+    Returns (bits per pixel, compressed) of found signature or None.
+
+    RGB signature is checked first, it ends at the 40th pixel while
+    alpha signature ends at the 120th.
+    """
+    width, height = image.size
+    pixel_count = width * height
+    has_alpha = image.mode == "RGBA"
+    lsb = _read_lsb(
+        image, SIGNATURE_BITS if has_alpha else SIGNATURE_BITS // 3
+    )
+    if pixel_count >= SIGNATURE_BITS // 3:
+        rgb_signature = bytes(
+            _bits_to_bytes(lsb[: SIGNATURE_BITS // 3, :3].reshape(-1))
         )
-        try:
-            if compressed:
-                decoded_data = gzip.decompress(bytes(byte_data)).decode(
-                    "utf-8"
-                )
-            else:
-                decoded_data = byte_data.decode("utf-8", errors="ignore")
-            geninfo = decoded_data
-        except:
-            pass
-        return geninfo
+        if rgb_signature in RGB_SIGNATURES:
+            return 3, RGB_SIGNATURES[rgb_signature]
+    if has_alpha and pixel_count >= SIGNATURE_BITS:
+        alpha_signature = bytes(_bits_to_bytes(lsb[:SIGNATURE_BITS, 3]))
+        if alpha_signature in ALPHA_SIGNATURES:
+            return 1, ALPHA_SIGNATURES[alpha_signature]
+    return None
+
+
+def _read_stream(
+    image: Image.Image, bits_per_pixel: int, start: int, length: int
+) -> numpy.ndarray:
+    lsb = _read_lsb(image, math.ceil((start + length) / bits_per_pixel))
+    if bits_per_pixel == 1:
+        stream = lsb[:, 3]
     else:
+        stream = lsb[:, :3].reshape(-1)
+    return stream[start : start + length]
+
+
+def read_info_from_image_stealth(image: Image.Image) -> str | None:
+    if image.mode not in {"RGB", "RGBA"}:
+        return None
+    signature = _find_signature(image)
+    if signature is None:
+        return None
+    bits_per_pixel, compressed = signature
+    width, height = image.size
+    stream_length = width * height * bits_per_pixel
+    if stream_length < HEADER_BITS:
+        return None
+    param_len = int.from_bytes(
+        _bits_to_bytes(
+            _read_stream(image, bits_per_pixel, SIGNATURE_BITS, LENGTH_BITS)
+        ),
+        "big",
+    )
+    if param_len == 0 or HEADER_BITS + param_len > stream_length:
         return None
+    byte_data = _bits_to_bytes(
+        _read_stream(image, bits_per_pixel, HEADER_BITS, param_len)
+    )
+    if compressed:
+        try:
+            return gzip.decompress(bytes(byte_data)).decode("utf-8")
+        except (OSError, EOFError, zlib.error, UnicodeDecodeError):
+            return None
+    return byte_data.decode("utf-8", errors="ignore")
 
 
 def stealth_png_check(image: Image.Image) -> bool:
+    # Only the RGB signature is recognized: the check stops at the 40th
+    # pixel, before an alpha signature ends.
+    if image.mode not in {"RGB", "RGBA"}:
+        return False
     width, height = image.size
-    if image.mode in {"P", "L", "LA"}:
+    if width * height < SIGNATURE_BITS // 3:
         return False
-    pixels = image.load()
-
-    has_alpha = True if image.mode == "RGBA" else False
-    mode = None
-    buffer_a = ""
-    buffer_rgb = ""
-    index_a = 0
-    index_rgb = 0
-    confirming_signature = True
-    read_end = False
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
-            else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if mode is None and y > 120:
-                    # Force stop to prevent reading the entire image
-                    read_end = True
-                    return False
-                if index_a == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_a[i : i + 8], 2)
-                        for i in range(0, len(buffer_a), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_pnginfo", "stealth_pngcomp"}:
-                        confirming_signature = False
-                        return True
-                    else:
-                        return False
-                elif index_rgb == len("stealth_pnginfo") * 8:
-                    decoded_sig = bytearray(
-                        int(buffer_rgb[i : i + 8], 2)
-                        for i in range(0, len(buffer_rgb), 8)
-                    ).decode("utf-8", errors="ignore")
-                    if decoded_sig in {"stealth_rgbinfo", "stealth_rgbcomp"}:
-                        confirming_signature = False
-                        return True
-                    else:
-                        return False
-            else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
-            break
-    return False
+    lsb = _read_lsb(image, SIGNATURE_BITS // 3)
+    return bytes(_bits_to_bytes(lsb[:, :3].reshape(-1))) in RGB_SIGNATURES
@@ -0,0 +1,133 @@
+import dataclasses
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+import medialib_db
+
+import config
+import shared_code
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class TagInfo:
+    id: int
+    name: str
+    category: str
+    parent_id: int | None
+    aliases: tuple[str, ...]
+
+
+GENERATION = "tags"
+
+
+class TagDictionary:
+    """
+    Process-wide memo of tag lookups: id, name, category, parent,
+    aliases.
+
+    Every lookup is answered by the same medialib_db function as
+    before, once, then from memory. Only found tags are remembered, so
+    tags created meanwhile resolve at once. Everything is dropped after
+    ttl seconds and when the shared "tags" generation changes, which
+    invalidate() does on tag writes of any server process.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._tags: dict[int, TagInfo] = dict()
+        self._ids_by_alias: dict[str, int] = dict()
+        self._names_by_id: dict[int, str] = dict()
+        self._names_by_alias: dict[str, str] = dict()
+        self._loaded_at = time.monotonic()
+        self._generation = shared_code.generations.get(GENERATION)
+        self._lock = threading.Lock()
+
+    def _clear(self):
+        self._tags.clear()
+        self._ids_by_alias.clear()
+        self._names_by_id.clear()
+        self._names_by_alias.clear()
+
+    def _memoized(self, memo: dict, key, lookup: Callable[[], Any]):
+        generation = shared_code.generations.get(GENERATION)
+        with self._lock:
+            if (
+                generation != self._generation
+                or time.monotonic() - self._loaded_at > self.ttl
+            ):
+                self._clear()
+                self._generation = generation
+                self._loaded_at = time.monotonic()
+            elif key in memo:
+                return memo[key]
+        value = lookup()
+        if value is not None:
+            with self._lock:
+                # a write during the lookup makes the value stale
+                if generation == self._generation:
+                    memo[key] = value
+        return value
+
+    def invalidate(self):
+        """Drop tag lookups of all server processes."""
+        shared_code.generations.bump(GENERATION)
+        with self._lock:
+            self._clear()
+
+    def get_tag(self, connection, tag_id: int) -> TagInfo | None:
+        def lookup() -> TagInfo | None:
+            raw_tag_info = medialib_db.tags_indexer.get_tag_info_by_tag_id(
+                tag_id, connection
+            )
+            if raw_tag_info is None:
+                return None
+            return TagInfo(
+                *raw_tag_info[:4],
+                tuple(
+                    medialib_db.tags_indexer.get_tag_aliases(
+                        tag_id, connection
+                    )
+                ),
+            )
+
+        return self._memoized(self._tags, tag_id, lookup)
+
+    def get_tag_id_by_alias(self, connection, alias: str) -> int | None:
+        return self._memoized(
+            self._ids_by_alias,
+            alias,
+            lambda: medialib_db.tags_indexer.get_tag_id_by_alias(
+                alias, connection
+            ),
+        )
+
+    def get_tag_name_by_id(self, connection, tag_id: int) -> str | None:
+        return self._memoized(
+            self._names_by_id,
+            tag_id,
+            lambda: medialib_db.get_tag_name_by_id(connection, tag_id),
+        )
+
+    def get_tag_name_by_alias(self, connection, alias: str) -> str | None:
+        return self._memoized(
+            self._names_by_alias,
+            alias,
+            lambda: medialib_db.get_tag_name_by_alias(connection, alias),
+        )
+
+    def get_parents(self, connection, tag_id: int) -> list[TagInfo]:
+        """Parent chain of the tag, nearest parent first."""
+        parents = []
+        tag = self.get_tag(connection, tag_id)
+        while tag is not None and tag.parent_id is not None:
+            tag = self.get_tag(connection, tag.parent_id)
+            if tag is not None:
+                parents.append(tag)
+        return parents
+
+
+tag_dictionary = TagDictionary(config.tag_cache_ttl)
@@ -3,6 +3,8 @@ import flask
 import medialib_db
 import dataclasses
 import shared_code
+from . import search_cache
+from .tag_cache import tag_dictionary
 
 # this code is ChatGPT assisted
 
@@ -15,9 +17,9 @@ def edit_tag():
     tag_name = request.form['tagName']
     tag_category = request.form['tagType']
 
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.tags_indexer.set_tag_properties(tag_id, tag_name, tag_category, connection)
-    connection.close()
+    tag_dictionary.invalidate()
 
     # Redirect to the show_tag route with the tag_id
     return redirect(url_for('medialib.tag_manager.show_tag_properties', tag_id=tag_id))
@@ -28,9 +30,9 @@ def add_alias():
     tag_id = int(request.form['tag_id'])
     alias_name = request.form['alias_name']
 
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.tags_indexer.add_alias(tag_id, alias_name, connection)
-    connection.close()
+    tag_dictionary.invalidate()
 
     return redirect(url_for('medialib.tag_manager.show_tag_properties', tag_id=tag_id))
 
@@ -44,9 +46,9 @@ def delete_alias():
     if tag_id is None or alias_name is None:
         abort(404)
 
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.tags_indexer.delete_alias(tag_id, alias_name, connection)
-    connection.close()
+    tag_dictionary.invalidate()
 
     return redirect(url_for('medialib.tag_manager.show_tag_properties', tag_id=tag_id))
 
@@ -55,9 +57,10 @@ def delete_alias():
 def merge_tags():
     first_tag_id = int(request.form['first_tag_id'])
     second_tag_id = int(request.form['second_tag_id'])
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.tags_indexer.merge_tags(first_tag_id, second_tag_id, connection)
-    connection.close()
+    tag_dictionary.invalidate()
+    search_cache.invalidate()
 
     return redirect(url_for('medialib.tag_manager.show_tag_properties', tag_id=second_tag_id))
 
@@ -77,28 +80,24 @@ class TagProperties:
 @tag_manager_blueprint.route('/show_tag/<int:tag_id>', methods=['GET'])
 @shared_code.login_validation
 def show_tag_properties(tag_id: int):
-    connection = medialib_db.common.make_connection()
-    raw_tag_info = medialib_db.tags_indexer.get_tag_info_by_tag_id(tag_id, connection)
-    aliases_list = medialib_db.tags_indexer.get_tag_aliases(tag_id, connection)
-    parents_list = []
-    parent_id = raw_tag_info[3]
-    while parent_id is not None:
-        _raw_tag_info = medialib_db.tags_indexer.get_tag_info_by_tag_id(parent_id, connection)
-        parents_list.append(
-            SimpleTagProperties(_raw_tag_info[0], _raw_tag_info[1])
-        )
-        parent_id = _raw_tag_info[3]
+    connection = shared_code.db_pool.get_connection()
+    tag = tag_dictionary.get_tag(connection, tag_id)
+    if tag is None:
+        abort(404)
+    parents_list = [
+        SimpleTagProperties(parent.id, parent.name)
+        for parent in tag_dictionary.get_parents(connection, tag_id)
+    ]
     tag_properties = TagProperties(
-        raw_tag_info[0], raw_tag_info[1], raw_tag_info[2], aliases_list, parents_list
+        tag.id, tag.name, tag.category, list(tag.aliases), parents_list
     )
-    connection.close()
     return render_template("tag_properties.html", tag=tag_properties)
 
 @tag_manager_blueprint.route('/delete_tag/content<int:content_id>tag<int:tag_id>', methods=['GET'])
 @shared_code.login_validation
 def delete_tag(content_id: int, tag_id: int):
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     medialib_db.delete_tag(content_id, tag_id, connection)
     connection.commit()
-    connection.close()
+    search_cache.invalidate()
     return flask.redirect(f"/content_metadata/mlid{content_id}")
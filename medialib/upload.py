@@ -1,15 +1,17 @@
+import hashlib
 import json
 import logging
 import lzma
+import os
 import subprocess
 import tempfile
+import time
 import typing
 import flask
 import medialib_db.config
 import shared_code
 import pyimglib
 import magic
-import io
 import PIL.Image
 import PIL.ExifTags
 import medialib_db
@@ -30,7 +32,8 @@ from pyimglib.decoders.srs import decode as decode_srs
 from werkzeug.datastructures import FileStorage
 
 from shared_code import EXTENSIONS_BY_MIME
-from . import stealth_png
+from . import search_cache, stealth_png, upload_jobs
+from .hash_index import similarity_index
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +41,10 @@ simple_id_pattern = re.compile("[a-z]{2}\d+")
 
 CIVIT_AI_ORIGIN = "civit ai"
 MAX_TITLE_LENGTH = 63
-MAX_SAMPLE_LENGTH = 200 * 1024 * 1024  # 200 MiB
+# libmagic does not look further by default
+MAGIC_HEADER_LENGTH = 1024 * 1024
+SPOOL_BLOCK_SIZE = 1024 * 1024
+JOB_EVENTS_POLL_INTERVAL = 0.5
 MOV_MIMETYPE = "video/quicktime"
 MPEG4V_MIMETYPE = "video/mp4"
 JPEG_MIMETYPE = "image/jpeg"
@@ -50,6 +56,18 @@ UNDEFINED_MIMETYPE = "application/octet-stream"
 PNG_HEADER_SEQUENCE = b"\x89PNG\x0d\x0a\x1a\x0a"
 
 
+def _read_umask() -> int:
+    # umask can only be read by setting it, do it once at import time
+    # before request threads create files
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# permissions of files created by open(), which tempfile does not use
+STORED_FILE_MODE = 0o666 & ~_read_umask()
+
+
 def generate_unsupported_type_response():
     supported_formats = []
     for mime in EXTENSIONS_BY_MIME:
@@ -60,15 +78,126 @@ def generate_unsupported_type_response():
     )
 
 
-def detect_file_type(file_buffer: io.BytesIO, request_header_mimetype):
-    mime = magic.from_buffer(file_buffer.getvalue(), mime=True)
+class SpooledUploadFile:
+    """
+    Uploaded file written to a temporary file as the request body is
+    parsed.
+
+    The temporary file is created in the directory where the content
+    will be stored, so move_to() is a rename. The digest and the header
+    bytes for MIME sniffing are collected while the file is written.
+    The temporary file is removed on close() unless it was moved or
+    detached for an upload job.
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(
+            mode="w+b", dir=directory, prefix=".upload-", delete=False
+        )
+        self.path = pathlib.Path(self._file.name)
+        self.size = 0
+        self.header = b""
+        self._hash = hashlib.sha3_256()
+        self._hexdigest: str | None = None
+        self._moved = False
+
+    @classmethod
+    def reattach(cls, detached: dict[str, typing.Any]) -> "SpooledUploadFile":
+        """
+        Spooled file kept by detach(), opened by the upload job. Header
+        bytes are not read again.
+        """
+        spool = cls.__new__(cls)
+        spool.path = pathlib.Path(detached["path"])
+        spool._file = spool.path.open("r+b")
+        spool.size = detached["size"]
+        spool.header = b""
+        spool._hash = None
+        spool._hexdigest = detached["digest"]
+        spool._moved = False
+        return spool
+
+    def write(self, data: bytes) -> int:
+        if len(self.header) < MAGIC_HEADER_LENGTH:
+            self.header += data[: MAGIC_HEADER_LENGTH - len(self.header)]
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        if self._hexdigest is not None:
+            return self._hexdigest
+        return self._hash.hexdigest()
+
+    def detach(self) -> dict[str, typing.Any]:
+        """Keep the file after close() for reattach() in an upload job."""
+        self._file.flush()
+        self._moved = True
+        return {
+            "path": str(self.path),
+            "size": self.size,
+            "digest": self.hexdigest(),
+        }
+
+    def move_to(self, file_path: pathlib.Path):
+        self._file.flush()
+        # temporary files are private to the owner
+        os.chmod(self.path, STORED_FILE_MODE)
+        os.rename(self.path, file_path)
+        self.path = file_path
+        self._moved = True
+
+    def close(self):
+        self._file.close()
+        if not self._moved:
+            self.path.unlink(missing_ok=True)
+
+    def __getattr__(self, name):
+        # read(), seek() and the rest of file interface
+        return getattr(self._file, name)
+
+
+def spool_file(file: FileStorage) -> SpooledUploadFile:
+    """
+    Spooled upload of the file; request files of endpoints in
+    SPOOLED_ENDPOINTS are spooled while the request is parsed.
+    """
+    if isinstance(file.stream, SpooledUploadFile):
+        return file.stream
+    spool = SpooledUploadFile(shared_code.get_output_directory())
+    file.stream.seek(0)
+    buffer = file.stream.read(SPOOL_BLOCK_SIZE)
+    while len(buffer):
+        spool.write(buffer)
+        buffer = file.stream.read(SPOOL_BLOCK_SIZE)
+    file.stream.close()
+    file.stream = spool
+    return spool
+
+
+class UploadRequest(flask.Request):
+    def _get_file_stream(
+        self,
+        total_content_length,
+        content_type,
+        filename=None,
+        content_length=None,
+    ):
+        if filename is not None and self.endpoint in SPOOLED_ENDPOINTS:
+            return SpooledUploadFile(shared_code.get_output_directory())
+        return super()._get_file_stream(
+            total_content_length, content_type, filename, content_length
+        )
+
+
+def detect_file_type(header: bytes, request_header_mimetype):
+    mime = magic.from_buffer(header, mime=True)
     if mime == MOV_MIMETYPE and request_header_mimetype == MPEG4V_MIMETYPE:
         mime = MPEG4V_MIMETYPE
     if mime == UNDEFINED_MIMETYPE:
-        file_buffer.seek(0)
         # check PNG header
-        header = file_buffer.read(8)
-        if header == PNG_HEADER_SEQUENCE:
+        if header[: len(PNG_HEADER_SEQUENCE)] == PNG_HEADER_SEQUENCE:
             mime = PNG_MIMETYPE
     is_image = False
     if mime.startswith("image/"):
@@ -104,20 +233,21 @@ def detect_source(
     return origin_name, origin_id
 
 
+def generate_filename(mime):
+    title_only = "".join(
+        random.choices(string.ascii_letters + string.digits, k=16)
+    )
+    return title_only + EXTENSIONS_BY_MIME[mime], title_only
+
+
 def save_image(
-    source_file: FileStorage,
+    source_file: SpooledUploadFile | None,
     file_size: int,
     mime: str,
     outdir: pathlib.Path,
     img: PIL.Image.Image,
     rgba_to_rgb: bool,
 ):
-    def generate_filename(mime):
-        title_only = "".join(
-            random.choices(string.ascii_letters + string.digits, k=16)
-        )
-        return title_only + EXTENSIONS_BY_MIME[mime], title_only
-
     is_srs = False
     if mime == PNG_MIMETYPE:
         if (
@@ -153,8 +283,7 @@ def save_image(
     else:
         filename, file_title = generate_filename(mime)
         file_path = outdir.joinpath(filename)
-        print("SAVE OUTPUT FILE", file_path)
-        source_file.save(file_path)
+        source_file.move_to(file_path)
     return file_path, file_title, is_srs
 
 
@@ -222,8 +351,90 @@ def extract_metadata_from_image(
     return None, False
 
 
+def store_metadata_attachment(
+    connection,
+    content_id: int,
+    image_metadata,
+    outdir: pathlib.Path,
+    saved_name: str,
+):
+    if isinstance(image_metadata, ComfyUIWorkflow):
+        binary_encoded_json = json.dumps(image_metadata.workflow).encode(
+            "utf-8"
+        )
+        comfy_workflow_filepath = outdir.joinpath(saved_name + ".json.xz")
+        with lzma.open(comfy_workflow_filepath, "wb") as f:
+            f.write(binary_encoded_json)
+        medialib_db.attachment.add_attachment(
+            connection,
+            content_id,
+            "json+xz",
+            comfy_workflow_filepath,
+            "ComfyUI Workflow",
+        )
+    elif isinstance(image_metadata, JSONData):
+        binary_encoded_json = json.dumps(image_metadata.data).encode("utf-8")
+        json_filepath = outdir.joinpath(saved_name + ".json.xz")
+        with lzma.open(json_filepath, "wb") as f:
+            f.write(binary_encoded_json)
+        medialib_db.attachment.add_attachment(
+            connection,
+            content_id,
+            "json+xz",
+            json_filepath,
+            "JSON file",
+        )
+
+
+def remove_stored_files(
+    file_path: pathlib.Path,
+    saved_name: str,
+    is_srs: bool,
+):
+    """
+    Files save_image() and store_metadata_attachment() created for a
+    content whose registration was rolled back.
+    """
+    outdir = file_path.parent
+    if is_srs:
+        try:
+            levels = decode_srs(file_path).get_levels()
+        except Exception:
+            logger.exception("can't read {}".format(file_path))
+        else:
+            for level in levels:
+                outdir.joinpath(levels[level]).unlink(missing_ok=True)
+    outdir.joinpath(saved_name + ".json.xz").unlink(missing_ok=True)
+    file_path.unlink(missing_ok=True)
+
+
+def register_srs_representations(
+    connection, content_id: int, file_path: pathlib.Path, outdir: pathlib.Path
+):
+    srs_image = decode_srs(file_path)
+    levels = srs_image.get_levels()
+    for level in levels:
+        representation_file = outdir.joinpath(levels[level])
+        relative_repr_path = str(
+            representation_file.relative_to(medialib_db.config.relative_to)
+        )
+        medialib_db.register_representation(
+            content_id,
+            representation_file.suffix[1:],
+            level,
+            relative_repr_path,
+            connection,
+        )
+
+
 upload_blueprint = flask.Blueprint("upload", __name__, url_prefix="/upload")
 
+# endpoints whose request files are spooled next to their destination
+SPOOLED_ENDPOINTS = {
+    "medialib.upload.upload_file",
+    "medialib.upload.bulk_upload",
+}
+
 
 @upload_blueprint.route("/")
 @shared_code.login_validation
@@ -253,29 +464,33 @@ def upload_file():
 
     file: FileStorage = flask.request.files["image-file"]
     description, origin_name, origin_id = extract_fields()
-    file_buffer = io.BytesIO(file.stream.read(MAX_SAMPLE_LENGTH))
-    file_size = len(file_buffer.getvalue())
-    file_buffer.seek(0)
-    file.stream.seek(0)
-    mime, file_type, is_image = detect_file_type(file_buffer, file.mimetype)
-    file_buffer.seek(0)
+    spool = spool_file(file)
+    file_size = spool.size
+    mime, file_type, is_image = detect_file_type(spool.header, file.mimetype)
     if mime not in EXTENSIONS_BY_MIME:
         return generate_unsupported_type_response()
     # trim too long filename
     title = str(pathlib.Path(file.filename).stem[:MAX_TITLE_LENGTH])
     origin_name, origin_id = detect_source(title, origin_name, origin_id)
     hash = None
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
+    if upload_jobs.queue is not None and is_image:
+        return enqueue_image_processing(
+            connection,
+            spool,
+            mime,
+            file_type,
+            title,
+            origin_name,
+            origin_id,
+            description,
+        )
     is_alternate_version = False
     image_metadata = None
     img = None
     rgba_to_rgb = False
     if is_image:
-        if mime == AVIF_MIMETYPE:
-            heif = pillow_heif.open_heif(file_buffer)
-            img = heif.to_pillow()
-        else:
-            img = PIL.Image.open(file_buffer)
+        img = open_uploaded_image(spool.path, mime)
         image_metadata, rgba_to_rgb = extract_metadata_from_image(
             img, mime, origin_name
         )
@@ -285,12 +500,8 @@ def upload_file():
         )
         if len(duplicates) > 0:
             if "alternate_version" not in flask.request.form:
-                link_elements = []
-                for dup in duplicates:
-                    link_elements.append(
-                        f"<a href=/content_metadata/mlid{dup[0]}>mlid{dup[0]}</a>"
-                    )
-                return "Duplicates detected " + ", ".join(link_elements)
+                img.close()
+                return generate_duplicates_response(duplicates)
             else:
                 is_alternate_version = True
 
@@ -301,10 +512,12 @@ def upload_file():
     outdir.mkdir(parents=True, exist_ok=True)
 
     file_path, saved_name, is_srs = save_image(
-        file, file_size, mime, outdir, img, rgba_to_rgb
+        spool, file_size, mime, outdir, img, rgba_to_rgb
     )
     if img is not None:
         img.close()
+    if file_path == spool.path:
+        shared_code.file_digests.set_digest(file_path, spool.hexdigest())
 
     content_new_data = {
         "content_title": title,
@@ -321,55 +534,297 @@ def upload_file():
         content_id = medialib_db.content_register(
             **content_new_data, connection=connection
         )
-        if isinstance(image_metadata, ComfyUIWorkflow):
-            binary_encoded_json = json.dumps(image_metadata.workflow).encode(
-                "utf-8"
+        store_metadata_attachment(
+            connection, content_id, image_metadata, outdir, saved_name
+        )
+        if is_srs:
+            register_srs_representations(
+                connection, content_id, file_path, outdir
             )
-            comfy_workflow_filepath = outdir.joinpath(saved_name + ".json.xz")
-            with lzma.open(comfy_workflow_filepath, "wb") as f:
-                f.write(binary_encoded_json)
-            medialib_db.attachment.add_attachment(
+        if hash is not None:
+            medialib_db.set_image_hash(content_id, hash, connection)
+        connection.commit()
+    except Exception as e:
+        file_path.unlink()
+        raise e
+    search_cache.invalidate()
+    if hash is not None:
+        similarity_index.add(content_id, hash)
+
+    return flask.redirect(f"/content_metadata/mlid{content_id}")
+
+
+def open_uploaded_image(file_path: pathlib.Path, mime: str):
+    if mime == AVIF_MIMETYPE:
+        return pillow_heif.open_heif(file_path).to_pillow()
+    return PIL.Image.open(file_path)
+
+
+def generate_duplicates_response(duplicates) -> str:
+    link_elements = []
+    for dup in duplicates:
+        link_elements.append(
+            f"<a href=/content_metadata/mlid{dup[0]}>mlid{dup[0]}</a>"
+        )
+    return "Duplicates detected " + ", ".join(link_elements)
+
+
+def enqueue_image_processing(
+    connection,
+    spool: SpooledUploadFile,
+    mime: str,
+    file_type: str,
+    title: str,
+    origin_name: str | None,
+    origin_id: str | None,
+    description: str | None,
+):
+    """
+    Check uploaded image for duplicates, register it as it is and leave
+    metadata extraction and encoding to the upload job queue.
+    """
+    img = open_uploaded_image(spool.path, mime)
+    try:
+        hash = pyimglib.calc_image_hash(img)
+    finally:
+        img.close()
+    duplicates = medialib_db.find_content_by_hash(
+        hash[1].hex().lower(), hash[2], hash[3], connection
+    )
+    if len(duplicates) > 0 and "alternate_version" not in flask.request.form:
+        return generate_duplicates_response(duplicates)
+    outdir = shared_code.get_output_directory()
+    outdir.mkdir(parents=True, exist_ok=True)
+    filename, saved_name = generate_filename(mime)
+    file_path = outdir.joinpath(filename)
+    spool.move_to(file_path)
+    shared_code.file_digests.set_digest(file_path, spool.hexdigest())
+    try:
+        content_id = medialib_db.content_register(
+            content_title=title,
+            file_path=file_path,
+            content_type=file_type,
+            addition_date=datetime.datetime.now(),
+            content_id=None,
+            origin_name=origin_name,
+            origin_id=origin_id,
+            hidden=False,
+            description=description,
+            connection=connection,
+        )
+        connection.commit()
+    except Exception as e:
+        file_path.unlink()
+        raise e
+    search_cache.invalidate()
+    job_id = upload_jobs.queue.enqueue(
+        IMAGE_JOB,
+        {
+            "content_id": content_id,
+            "file_path": str(file_path),
+            "mime": mime,
+            "title": title,
+            "origin_name": origin_name,
+            "description": description,
+            "alternate_version": "alternate_version" in flask.request.form,
+            "image_hash": [hash[0], hash[1].hex(), hash[2], hash[3]],
+        },
+    )
+    if flask.request.accept_mimetypes.best == "application/json":
+        return make_job_response(job_id, {"content_id": content_id})
+    return flask.redirect(f"/content_metadata/mlid{content_id}")
+
+
+def make_job_response(job_id: int, fields: dict[str, typing.Any]):
+    """202 response with URLs of status and events of the upload job."""
+    return flask.Response(
+        json.dumps(
+            fields
+            | {
+                "job_id": job_id,
+                "status": flask.url_for(
+                    "medialib.upload.show_job_status", job_id=job_id
+                ),
+                "events": flask.url_for(
+                    "medialib.upload.stream_job_events", job_id=job_id
+                ),
+            }
+        ),
+        status=202,
+        mimetype="application/json",
+    )
+
+
+IMAGE_JOB = "image"
+# reported once the registration is committed
+UPLOAD_JOB_COMMITTED_STAGE = "committed"
+
+
+def _finish_upload_job(
+    connection,
+    params: dict[str, typing.Any],
+    image_hash,
+    file_path: pathlib.Path,
+) -> dict[str, typing.Any]:
+    content_id = params["content_id"]
+    duplicates = [
+        dup[0]
+        for dup in medialib_db.find_content_by_hash(
+            image_hash[1].hex().lower(),
+            image_hash[2],
+            image_hash[3],
+            connection,
+        )
+        if dup[0] != content_id
+    ]
+    search_cache.invalidate()
+    similarity_index.add(content_id, image_hash)
+    return {
+        "content_id": content_id,
+        "file_path": str(file_path),
+        "duplicates": duplicates,
+        "alternate_version": params["alternate_version"],
+    }
+
+
+def process_uploaded_image(
+    params: dict[str, typing.Any],
+    stage: str | None,
+    progress: dict[str, typing.Any] | None,
+    report: upload_jobs.Report,
+) -> dict[str, typing.Any]:
+    """
+    Upload job: the part of upload_file() done after registration.
+
+    The registration is one transaction, a job interrupted after it
+    was committed is not registered again when it runs again: it is
+    known by the reported stage or, for encoded PNG images, by the
+    changed file path of the content.
+    """
+    content_id = params["content_id"]
+    file_path = pathlib.Path(params["file_path"])
+    mime = params["mime"]
+    outdir = file_path.parent
+    saved_name = file_path.stem
+    with shared_code.db_pool.checkout() as connection:
+        content = medialib_db.content.get_content_metadata_by_id(
+            content_id, connection
+        )
+        if content is None:
+            raise ValueError("content {} does not exist".format(content_id))
+        if (
+            stage == UPLOAD_JOB_COMMITTED_STAGE
+            or content.file_path.name != file_path.name
+        ):
+            logger.info(
+                "upload job of content {} was committed already".format(
+                    content_id
+                )
+            )
+            if content.file_path.name != file_path.name:
+                file_path.unlink(missing_ok=True)
+            return _finish_upload_job(
                 connection,
-                content_id,
-                "json+xz",
-                comfy_workflow_filepath,
-                "ComfyUI Workflow",
+                params,
+                medialib_db.get_image_hash(content_id, connection),
+                medialib_db.config.relative_to.joinpath(content.file_path),
             )
-        elif isinstance(image_metadata, JSONData):
-            binary_encoded_json = json.dumps(image_metadata.data).encode(
-                "utf-8"
+    report("metadata")
+    img = open_uploaded_image(file_path, mime)
+    with shared_code.db_pool.checkout() as connection:
+        image_metadata, rgba_to_rgb = extract_metadata_from_image(
+            img, mime, params["origin_name"]
+        )
+        if "image_hash" in params:
+            # computed by the request for the duplicate check
+            aspect_ratio, value_hash, hue, saturation = params["image_hash"]
+            hash = (aspect_ratio, bytes.fromhex(value_hash), hue, saturation)
+        else:
+            # jobs enqueued before the request checked duplicates
+            report("hash")
+            hash = pyimglib.calc_image_hash(img)
+        is_srs = False
+        png_file_path = None
+        if mime == PNG_MIMETYPE:
+            report("encode")
+            new_file_path, saved_name, is_srs = save_image(
+                None,
+                file_path.stat().st_size,
+                mime,
+                outdir,
+                img,
+                rgba_to_rgb,
             )
-            json_filepath = outdir.joinpath(saved_name + ".json.xz")
-            with lzma.open(json_filepath, "wb") as f:
-                f.write(binary_encoded_json)
-            medialib_db.attachment.add_attachment(
-                connection,
-                content_id,
-                "json+xz",
-                json_filepath,
-                "JSON file",
+            img.close()
+            medialib_db.update_file_path(
+                content_id, new_file_path, hash, connection
+            )
+            png_file_path = file_path
+            file_path = new_file_path
+        else:
+            img.close()
+            medialib_db.set_image_hash(content_id, hash, connection)
+        report("register")
+        store_metadata_attachment(
+            connection, content_id, image_metadata, outdir, saved_name
+        )
+        if params["description"] is None and isinstance(
+            image_metadata, PlainTextData
+        ):
+            medialib_db.content.content_update(
+                connection=connection,
+                content_id=content_id,
+                content_title=params["title"],
+                hidden=False,
+                description=image_metadata.data,
             )
         if is_srs:
-            srs_image = decode_srs(file_path)
-            levels = srs_image.get_levels()
-            for level in levels:
-                representation_file = outdir.joinpath(levels[level])
-                relative_repr_path = str(
-                    representation_file.relative_to(
-                        medialib_db.config.relative_to
-                    )
-                )
-                medialib_db.register_representation(
-                    content_id,
-                    representation_file.suffix[1:],
-                    level,
-                    relative_repr_path,
-                    connection,
-                )
+            register_srs_representations(
+                connection, content_id, file_path, outdir
+            )
         connection.commit()
-        connection.close()
-    except Exception as e:
-        file_path.unlink()
-        raise e
+        report(UPLOAD_JOB_COMMITTED_STAGE)
+        # removed only now: until the commit the content refers to it
+        if png_file_path is not None:
+            png_file_path.unlink()
+        return _finish_upload_job(connection, params, hash, file_path)
 
-    return flask.redirect(f"/content_metadata/mlid{content_id}")
+
+def get_job_or_404(job_id: int) -> dict[str, typing.Any]:
+    job = None
+    if upload_jobs.queue is not None:
+        job = upload_jobs.queue.get(job_id)
+    if job is None:
+        flask.abort(404)
+    return job
+
+
+@upload_blueprint.route("/jobs/<int:job_id>")
+@shared_code.login_validation
+def show_job_status(job_id: int):
+    return flask.Response(
+        json.dumps(get_job_or_404(job_id)), mimetype="application/json"
+    )
+
+
+@upload_blueprint.route("/jobs/<int:job_id>/events")
+@shared_code.login_validation
+def stream_job_events(job_id: int):
+    """Server-sent events with job status on every change until it ends."""
+    job = get_job_or_404(job_id)
+
+    def generate(job):
+        while True:
+            yield "data: {}\n\n".format(json.dumps(job))
+            if job["state"] in upload_jobs.FINISHED_STATES:
+                return
+            last_update = job["updated"]
+            while job["updated"] == last_update:
+                time.sleep(JOB_EVENTS_POLL_INTERVAL)
+                job = upload_jobs.queue.get(job_id)
+
+    return flask.Response(
+        generate(job),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FINISHED_STATES = {DONE, FAILED}
+
+# workers of other processes add jobs too, so idle workers look into
+# the database at least this often
+POLL_INTERVAL = 5
+
+# handler(params, stage reached and progress saved by an interrupted
+# earlier run, report(stage, progress to save or None))
+Report = Callable[[str, dict[str, Any] | None], None]
+Handler = Callable[
+    [dict[str, Any], str | None, dict[str, Any] | None, Report],
+    dict[str, Any],
+]
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Queue of upload post-processing jobs persisted in SQLite.
+
+    Jobs are run by the handler of their kind in a bounded pool of
+    worker threads. The
+    database is shared by all server processes, a job is claimed by
+    one worker in a write transaction. Jobs which were running in a
+    process that does not exist anymore are queued again on start, so
+    jobs survive restarts. Progress a handler saves with its stage is
+    kept in the result of the running job and given to the handler
+    when the job runs again.
+    """
+
+    def __init__(self, db_file: pathlib.Path, handlers: dict[str, Handler]):
+        self._db_file = db_file
+        self._handlers = handlers
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._workers: list[threading.Thread] = []
+        connection = self._get_connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS upload_job ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "state TEXT NOT NULL, "
+            "stage TEXT, "
+            "params TEXT NOT NULL, "
+            "result TEXT, "
+            "error TEXT, "
+            "pid INTEGER, "
+            "created REAL NOT NULL, "
+            "updated REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS upload_job_state "
+            "ON upload_job (state, id)"
+        )
+        connection.commit()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, nor
+        # between processes, the queue is created before fork
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self._db_file, timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def enqueue(self, kind: str, params: dict[str, Any]) -> int:
+        params = params | {"kind": kind}
+        now = time.time()
+        job_id = (
+            self._get_connection()
+            .execute(
+                "INSERT INTO upload_job (state, params, created, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (QUEUED, json.dumps(params), now, now),
+            )
+            .lastrowid
+        )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id: int) -> dict[str, Any] | None:
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT id, state, stage, result, error, created, updated "
+                "FROM upload_job WHERE id = ?",
+                (job_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = (
+            json.loads(job["result"]) if job["result"] is not None else None
+        )
+        return job
+
+    def _requeue_orphans(self):
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        for job_id, pid in connection.execute(
+            "SELECT id, pid FROM upload_job WHERE state = ?", (RUNNING,)
+        ).fetchall():
+            if pid is None or not _process_exists(pid):
+                logger.info("upload job {} queued again".format(job_id))
+                connection.execute(
+                    "UPDATE upload_job SET state = ?, pid = NULL "
+                    "WHERE id = ?",
+                    (QUEUED, job_id),
+                )
+        connection.execute("COMMIT")
+
+    def _claim(
+        self,
+    ) -> tuple[int, dict[str, Any], str | None, dict[str, Any] | None] | None:
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute(
+            "SELECT id, params, stage, result FROM upload_job "
+            "WHERE state = ? "
+            "ORDER BY id LIMIT 1",
+            (QUEUED,),
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        connection.execute(
+            "UPDATE upload_job SET state = ?, pid = ?, updated = ? "
+            "WHERE id = ?",
+            (RUNNING, os.getpid(), time.time(), row["id"]),
+        )
+        connection.execute("COMMIT")
+        # result of a running job is the progress it saved
+        return (
+            row["id"],
+            json.loads(row["params"]),
+            row["stage"],
+            json.loads(row["result"]) if row["result"] is not None else None,
+        )
+
+    def _update(self, job_id: int, **columns):
+        columns["updated"] = time.time()
+        self._get_connection().execute(
+            "UPDATE upload_job SET {} WHERE id = ?".format(
+                ", ".join("{} = ?".format(name) for name in columns)
+            ),
+            (*columns.values(), job_id),
+        )
+
+    def _run(
+        self,
+        job_id: int,
+        params: dict[str, Any],
+        stage: str | None,
+        progress: dict[str, Any] | None,
+    ):
+        def report(stage: str, progress: dict[str, Any] | None = None):
+            if progress is None:
+                self._update(job_id, stage=stage)
+            else:
+                self._update(job_id, stage=stage, result=json.dumps(progress))
+
+        try:
+            result = self._handlers[params["kind"]](
+                params, stage, progress, report
+            )
+        except Exception as e:
+            logger.exception("upload job {} failed".format(job_id))
+            self._update(job_id, state=FAILED, error=str(e))
+        else:
+            self._update(
+                job_id, state=DONE, stage=None, result=json.dumps(result)
+            )
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    with self._wakeup:
+                        self._wakeup.wait(POLL_INTERVAL)
+                    continue
+                self._run(*job)
+            except Exception:
+                # e.g. the database stayed locked longer than the timeout,
+                # the worker must survive it
+                logger.exception("upload job worker failed")
+                connection = self._get_connection()
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                time.sleep(POLL_INTERVAL)
+
+    def start(self, workers: int):
+        """Start worker threads, called in every serving process."""
+        self._requeue_orphans()
+        for i in range(workers):
+            worker = threading.Thread(
+                target=self._work, name="upload-job-{}".format(i), daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+
+queue: JobQueue | None = None
@@ -24,9 +24,12 @@ import pyimglib.decoders.ffmpeg
 import shared_code
 import pyimglib.ACLMMP as ACLMMP
 import medialib_db
+import config
 import medialib
+import medialib.indexer
 import typing
 
+import filesystem.prewarm
 from filesystem.browse import browse
 
 
@@ -34,6 +37,7 @@ tmp_file = tempfile.NamedTemporaryFile()
 
 
 app = flask.Flask(__name__)
+app.request_class = medialib.upload.UploadRequest
 
 
 app.jinja_env.trim_blocks = True
@@ -84,6 +88,7 @@ def fs_root():
 
 
 app.register_blueprint(medialib.medialib_blueprint)
+app.teardown_appcontext(shared_code.db_pool.teardown_connection)
 
 
 def static_file(path, mimetype=None):
@@ -154,9 +159,41 @@ def get_download_filename(content_title, origin_id, path, _format) -> str:
     return filename
 
 
+TRANSCODE_ENCODER_PARAMS = {
+    "webp": {"quality": 90, "method": 4, "lossless": False},
+    "jpeg": {"quality": 90},
+    "png": {},
+}
+
+
+def cached_transcode(
+    source_path: pathlib.Path,
+    _format: str,
+    encoder_params: str,
+    encode: typing.Callable[[], bytes],
+) -> io.BytesIO | pathlib.Path:
+    transcode_cache = shared_code.transcode_cache
+    if transcode_cache is None:
+        return io.BytesIO(encode())
+    source_stat = source_path.stat()
+    cache_key = shared_code.disk_cache.make_key(
+        shared_code.root_dir.joinpath(source_path),
+        source_stat.st_size,
+        source_stat.st_mtime_ns,
+        _format,
+        encoder_params,
+    )
+    return transcode_cache.get_or_create(cache_key, "." + _format, encode)
+
+
 def jxl_jpeg_decode(file_path, download, content_title, origin_id, path):
     logger.info("decoding JPEG XL to JPEG")
-    jpeg_buffer = io.BytesIO(shared_code.jpeg_xl_fast_decode(file_path))
+    jpeg_buffer = cached_transcode(
+        pathlib.Path(file_path),
+        "jpeg",
+        "djxl",
+        lambda: shared_code.jpeg_xl_fast_decode(file_path),
+    )
     f = flask.send_file(jpeg_buffer, mimetype="image/jpeg")
     response = flask.make_response(f)
     if download:
@@ -169,6 +206,13 @@ def jxl_jpeg_decode(file_path, download, content_title, origin_id, path):
     return response
 
 
+TRANSCODE_MIME_TYPES = {
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
 @app.route("/image/<string:_format>/<string:pathstr>")
 @shared_code.login_validation
 def transcode_image(_format: str, pathstr):
@@ -187,6 +231,7 @@ def transcode_image(_format: str, pathstr):
                 path, download, content_title, origin_id, path
             )
         img = pyimglib.decoders.open_image(path)
+        source_path = path
         possible_formats = (_format,)
         LEVEL = int(flask.session["clevel"])
         if _format.lower() == "autodetect":
@@ -210,6 +255,7 @@ def transcode_image(_format: str, pathstr):
             )
             if _format == "png":
                 img = pyimglib.decoders.open_image(current_lod)
+                source_path = current_lod
             else:
                 while len(lods):
                     if current_lod_format not in possible_formats:
@@ -256,35 +302,46 @@ def transcode_image(_format: str, pathstr):
                         )
                     else:
                         img = pyimglib.decoders.open_image(current_lod)
-        if isinstance(img, pyimglib.decoders.frames_stream.FramesStream):
-            _img = img.next_frame()
-            img.close()
-            img = _img
-        img = img.convert(mode="RGBA")
-        buffer = io.BytesIO()
-        mime = ""
-        if _format.lower() == "webp":
-            img.save(
-                buffer, format="WEBP", quality=90, method=4, lossless=False
-            )
-            mime = "image/webp"
-        elif _format.lower() == "jpeg":
-            if pyimglib.decoders.jpeg.is_JPEG(path):
-                jpeg_data = path.read_bytes()
+                        source_path = current_lod
+        _format = _format.lower()
+        if _format not in TRANSCODE_ENCODER_PARAMS:
+            _format = "png"
+        encoder_params = TRANSCODE_ENCODER_PARAMS[_format]
+        is_jpeg_source = _format == "jpeg" and pyimglib.decoders.jpeg.is_JPEG(
+            path
+        )
+
+        def encode() -> bytes:
+            nonlocal img
+            if is_jpeg_source:
                 transcoding_result = subprocess.run(
                     ["jpegtran", "-copy", "all"],
-                    input=jpeg_data,
+                    input=path.read_bytes(),
                     capture_output=True,
                 )
-                buffer = io.BytesIO(transcoding_result.stdout)
-            else:
+                return transcoding_result.stdout
+            if isinstance(img, pyimglib.decoders.frames_stream.FramesStream):
+                _img = img.next_frame()
+                img.close()
+                img = _img
+            img = img.convert(mode="RGBA")
+            if _format == "jpeg":
                 img = img.convert(mode="RGB")
-                img.save(buffer, format="JPEG", quality=90)
-            mime = "image/jpeg"
-        else:
-            img.save(buffer, format="PNG")
-            mime = "image/png"
-        buffer.seek(0)
+            buffer = io.BytesIO()
+            img.save(buffer, format=_format.upper(), **encoder_params)
+            return buffer.getvalue()
+
+        try:
+            buffer = cached_transcode(
+                path if is_jpeg_source else source_path,
+                _format,
+                "jpegtran" if is_jpeg_source else repr(encoder_params),
+                encode,
+            )
+        finally:
+            # on a cache hit encode() does not run, the source is unused
+            img.close()
+        mime = TRANSCODE_MIME_TYPES[_format]
         f = flask.send_file(
             buffer,
             mimetype=mime,
@@ -395,6 +452,20 @@ def gen_thumbnail(_format: str, width: int, height: int, pathstr: str | None):
             src_hash, status_code = shared_code.cache_check(path)
         if status_code is not None:
             return status_code
+        if shared_code.fs_thumbnail_cache is not None and not allow_origin:
+            source_stat = path.stat()
+            thumbnail_format = shared_code.normalize_thumbnail_format(_format)
+            f = flask.send_file(
+                filesystem.thumbnails.get_cached_thumbnail(
+                    path, thumbnail_format, width, height, source_stat
+                ),
+                mimetype=shared_code.MIME_TYPES_BY_FORMAT[thumbnail_format],
+                max_age=24 * 60 * 60,
+                last_modified=source_stat.st_mtime,
+            )
+            if src_hash is not None:
+                f.set_etag(src_hash)
+            return f
         img = pyimglib.decoders.open_image(
             shared_code.root_dir.joinpath(path), (width, height)
         )
@@ -427,6 +498,106 @@ def gen_thumbnail(_format: str, width: int, height: int, pathstr: str | None):
     )
 
 
+prewarm_state: shared_code.job_state.JobState | None = None
+
+
+@app.route("/thumbnail-prewarm", methods=["GET", "POST"])
+@shared_code.login_validation
+def thumbnail_prewarm():
+    """
+    Start thumbnail pre-generation (POST) or show its progress (GET).
+
+    POST form takes either "dir", a directory relative to the root dir,
+    or medialib tag search fields (tags_count, tags, not, hidden_filtering).
+    Thumbnails are generated for the thumbnail size of current session.
+    One run at a time, its progress is seen by all worker processes.
+    """
+    if flask.request.method == "POST":
+        variants = filesystem.prewarm.make_variants(
+            [
+                (
+                    flask.session["thumbnail_width"],
+                    flask.session["thumbnail_height"],
+                )
+            ]
+        )
+        if "dir" in flask.request.form:
+            if shared_code.fs_thumbnail_cache is None:
+                flask.abort(400, "fs_thumbnail_cache_dir is not configured")
+            # resolved, so symlinks and ".." can't lead out of the root dir
+            root_dir = shared_code.root_dir.resolve()
+            directory = root_dir.joinpath(flask.request.form["dir"]).resolve()
+            if not directory.is_dir():
+                flask.abort(404)
+            if directory != root_dir and root_dir not in directory.parents:
+                flask.abort(403)
+            sources = filesystem.prewarm.iter_directory_sources(directory)
+            worker_function = filesystem.prewarm.prewarm_file
+        else:
+            if config.thumbnail_cache_dir is None:
+                flask.abort(400, "thumbnail_cache_dir is not configured")
+            hidden_filtering = int(
+                flask.request.form.get(
+                    "hidden_filtering",
+                    medialib_db.files_by_tag_search.HIDDEN_FILTERING.FILTER.value,
+                )
+            )
+            sources = filesystem.prewarm.iter_tag_query_sources(
+                medialib.parse_tags_groups(flask.request.form),
+                hidden_filtering,
+            )
+            worker_function = filesystem.prewarm.prewarm_content
+        if not prewarm_state.acquire():
+            flask.abort(409, "thumbnail pre-generation is already running")
+        filesystem.prewarm.PrewarmJob(
+            sources, worker_function, variants, prewarm_state
+        ).start()
+    return flask.Response(
+        json.dumps(prewarm_state.status()), mimetype="application/json"
+    )
+
+
+indexer_state: shared_code.job_state.JobState | None = None
+
+
+@app.route("/medialib-index", methods=["GET", "POST"])
+@shared_code.login_validation
+def medialib_index():
+    """
+    Start registration of files of "dir", a directory relative to the
+    root dir, in medialib (POST) or show its progress (GET). One run at
+    a time, its progress is seen by all worker processes.
+    """
+    if flask.request.method == "POST":
+        # resolved, so symlinks and ".." can't lead out of the root dir
+        root_dir = shared_code.root_dir.resolve()
+        directory = root_dir.joinpath(
+            flask.request.form.get("dir", ".")
+        ).resolve()
+        if not directory.is_dir():
+            flask.abort(404)
+        if directory != root_dir and root_dir not in directory.parents:
+            flask.abort(403)
+        # registered paths are relative to the unresolved root dir
+        directory = shared_code.root_dir.joinpath(
+            directory.relative_to(root_dir)
+        )
+        if not indexer_state.acquire():
+            flask.abort(409, "indexer is already running")
+        medialib.indexer.IndexerJob(directory, indexer_state).start()
+    return flask.Response(
+        json.dumps(indexer_state.status()), mimetype="application/json"
+    )
+
+
+@app.route("/db-pool-stats")
+@shared_code.login_validation
+def db_pool_stats():
+    """Database connection pool metrics of the current worker process."""
+    stats = shared_code.db_pool.get_pool().stats() | {"pid": os.getpid()}
+    return flask.Response(json.dumps(stats), mimetype="application/json")
+
+
 def detect_content_type(path: pathlib.Path):
     if path.suffix in filesystem.browse.image_file_extensions:
         return "image"
@@ -554,7 +725,7 @@ def get_content_metadata(pathstr: str | None, content_id: int | None) -> str:
         return content_new_data, tags
 
     # --- code body ---
-    connection = medialib_db.common.make_connection()
+    connection = shared_code.db_pool.get_connection()
     path = None
     if pathstr is not None:
         path = pathlib.Path(shared_code.base32_to_str(pathstr))
@@ -575,7 +746,6 @@ def get_content_metadata(pathstr: str | None, content_id: int | None) -> str:
                 **content_new_data, connection=connection
             )
         if content_id is None:
-            connection.close()
             flask.abort(500, "Unexpected behaviour: content_id is still None")
         medialib_db.add_tags_for_content(content_id, tags, connection)
 
@@ -600,7 +770,6 @@ def get_content_metadata(pathstr: str | None, content_id: int | None) -> str:
         )
         if len(attachments) == 0:
             attachments = None
-    connection.close()
 
     # render template
     if is_file:
@@ -656,7 +825,7 @@ def get_content_metadata(pathstr: str | None, content_id: int | None) -> str:
 @shared_code.login_validation
 def autodownload(pathstr, content_id):
     def body(path: pathlib.Path | None, content_id=None):
-        connection = medialib_db.common.make_connection()
+        connection = shared_code.db_pool.get_connection()
         db_content = None
         if content_id is not None:
             db_content = medialib_db.content.get_content_metadata_by_id(
@@ -702,7 +871,8 @@ def autodownload(pathstr, content_id):
             representations = medialib_db.get_representation_by_content_id(
                 content_id, connection
             )
-        connection.close()
+        # return the connection before the long running part
+        shared_code.db_pool.release_connection()
 
         if path.suffix == ".srs" and representations:
             compatible_repr: (
@@ -795,7 +965,7 @@ def autodownload(pathstr, content_id):
 @shared_code.login_validation
 def get_tags_from_external_service(pathstr, content_id):
     def body(path: pathlib.Path | None, content_id=None):
-        connection = medialib_db.common.make_connection()
+        connection = shared_code.db_pool.get_connection()
         db_content: medialib_db.content.Content | None = None
         is_file = True
         if content_id is not None:
@@ -825,7 +995,7 @@ def get_tags_from_external_service(pathstr, content_id):
             representations = medialib_db.get_representation_by_content_id(
                 content_id, connection
             )
-        connection.close()
+        shared_code.db_pool.release_connection()
 
         img = None
         img_file = None
@@ -1299,9 +1469,104 @@ def login_handler():
         flask.abort(401)
 
 
+def create_app(
+    root_dir: pathlib.Path | str | None = None,
+    allow_anonymous: bool | None = None,
+    enable_external_scripts: bool | None = None,
+) -> flask.Flask:
+    """
+    Configure the application and shared state from config module.
+
+    Arguments which are not None override the config values. The working
+    directory is changed to the root dir, because paths of files outside
+    of medialib are resolved relative to it.
+    Must be called before forking worker processes, so all of them share
+    the same secret key and sessions stay valid across workers.
+    """
+    global indexer_state, prewarm_state
+    if root_dir is None:
+        root_dir = config.root_dir
+    if root_dir is None:
+        raise ValueError("root dir is not set in config nor in arguments")
+    os.chdir(root_dir)
+    shared_code.root_dir = pathlib.Path(".").absolute()
+    if allow_anonymous is None:
+        allow_anonymous = config.allow_anonymous
+    shared_code.anonymous_forbidden = not allow_anonymous
+    if enable_external_scripts is not None:
+        shared_code.enable_external_scripts = enable_external_scripts
+    filesystem.browse.items_per_page = config.items_per_page
+    if config.dir_index_db is not None:
+        filesystem.browse.dir_index = (
+            filesystem.browse.directory_index.DirectoryIndex(
+                config.dir_index_db,
+                filesystem.browse.supported_file_extensions,
+                filesystem.browse.get_manifest_members,
+            )
+        )
+    if config.upload_queue_db is not None:
+        medialib.upload_jobs.queue = medialib.upload_jobs.JobQueue(
+            config.upload_queue_db,
+            {
+                medialib.upload.IMAGE_JOB: medialib.upload.process_uploaded_image,
+                medialib.bulk_upload.BULK_JOB: medialib.bulk_upload.process_bulk_upload,
+            },
+        )
+    if config.generation_file is not None:
+        shared_code.generations = shared_code.generation.SharedGenerations(
+            config.generation_file
+        )
+    job_state_dir = config.job_state_dir
+    if job_state_dir is None:
+        # created before fork, shared by worker processes
+        job_state_dir = pathlib.Path(tempfile.mkdtemp(prefix="jobs-"))
+    indexer_state = shared_code.job_state.JobState(job_state_dir, "indexer")
+    prewarm_state = shared_code.job_state.JobState(job_state_dir, "prewarm")
+    if config.file_digest_db is not None:
+        shared_code.file_digests = shared_code.file_digest.FileDigestStore(
+            config.file_digest_db
+        )
+    if config.transcode_cache_dir is not None:
+        shared_code.transcode_cache = shared_code.disk_cache.DiskCache(
+            config.transcode_cache_dir, config.transcode_cache_max_size
+        )
+    if config.fs_thumbnail_cache_dir is not None:
+        shared_code.fs_thumbnail_cache = shared_code.disk_cache.DiskCache(
+            config.fs_thumbnail_cache_dir, config.fs_thumbnail_cache_max_size
+        )
+    if config.fs_watch:
+        shared_code.fs_watch.register_invalidator(
+            filesystem.browse.listing_cache.invalidate
+        )
+        if filesystem.browse.dir_index is not None:
+            shared_code.fs_watch.register_invalidator(
+                filesystem.browse.dir_index.invalidate
+            )
+    if config.secret_key is not None:
+        app.secret_key = config.secret_key
+    elif app.secret_key is None:
+        app.secret_key = os.urandom(24)
+    return app
+
+
+def start_worker_threads(fs_watch: bool = True):
+    """
+    Start background threads of a serving process.
+
+    Threads don't survive fork(), so with pre-forked workers this is
+    called in every worker. fs_watch=False leaves the inotify watcher
+    off even if config.fs_watch is set.
+    """
+    if config.fs_watch and fs_watch:
+        shared_code.fs_watch.start(shared_code.root_dir)
+    if config.similarity_index:
+        medialib.hash_index.start_loading()
+    if medialib.upload_jobs.queue is not None:
+        medialib.upload_jobs.queue.start(config.upload_workers)
+
+
 if __name__ == "__main__":
     import argparse
-    import config
 
     ssl_context = None
     if len(config.certificate_file) and len(config.private_key_file):
@@ -1310,24 +1575,58 @@ if __name__ == "__main__":
         if os.path.exists(cert_path) and os.path.exists(key_path):
             ssl_context = (cert_path, key_path)
     port = config.port
-    filesystem.browse.items_per_page = config.items_per_page
     parser = argparse.ArgumentParser()
-    parser.add_argument("root_dir", default="")
+    parser.add_argument("root_dir", nargs="?", default=None)
     parser.add_argument("--port")
     parser.add_argument(
-        "--anon", help="enable access by anonymous", action="store_false"
+        "--workers",
+        help="number of worker processes (default: server_workers from config)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--anon", help="enable access by anonymous", action="store_true"
     )
     parser.add_argument(
         "--disable-external-content",
         help="Don't include external content links in template (web pages). Useful when you offline.",
-        action="store_false",
+        action="store_true",
     )
     args = parser.parse_args()
-    os.chdir(args.root_dir)
-    shared_code.root_dir = pathlib.Path(".").absolute()
     if args.port is not None:
         port = args.port
-    shared_code.anonymous_forbidden = args.anon
-    shared_code.enable_external_scripts = args.disable_external_content
-    app.secret_key = os.urandom(12)
-    app.run(host=config.host_name, port=port, ssl_context=ssl_context)
+    create_app(
+        args.root_dir,
+        allow_anonymous=True if args.anon else None,
+        enable_external_scripts=(
+            False if args.disable_external_content else None
+        ),
+    )
+    workers = (
+        args.workers if args.workers is not None else config.server_workers
+    )
+    # workers encode thumbnails at once, each gets its share of CPUs
+    shared_code.encoder_threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers > 1:
+        if config.fs_watch:
+            # every worker would watch the whole tree, multiplying
+            # inotify watches; listings are validated by mtime instead
+            logger.warning(
+                "fs_watch is off with more than one worker process"
+            )
+        shared_code.prefork.serve(
+            app,
+            config.host_name,
+            port,
+            workers,
+            ssl_context=ssl_context,
+            post_fork=lambda: start_worker_threads(fs_watch=False),
+        )
+    else:
+        start_worker_threads()
+        app.run(
+            host=config.host_name,
+            port=port,
+            ssl_context=ssl_context,
+            threaded=True,
+        )
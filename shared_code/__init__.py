@@ -1,14 +1,22 @@
 import functools
+import os
 import pathlib
 from . import enums
+from . import disk_cache
+from . import file_digest
+from . import prefork
+from . import db_pool
+from . import fs_watch
+from . import generation
+from . import job_state
 import base64
-import hashlib
 import re
 import urllib
 import urllib.parse
 import medialib_db
 import flask
 import PIL.Image
+import PIL.features
 import logging
 import io
 import tempfile
@@ -53,14 +61,14 @@ def get_medialib_sorting_constants_for_template():
     ]
 
 
+file_digests = file_digest.FileDigestStore(None)
+
+# created before fork, so pre-forked workers share it
+generations = generation.SharedGenerations()
+
+
 def cache_check(path):
-    hash = hashlib.sha3_256()
-    with path.open("br") as f:
-        buffer = f.read(1024)
-        while len(buffer) > 0:
-            hash.update(buffer)
-            buffer = f.read(1024 * 1024)
-    src_hash = hash.hexdigest()
+    src_hash = file_digests.get_digest(path)
     try:
         if flask.request.headers["If-None-Match"][1:-1] == src_hash:
             status_code = flask.Response(status=304)
@@ -126,6 +134,14 @@ def get_thumbnail_size(
 
 root_dir: pathlib.Path = None
 
+# cache of generated thumbnails for files outside of medialib
+fs_thumbnail_cache: disk_cache.DiskCache | None = None
+# cache of /image/ transcoding results
+transcode_cache: disk_cache.DiskCache | None = None
+# threads of one image encoder, None is the number of CPUs; set to a
+# share of CPUs where several processes encode at once
+encoder_threads: int | None = None
+
 
 MIME_TYPES_BY_FORMAT = {
     "jpeg": "image/jpeg",
@@ -134,6 +150,13 @@ MIME_TYPES_BY_FORMAT = {
 }
 
 
+def normalize_thumbnail_format(_format: str) -> str:
+    _format = _format.lower()
+    if _format in {"webp", "avif"}:
+        return _format
+    return "jpeg"
+
+
 def get_output_directory() -> pathlib.Path:
     MEDIALIB_ROOT = root_dir.joinpath("pictures").joinpath("medialib")
 
@@ -152,23 +175,60 @@ def extract_frame_from_video(
     return _img
 
 
-def generate_thumbnail_image(
-    img, _format, width, height
-) -> tuple[io.BytesIO, str, str]:
-    logger.info("generating thumbnail")
-    img = img.convert(mode="RGBA")
-    img.thumbnail((width, height), PIL.Image.Resampling.LANCZOS)
-    buffer = io.BytesIO()
-    thumbnail_file_path = None
-    mime = ""
-    if _format.lower() == "webp":
-        img.save(buffer, format="WEBP", quality=90, method=4, lossless=False)
-        mime = "image/webp"
-        _format = "webp"
-    elif _format.lower() == "avif":
+# avifenc quantizer range 8..16 of 63 is about this quality
+AVIF_QUALITY = 81
+AVIF_SPEED = 8
+
+
+def get_encoder_threads() -> int:
+    if encoder_threads is not None:
+        return encoder_threads
+    return os.cpu_count() or 1
+
+
+@functools.cache
+def get_avif_encoder() -> str:
+    """
+    AVIF encoder to use: Pillow AVIF plugin (Pillow 11.3+ built with
+    libavif), pillow_heif if its libheif has an AVIF encoder, or avifenc.
+    """
+    if PIL.features.check("avif"):
+        return "pillow"
+    try:
+        import pillow_heif
+    except ImportError:
+        pass
+    else:
+        if pillow_heif.libheif_info().get("AVIF"):
+            return "pillow_heif"
+    return "avifenc"
+
+
+def encode_avif(img: PIL.Image.Image, buffer: io.BytesIO):
+    encoder = get_avif_encoder()
+    if encoder == "pillow":
+        img.save(
+            buffer,
+            format="AVIF",
+            quality=AVIF_QUALITY,
+            speed=AVIF_SPEED,
+            max_threads=get_encoder_threads(),
+        )
+    elif encoder == "pillow_heif":
+        import pillow_heif
+
+        # "threads" is a parameter of all libheif AV1 encoder plugins
+        pillow_heif.from_pillow(img).save(
+            buffer,
+            format="AVIF",
+            quality=AVIF_QUALITY,
+            enc_params={"threads": str(get_encoder_threads())},
+        )
+    else:
         tmp_png_file = tempfile.NamedTemporaryFile(suffix=".png")
-        tmp_avif_file = tempfile.NamedTemporaryFile(suffix="avif")
+        tmp_avif_file = tempfile.NamedTemporaryFile(suffix=".avif")
         img.save(tmp_png_file, format="PNG")
+        tmp_png_file.flush()
         commandline = [
             "avifenc",
             "-d",
@@ -178,20 +238,35 @@ def generate_thumbnail_image(
             "--max",
             "16",
             "-j",
-            "4",
+            str(get_encoder_threads()),
             "-a",
             "end-usage=q",
             "-a",
             "cq-level=12",
             "-s",
-            "8",
+            str(AVIF_SPEED),
             tmp_png_file.name,
             tmp_avif_file.name,
         ]
-        subprocess.run(commandline)
+        subprocess.run(commandline, capture_output=True, check=True)
         tmp_png_file.close()
         buffer.write(tmp_avif_file.read())
         tmp_avif_file.close()
+
+
+def generate_thumbnail_image(
+    img, _format, width, height
+) -> tuple[io.BytesIO, str, str]:
+    logger.info("generating thumbnail")
+    img = img.convert(mode="RGBA")
+    img.thumbnail((width, height), PIL.Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    if _format.lower() == "webp":
+        img.save(buffer, format="WEBP", quality=90, method=4, lossless=False)
+        mime = "image/webp"
+        _format = "webp"
+    elif _format.lower() == "avif":
+        encode_avif(img, buffer)
         mime = "image/avif"
         _format = "avif"
     else:
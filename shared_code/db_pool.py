@@ -0,0 +1,228 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+import flask
+import medialib_db
+import psycopg2.extensions
+
+import config
+
+logger = logging.getLogger(__name__)
+
+G_CONNECTION_KEY = "medialib_db_connection"
+G_REQUEST_KEY = "medialib_db_request"
+
+_local = threading.local()
+
+
+def _count_query():
+    count = getattr(_local, "query_count", None)
+    if count is not None:
+        _local.query_count = count + 1
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor counting queries of the current request for debug logs."""
+
+    def execute(self, query, vars=None):
+        _count_query()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        _count_query()
+        return super().executemany(query, vars_list)
+
+
+def make_connection():
+    connection = medialib_db.common.make_connection()
+    connection.cursor_factory = CountingCursor
+    return connection
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of medialib database connections.
+
+    At most max_size connections are open at once, callers wait up to
+    timeout seconds for a free one. Released connections are rolled back,
+    so uncommitted changes never leak into the next checkout. Connections
+    closed by their user are dropped and replaced by new ones.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], object],
+        max_size: int,
+        timeout: float,
+    ):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle: list = []
+        self._open_count = 0
+        self._condition = threading.Condition()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+
+    def acquire(self):
+        start_time = time.monotonic()
+        waited = False
+        with self._condition:
+            while not len(self._idle) and self._open_count >= self.max_size:
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        "no free database connection in {} s".format(
+                            self.timeout
+                        )
+                    )
+                self._condition.wait(remaining)
+            if len(self._idle):
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._open_count += 1
+            wait_time = time.monotonic() - start_time
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max, wait_time)
+        if connection is None:
+            try:
+                connection = self._connect()
+            except BaseException:
+                with self._condition:
+                    self._open_count -= 1
+                    self._condition.notify()
+                raise
+        return connection
+
+    def release(self, connection):
+        reusable = not connection.closed
+        if reusable:
+            try:
+                connection.rollback()
+            except Exception:
+                logger.exception("rollback of released connection failed")
+                reusable = False
+                connection.close()
+        with self._condition:
+            if reusable:
+                self._idle.append(connection)
+            else:
+                self._open_count -= 1
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "open": self._open_count,
+                "idle": len(self._idle),
+                "in_use": self._open_count - len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "wait_time_total": self._wait_time_total,
+                "wait_time_max": self._wait_time_max,
+                "wait_time_avg": (
+                    self._wait_time_total / self._checkouts
+                    if self._checkouts
+                    else 0.0
+                ),
+            }
+
+
+_pool: ConnectionPool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Return the pool of current process.
+
+    Connections can't be shared between processes, so a forked worker
+    creates its own pool instead of inheriting the parent one.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                make_connection,
+                config.db_pool_size,
+                config.db_pool_timeout,
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def checkout():
+    """
+    Context manager for code running outside of a request
+    (background threads, CLI tools).
+    """
+    return get_pool().checkout()
+
+
+def get_connection():
+    """
+    Return the connection bound to the current request.
+
+    It is checked out on first use and released by teardown_connection()
+    when the application context is torn down, also after flask.abort().
+    Queries of the request are counted and logged at debug level.
+    """
+    connection = flask.g.get(G_CONNECTION_KEY)
+    if connection is None:
+        connection = get_pool().acquire()
+        setattr(flask.g, G_CONNECTION_KEY, connection)
+        if G_REQUEST_KEY not in flask.g and flask.has_request_context():
+            setattr(
+                flask.g,
+                G_REQUEST_KEY,
+                "{} {}".format(flask.request.method, flask.request.path),
+            )
+            _local.query_count = 0
+    return connection
+
+
+def release_connection():
+    """Return the request connection to the pool before the request ends."""
+    connection = flask.g.pop(G_CONNECTION_KEY, None)
+    if connection is not None:
+        get_pool().release(connection)
+
+
+def teardown_connection(exception=None):
+    release_connection()
+    request_description = flask.g.pop(G_REQUEST_KEY, None)
+    if request_description is not None:
+        logger.debug(
+            "{}: {} database queries".format(
+                request_description, _local.query_count
+            )
+        )
+        _local.query_count = None
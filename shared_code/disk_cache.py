@@ -0,0 +1,164 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(*parts) -> str:
+    key_source = "\x00".join(str(part) for part in parts)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed file cache with a byte budget.
+
+    Entries are stored as ``<cache_dir>/<key[:2]>/<key><suffix>``. File
+    mtime is used as the access time: hits touch the file, eviction removes
+    the least recently touched entries first. Because the state lives on
+    disk, several server processes can share one cache directory: the
+    total size is counted in a size file, updated under its lock.
+    """
+
+    EVICTION_TARGET_RATIO = 0.9
+    LOCK_DIR_NAME = ".locks"
+    SIZE_FILE_NAME = "size"
+
+    def __init__(self, cache_dir: pathlib.Path, max_size: int):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir.joinpath(self.LOCK_DIR_NAME).mkdir(exist_ok=True)
+
+    def _entry_path(self, key: str, suffix: str) -> pathlib.Path:
+        return self.cache_dir.joinpath(key[:2], key + suffix)
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for bucket in os.scandir(self.cache_dir):
+            if bucket.name.startswith(".") or not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key: str, suffix: str) -> pathlib.Path | None:
+        entry_path = self._entry_path(key, suffix)
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        logger.debug("disk cache hit: {}".format(entry_path))
+        return entry_path
+
+    @contextlib.contextmanager
+    def single_flight(self, key: str):
+        """
+        Serialize creation of an entry between threads and processes.
+
+        Callers should check the cache again after entering the context,
+        because another worker could have created the entry meanwhile.
+        Lock files are striped by key prefix, so their number is bounded.
+        """
+        lock_path = self.cache_dir.joinpath(self.LOCK_DIR_NAME, key[:3])
+        # flock is bound to the open file description, so every caller
+        # opens its own descriptor, even within one process
+        with open(lock_path, "ab") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_or_create(
+        self, key: str, suffix: str, create: Callable[[], bytes]
+    ) -> pathlib.Path:
+        entry_path = self.get(key, suffix)
+        if entry_path is None:
+            with self.single_flight(key):
+                entry_path = self.get(key, suffix)
+                if entry_path is None:
+                    entry_path = self.put(key, suffix, create())
+        return entry_path
+
+    def put(self, key: str, suffix: str, data: bytes) -> pathlib.Path:
+        entry_path = self._entry_path(key, suffix)
+        entry_path.parent.mkdir(exist_ok=True)
+        # write to a temporary file first, so concurrent readers never
+        # see a partially written entry
+        try:
+            replaced_size = entry_path.stat().st_size
+        except FileNotFoundError:
+            replaced_size = 0
+        fd, tmp_name = tempfile.mkstemp(dir=entry_path.parent, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, entry_path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        self._add_size(len(data) - replaced_size)
+        return entry_path
+
+    def _add_size(self, added: int):
+        """
+        Update the size shared by all processes, evicting over budget.
+
+        The size is counted from a scan of the cache directory when the
+        size file is empty and set by every eviction, so it does not
+        drift from the actual size for long.
+        """
+        size_path = self.cache_dir.joinpath(
+            self.LOCK_DIR_NAME, self.SIZE_FILE_NAME
+        )
+        # unbuffered, the size is written before the lock is released
+        with open(size_path, "a+b", buffering=0) as size_file:
+            fcntl.flock(size_file, fcntl.LOCK_EX)
+            try:
+                size_file.seek(0)
+                size_str = size_file.read()
+                if len(size_str):
+                    size = int(size_str) + added
+                else:
+                    size = sum(entry[1] for entry in self._scan())
+                if size > self.max_size:
+                    size = self._evict()
+                size_file.truncate(0)
+                size_file.write(str(size).encode("ascii"))
+            finally:
+                fcntl.flock(size_file, fcntl.LOCK_UN)
+
+    def _evict(self) -> int:
+        entries = self._scan()
+        entries.sort()
+        total_size = sum(entry[1] for entry in entries)
+        target_size = self.max_size * self.EVICTION_TARGET_RATIO
+        removed = 0
+        for mtime, size, path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+        logger.info(
+            "disk cache {}: evicted {} entries, {} bytes left".format(
+                self.cache_dir, removed, total_size
+            )
+        )
+        return total_size
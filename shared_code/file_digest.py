@@ -0,0 +1,124 @@
+import collections
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def compute_file_digest(path: pathlib.Path) -> str:
+    hash = hashlib.sha3_256()
+    with open(path, "br") as f:
+        buffer = f.read(READ_BLOCK_SIZE)
+        while len(buffer) > 0:
+            hash.update(buffer)
+            buffer = f.read(READ_BLOCK_SIZE)
+    return hash.hexdigest()
+
+
+def stat_key(stat_result: os.stat_result) -> tuple[int, int, int, int]:
+    return (
+        stat_result.st_dev,
+        stat_result.st_ino,
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+    )
+
+
+class FileDigestStore:
+    """
+    SHA3-256 digests of files keyed by (device, inode, size, mtime_ns).
+
+    A digest is calculated once and then served from the in-memory LRU
+    or from the SQLite database, if db_file is given. Any change of the
+    stat tuple makes the stored digest stale, so it is recalculated.
+    """
+
+    def __init__(self, db_file: pathlib.Path | None, memory_entries=4096):
+        self._db_file = db_file
+        self._memory_entries = memory_entries
+        self._memory_cache: collections.OrderedDict[tuple, str] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self._db_file is not None:
+            connection = self._get_connection()
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_digest ("
+                "device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "digest TEXT NOT NULL, "
+                "PRIMARY KEY (device, inode))"
+            )
+            connection.commit()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_file, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _remember(self, key: tuple, digest: str):
+        with self._lock:
+            self._memory_cache[key] = digest
+            self._memory_cache.move_to_end(key)
+            while len(self._memory_cache) > self._memory_entries:
+                self._memory_cache.popitem(last=False)
+
+    def _load(self, key: tuple) -> str | None:
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT size, mtime_ns, digest FROM file_digest "
+                "WHERE device = ? AND inode = ?",
+                key[:2],
+            )
+            .fetchone()
+        )
+        if row is not None and tuple(row[:2]) == key[2:]:
+            return row[2]
+        return None
+
+    def _save(self, key: tuple, digest: str):
+        connection = self._get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO file_digest "
+            "(device, inode, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+            (*key, digest),
+        )
+        connection.commit()
+
+    def get_digest(self, path: pathlib.Path) -> str:
+        key = stat_key(os.stat(path))
+        with self._lock:
+            digest = self._memory_cache.get(key)
+            if digest is not None:
+                self._memory_cache.move_to_end(key)
+                return digest
+        if self._db_file is not None:
+            digest = self._load(key)
+        if digest is None:
+            logger.debug("calculating digest of {}".format(path))
+            digest = compute_file_digest(path)
+            if self._db_file is not None:
+                self._save(key, digest)
+        self._remember(key, digest)
+        return digest
+
+    def set_digest(self, path: pathlib.Path, digest: str):
+        """Register an already known digest of the file, e.g. after upload."""
+        key = stat_key(os.stat(path))
+        if self._db_file is not None:
+            self._save(key, digest)
+        self._remember(key, digest)
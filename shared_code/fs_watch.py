@@ -0,0 +1,232 @@
+import ctypes
+import ctypes.util
+import enum
+import errno
+import logging
+import os
+import pathlib
+import select
+import struct
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class EventType(enum.Enum):
+    CREATE = enum.auto()
+    MODIFY = enum.auto()
+    MOVE = enum.auto()
+    DELETE = enum.auto()
+    # events were lost, everything under the path may have changed
+    OVERFLOW = enum.auto()
+
+
+Invalidator = Callable[[pathlib.Path, EventType], None]
+
+_invalidators: list[Invalidator] = []
+
+
+def register_invalidator(invalidator: Invalidator):
+    """
+    Register a callback called with (path, event type) on every change.
+
+    Callbacks run in the watcher thread and must be thread-safe. For
+    OVERFLOW the path is a watched directory and anything below it has
+    to be treated as changed.
+    """
+    _invalidators.append(invalidator)
+
+
+def publish(path: pathlib.Path, event_type: EventType):
+    for invalidator in _invalidators:
+        try:
+            invalidator(path, event_type)
+        except Exception:
+            logger.exception("invalidator {} failed".format(invalidator))
+
+
+def _event_type(mask: int) -> EventType:
+    if mask & (IN_MOVED_FROM | IN_MOVED_TO | IN_MOVE_SELF):
+        return EventType.MOVE
+    elif mask & (IN_DELETE | IN_DELETE_SELF):
+        return EventType.DELETE
+    elif mask & IN_CREATE:
+        return EventType.CREATE
+    else:
+        return EventType.MODIFY
+
+
+class InotifyWatcher(threading.Thread):
+    """
+    Watch a directory tree with inotify and publish changes.
+
+    Directories are watched recursively, new subdirectories are added as
+    they appear. When the kernel limit of watches is reached, the rest
+    of the tree stays unwatched; is_watched() is False for such
+    directories, so caches have to keep validating them by mtime.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        super().__init__(name="inotify-watcher", daemon=True)
+        self.root = pathlib.Path(root)
+        self.exhausted = False
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self._add_watch.restype = ctypes.c_int
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._stop_read, self._stop_write = os.pipe()
+        self._paths_by_wd: dict[int, pathlib.Path] = dict()
+        self._watched: set[pathlib.Path] = set()
+        self._lock = threading.Lock()
+
+    def is_watched(self, directory: pathlib.Path) -> bool:
+        with self._lock:
+            return self.is_alive() and directory in self._watched
+
+    def _watch(self, directory: pathlib.Path) -> bool:
+        if self.exhausted:
+            return False
+        wd = self._add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self.exhausted = True
+                logger.warning(
+                    "inotify watches exhausted at {}, "
+                    "falling back to mtime checks".format(directory)
+                )
+            elif error not in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                logger.error(
+                    "inotify_add_watch {}: {}".format(
+                        directory, os.strerror(error)
+                    )
+                )
+            return False
+        with self._lock:
+            self._paths_by_wd[wd] = directory
+            self._watched.add(directory)
+        return True
+
+    def _watch_tree(self, top: pathlib.Path):
+        for dirpath, dirnames, filenames in os.walk(top):
+            if not self._watch(pathlib.Path(dirpath)):
+                dirnames.clear()
+                continue
+            # hidden directories are not shown by the browser
+            dirnames[:] = [name for name in dirnames if name[0] != "."]
+
+    def _forget(self, wd: int):
+        with self._lock:
+            directory = self._paths_by_wd.pop(wd, None)
+            if directory is not None:
+                self._watched.discard(directory)
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflow")
+            publish(self.root, EventType.OVERFLOW)
+            return
+        if mask & IN_IGNORED:
+            self._forget(wd)
+            return
+        with self._lock:
+            directory = self._paths_by_wd.get(wd)
+        if directory is None:
+            return
+        path = directory.joinpath(name) if name else directory
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            if name[0] != ".":
+                self._watch_tree(path)
+        publish(path, _event_type(mask))
+
+    def run(self):
+        self._watch_tree(self.root)
+        logger.info(
+            "watching {} directories under {}".format(
+                len(self._watched), self.root
+            )
+        )
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_read], [], [])
+            if self._stop_read in readable:
+                break
+            buffer = os.read(self._fd, READ_BUFFER_SIZE)
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(
+                    buffer, offset
+                )
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(
+                    buffer[offset : offset + name_length].rstrip(b"\0")
+                )
+                offset += name_length
+                self._handle(wd, mask, name)
+        os.close(self._fd)
+
+    def stop(self):
+        os.write(self._stop_write, b"\0")
+
+
+watcher: InotifyWatcher | None = None
+
+
+def start(root: pathlib.Path) -> InotifyWatcher | None:
+    """Start the watcher of current process, None if inotify is missing."""
+    global watcher
+    try:
+        watcher = InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        # AttributeError: libc without inotify functions (not Linux)
+        logger.warning("inotify is not available: {}".format(e))
+        watcher = None
+        return None
+    watcher.start()
+    return watcher
+
+
+def is_watched(directory: pathlib.Path) -> bool:
+    """
+    True if changes in directory are published to invalidators.
+
+    Otherwise cached data about directory must be validated by mtime.
+    """
+    return watcher is not None and watcher.is_watched(directory)
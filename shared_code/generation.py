@@ -0,0 +1,114 @@
+import fcntl
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+
+COUNTER_FORMAT = "<q"
+COUNTER_SIZE = struct.calcsize(COUNTER_FORMAT)
+
+# content: content and tag assignments (search caches)
+# tags: names, aliases, parents of tags (tag dictionary)
+# image_hashes: perceptual hashes (similarity index)
+COUNTERS = ("content", "tags", "image_hashes")
+# counters which keep ids of their last changes, so readers can apply
+# them instead of reloading everything
+CHANGE_LOGS = ("image_hashes",)
+CHANGE_LOG_LENGTH = 4096
+# a change of unknown items
+UNKNOWN_ITEM = -1
+
+
+class SharedGenerations:
+    """
+    Generation counters shared by server processes.
+
+    Every write bumps its counter, caches remember the generation their
+    entries were loaded in and treat entries of an older generation as
+    missing. The counters live in a file mapped into memory, reading one
+    is a memory access. With path set, command line tools which use
+    the same file invalidate caches of the server too. Without it an
+    unnamed temporary file is used, created before fork, so it is shared
+    by pre-forked workers only.
+
+    Counters of CHANGE_LOGS keep the item of every bump in a ring of
+    CHANGE_LOG_LENGTH slots after the counters, the item of generation g
+    is in slot g % CHANGE_LOG_LENGTH.
+    """
+
+    def __init__(self, path: pathlib.Path | None = None):
+        size = COUNTER_SIZE * (
+            len(COUNTERS) + len(CHANGE_LOGS) * CHANGE_LOG_LENGTH
+        )
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _offset(self, name: str) -> int:
+        return COUNTERS.index(name) * COUNTER_SIZE
+
+    def _slot_offset(self, name: str, generation: int) -> int:
+        return COUNTER_SIZE * (
+            len(COUNTERS)
+            + CHANGE_LOGS.index(name) * CHANGE_LOG_LENGTH
+            + generation % CHANGE_LOG_LENGTH
+        )
+
+    def get(self, name: str) -> int:
+        return struct.unpack_from(
+            COUNTER_FORMAT, self._map, self._offset(name)
+        )[0]
+
+    def bump(self, name: str, item: int = UNKNOWN_ITEM) -> int:
+        """
+        Start a new generation of counter name. item is the changed
+        item, recorded for counters of CHANGE_LOGS.
+        """
+        offset = self._offset(name)
+        # record locks are owned by the process, unlike flock() locks
+        # they exclude forked processes which share the file descriptor
+        fcntl.lockf(self._file, fcntl.LOCK_EX, COUNTER_SIZE, offset)
+        try:
+            generation = self.get(name) + 1
+            if name in CHANGE_LOGS:
+                # the slot is written before the counter, a reader which
+                # sees the generation sees its item too
+                struct.pack_into(
+                    COUNTER_FORMAT,
+                    self._map,
+                    self._slot_offset(name, generation),
+                    item,
+                )
+            struct.pack_into(COUNTER_FORMAT, self._map, offset, generation)
+        finally:
+            fcntl.lockf(self._file, fcntl.LOCK_UN, COUNTER_SIZE, offset)
+        return generation
+
+    def changes(self, name: str, since: int) -> tuple[int, set[int] | None]:
+        """
+        Current generation of counter name and items changed after
+        generation since, None if they are not known: the ring was
+        overwritten or an item was not recorded.
+        """
+        generation = self.get(name)
+        if generation - since > CHANGE_LOG_LENGTH or generation < since:
+            return generation, None
+        items = {
+            struct.unpack_from(
+                COUNTER_FORMAT,
+                self._map,
+                self._slot_offset(name, changed_generation),
+            )[0]
+            for changed_generation in range(since + 1, generation + 1)
+        }
+        # writers could overwrite the slots while they were read
+        if self.get(name) - since > CHANGE_LOG_LENGTH:
+            return generation, None
+        if UNKNOWN_ITEM in items:
+            return generation, None
+        return generation, items
@@ -0,0 +1,101 @@
+import fcntl
+import json
+import os
+import pathlib
+import threading
+from typing import Any, Callable
+
+# seconds between progress updates of a running job
+PUBLISH_INTERVAL = 1.0
+
+
+class JobState:
+    """
+    Lock and progress of a background job shared by processes.
+
+    The job runs in one process, which holds an exclusive flock() of
+    the lock file while it runs and writes progress to the state file.
+    Any process reads the progress. flock() locks belong to the open
+    file, the lock file is opened when the job starts, so pre-forked
+    workers and command line tools using the same directory exclude
+    each other. The kernel drops the lock of a crashed process.
+    """
+
+    def __init__(self, directory: pathlib.Path, name: str):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._lock_path = directory.joinpath(name + ".lock")
+        self._state_path = directory.joinpath(name + ".json")
+        self._lock_file = None
+
+    def _try_lock(self):
+        lock_file = self._lock_path.open("a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def acquire(self) -> bool:
+        """Take the lock for a new job, False if a job runs already."""
+        lock_file = self._try_lock()
+        if lock_file is None:
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self):
+        lock_file, self._lock_file = self._lock_file, None
+        if lock_file is not None:
+            lock_file.close()
+
+    def is_running(self) -> bool:
+        lock_file = self._try_lock()
+        if lock_file is None:
+            return True
+        lock_file.close()
+        return False
+
+    def write(self, status: dict[str, Any]):
+        temp_path = self._state_path.with_name(
+            "{}.{}".format(self._state_path.name, os.getpid())
+        )
+        temp_path.write_text(json.dumps(status))
+        # readers see the old or the new state, never a partial one
+        os.replace(temp_path, self._state_path)
+
+    def read(self) -> dict[str, Any] | None:
+        try:
+            return json.loads(self._state_path.read_text())
+        except FileNotFoundError:
+            return None
+
+    def status(self) -> dict[str, Any]:
+        """Progress of the last job with "running" flag."""
+        running = self.is_running()
+        state = self.read()
+        if state is None:
+            return {"running": running}
+        return state | {"running": running}
+
+    def run(self, progress, target: Callable[[], None]):
+        """
+        Run target of an acquired job, publishing progress.as_dict()
+        while it runs, and release the lock after it.
+        """
+        stop = threading.Event()
+
+        def publish():
+            while not stop.wait(PUBLISH_INTERVAL):
+                self.write(progress.as_dict())
+
+        self.write(progress.as_dict())
+        publisher = threading.Thread(target=publish, daemon=True)
+        publisher.start()
+        try:
+            target()
+        finally:
+            stop.set()
+            publisher.join()
+            self.write(progress.as_dict())
+            self.release()
@@ -0,0 +1,102 @@
+import logging
+import os
+import signal
+import socket
+import sys
+from typing import Callable
+
+import werkzeug.serving
+
+logger = logging.getLogger(__name__)
+
+LISTEN_BACKLOG = 128
+
+
+def _run_worker(app, host, port, listen_fd, ssl_context, post_fork):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if post_fork is not None:
+        post_fork()
+    server = werkzeug.serving.make_server(
+        host,
+        port,
+        app,
+        threaded=True,
+        ssl_context=ssl_context,
+        fd=listen_fd,
+    )
+    logger.info("worker {} started".format(os.getpid()))
+    server.serve_forever()
+
+
+def serve(
+    app,
+    host: str,
+    port: int,
+    workers: int,
+    ssl_context=None,
+    post_fork: Callable[[], None] | None = None,
+):
+    """
+    Serve app from pre-forked worker processes.
+
+    The listening socket is created before forking and is shared by all
+    workers, each of them handles requests in threads. Workers which exit
+    unexpectedly are restarted. post_fork is called in every worker, it
+    is the place to start threads, which don't survive fork().
+    """
+    listen_socket = socket.create_server(
+        (host, int(port)),
+        family=werkzeug.serving.select_address_family(host, int(port)),
+        backlog=LISTEN_BACKLOG,
+    )
+    listen_socket.set_inheritable(True)
+    listen_fd = listen_socket.fileno()
+    children: set[int] = set()
+    shutting_down = False
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, host, port, listen_fd, ssl_context, post_fork)
+            except BaseException:
+                logger.exception("worker {} failed".format(os.getpid()))
+            finally:
+                os._exit(1)
+        children.add(pid)
+
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info(
+        "serving on {}:{} with {} worker processes".format(host, port, workers)
+    )
+    for i in range(workers):
+        spawn_worker()
+    while len(children):
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not shutting_down:
+            logger.error(
+                "worker {} exited with status {}, restarting".format(
+                    pid, status
+                )
+            )
+            spawn_worker()
+    listen_socket.close()
+    sys.exit(0)
@@ -0,0 +1,25 @@
+import importlib.util
+import pathlib
+import sys
+
+APP_DIR = pathlib.Path(__file__).parent.parent
+
+
+def import_standalone(module_name: str):
+    """
+    Import a module of the application by file, without its package.
+
+    Packages such as medialib import the database and image libraries
+    on import; modules which do not need them can be tested without.
+    """
+    standalone_name = "standalone." + module_name
+    if standalone_name in sys.modules:
+        return sys.modules[standalone_name]
+    spec = importlib.util.spec_from_file_location(
+        standalone_name,
+        APP_DIR.joinpath(*module_name.split(".")).with_suffix(".py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[standalone_name] = module
+    spec.loader.exec_module(module)
+    return module
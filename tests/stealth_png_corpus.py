@@ -0,0 +1,141 @@
+"""
+Test corpus of stealth PNG metadata images.
+
+Images are generated from fixed seeds: both channels, plain and gzip
+compressed payloads, payloads cut by the end of the image, zero length
+and broken gzip payloads, and images with sides of 1 to 200 pixels.
+Files in tests/data/stealth_png are a part of the corpus written by
+this module; write them again with:
+    python -m tests.stealth_png_corpus tests/data/stealth_png
+"""
+
+import gzip
+import pathlib
+import random
+import sys
+from typing import Iterator
+
+import numpy
+from PIL import Image
+
+DATA_DIR = pathlib.Path(__file__).parent.joinpath("data", "stealth_png")
+SIGNATURES = {
+    ("alpha", False): b"stealth_pnginfo",
+    ("alpha", True): b"stealth_pngcomp",
+    ("rgb", False): b"stealth_rgbinfo",
+    ("rgb", True): b"stealth_rgbcomp",
+}
+PARAMETERS_TEXT = (
+    "masterpiece, best quality, 1girl, solo\n"
+    "Negative prompt: lowres, bad anatomy\n"
+    "Steps: 28, Sampler: Euler a, CFG scale: 7, Seed: {}, "
+    "Size: {}x{}, Model: анимэ-v3 ✓"
+)
+# payload variants
+PLAIN = "plain"
+TRUNCATED = "truncated"
+EMPTY = "empty"
+BROKEN_GZIP = "broken_gzip"
+
+
+def _to_bits(data: bytes) -> numpy.ndarray:
+    return numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+
+
+def embed(
+    width: int,
+    height: int,
+    channel: str,
+    compressed: bool,
+    payload: bytes,
+    variant: str,
+    seed: int,
+) -> Image.Image:
+    """
+    Image with stealth metadata in least significant bits,
+    written column by column like the stealth_pnginfo extension does.
+    """
+    rng = numpy.random.default_rng(seed)
+    mode = "RGBA" if channel == "alpha" else "RGB"
+    # gradient with random least significant bits, the gradient keeps
+    # corpus files small
+    gradient = numpy.add.outer(
+        numpy.arange(height), numpy.arange(width)
+    ).astype(numpy.uint8)
+    pixels = (
+        numpy.repeat(gradient[:, :, numpy.newaxis], len(mode), axis=2) & 0xFE
+    ) | rng.integers(0, 2, (height, width, len(mode)), dtype=numpy.uint8)
+    if compressed and variant != BROKEN_GZIP:
+        payload = gzip.compress(payload, mtime=0)
+    elif variant == BROKEN_GZIP:
+        payload = b"\x1f\x8b" + payload
+    length = 0 if variant == EMPTY else len(payload) * 8
+    stream = numpy.concatenate(
+        (
+            _to_bits(SIGNATURES[channel, compressed]),
+            _to_bits(length.to_bytes(4, "big")),
+            _to_bits(payload),
+        )
+    )
+    columns = pixels.transpose(1, 0, 2).reshape(-1, len(mode))
+    if channel == "alpha":
+        lsb = columns[:, 3]
+    else:
+        lsb = columns[:, :3].reshape(-1)
+    # a truncated stream is what fits, the rest is cut off
+    stream = stream[: len(lsb)]
+    lsb[: len(stream)] = (lsb[: len(stream)] & 0xFE) | stream
+    if channel == "alpha":
+        columns[:, 3] = lsb
+    else:
+        columns[:, :3] = lsb.reshape(-1, 3)
+    pixels = columns.reshape(width, height, len(mode)).transpose(1, 0, 2)
+    return Image.fromarray(numpy.ascontiguousarray(pixels), mode)
+
+
+def iter_corpus(count: int = 600) -> Iterator[tuple[str, Image.Image]]:
+    """(name, image) of count generated images."""
+    rng = random.Random(18)
+    variants = [PLAIN] * 4 + [TRUNCATED, EMPTY, BROKEN_GZIP]
+    for index in range(count):
+        channel = rng.choice(("alpha", "rgb"))
+        compressed = rng.random() < 0.5
+        variant = rng.choice(variants)
+        if variant == BROKEN_GZIP:
+            compressed = True
+        width = rng.randint(1, 200)
+        height = rng.randint(1, 200)
+        payload = PARAMETERS_TEXT.format(index, width, height).encode()
+        if variant != TRUNCATED:
+            # the header and the payload fit into the image
+            bits_per_pixel = 1 if channel == "alpha" else 3
+            min_pixels = (47 * 8 + len(payload) * 8 * 2) // bits_per_pixel
+            height = max(height, min_pixels // width + 1)
+        name = "{:03}_{}_{}_{}_{}x{}".format(
+            index,
+            channel,
+            "comp" if compressed else "info",
+            variant,
+            width,
+            height,
+        )
+        yield name, embed(
+            width, height, channel, compressed, payload, variant, index
+        )
+
+
+def iter_files() -> Iterator[tuple[str, Image.Image]]:
+    """(name, image) of the corpus files."""
+    for file in sorted(DATA_DIR.glob("*.png")):
+        with Image.open(file) as image:
+            yield file.stem, image.copy()
+
+
+def write_files(directory: pathlib.Path, count: int = 24):
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, image in iter_corpus(count):
+        image.save(directory.joinpath(name + ".png"), optimize=True)
+
+
+if __name__ == "__main__":
+    write_files(pathlib.Path(sys.argv[1]))
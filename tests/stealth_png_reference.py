@@ -0,0 +1,197 @@
+"""
+Stealth PNG metadata reader as it was before the NumPy version, kept
+unchanged as the reference for tests/test_stealth_png.py and
+benchmarks/stealth_png_benchmark.py.
+"""
+
+import gzip
+from PIL import Image
+
+
+def read_info_from_image_stealth(image: Image.Image) -> str | None:
+    # source code taken here: https://github.com/catboxanon/comfyui_stealth_pnginfo/blob/726de7e51d7b950a3342b3a20ab231ed317f71a7/scripts/stealth_pnginfo.py#L70
+    # possible_sigs = {'stealth_pnginfo', 'stealth_pngcomp', 'stealth_rgbinfo', 'stealth_rgbcomp'}
+
+    # trying to read stealth pnginfo
+    width, height = image.size
+    if image.mode in {"P", "L", "LA"}:
+        return None
+    pixels = image.load()
+
+    has_alpha = True if image.mode == "RGBA" else False
+    mode = None
+    compressed = False
+    binary_data = ""
+    buffer_a = ""
+    buffer_rgb = ""
+    index_a = 0
+    index_rgb = 0
+    sig_confirmed = False
+    confirming_signature = True
+    reading_param_len = False
+    reading_param = False
+    read_end = False
+    for x in range(width):
+        for y in range(height):
+            if has_alpha:
+                r, g, b, a = pixels[x, y]
+                buffer_a += str(a & 1)
+                index_a += 1
+            else:
+                r, g, b = pixels[x, y]
+            buffer_rgb += str(r & 1)
+            buffer_rgb += str(g & 1)
+            buffer_rgb += str(b & 1)
+            index_rgb += 3
+            if confirming_signature:
+                if mode is None and y > 120:
+                    # Force stop to prevent reading the entire image
+                    read_end = True
+                    return None
+                if index_a == len("stealth_pnginfo") * 8:
+                    decoded_sig = bytearray(
+                        int(buffer_a[i : i + 8], 2)
+                        for i in range(0, len(buffer_a), 8)
+                    ).decode("utf-8", errors="ignore")
+                    if decoded_sig in {"stealth_pnginfo", "stealth_pngcomp"}:
+                        confirming_signature = False
+                        sig_confirmed = True
+                        reading_param_len = True
+                        mode = "alpha"
+                        if decoded_sig == "stealth_pngcomp":
+                            compressed = True
+                        buffer_a = ""
+                        index_a = 0
+                    else:
+                        read_end = True
+                        break
+                elif index_rgb == len("stealth_pnginfo") * 8:
+                    decoded_sig = bytearray(
+                        int(buffer_rgb[i : i + 8], 2)
+                        for i in range(0, len(buffer_rgb), 8)
+                    ).decode("utf-8", errors="ignore")
+                    if decoded_sig in {"stealth_rgbinfo", "stealth_rgbcomp"}:
+                        confirming_signature = False
+                        sig_confirmed = True
+                        reading_param_len = True
+                        mode = "rgb"
+                        if decoded_sig == "stealth_rgbcomp":
+                            compressed = True
+                        buffer_rgb = ""
+                        index_rgb = 0
+            elif reading_param_len:
+                if mode == "alpha":
+                    if index_a == 32:
+                        param_len = int(buffer_a, 2)
+                        reading_param_len = False
+                        reading_param = True
+                        buffer_a = ""
+                        index_a = 0
+                else:
+                    if index_rgb == 33:
+                        pop = buffer_rgb[-1]
+                        buffer_rgb = buffer_rgb[:-1]
+                        param_len = int(buffer_rgb, 2)
+                        reading_param_len = False
+                        reading_param = True
+                        buffer_rgb = pop
+                        index_rgb = 1
+            elif reading_param:
+                if mode == "alpha":
+                    if index_a == param_len:
+                        binary_data = buffer_a
+                        read_end = True
+                        break
+                else:
+                    if index_rgb >= param_len:
+                        diff = param_len - index_rgb
+                        if diff < 0:
+                            buffer_rgb = buffer_rgb[:diff]
+                        binary_data = buffer_rgb
+                        read_end = True
+                        break
+            else:
+                # impossible
+                read_end = True
+                break
+        if read_end:
+            break
+    if sig_confirmed and binary_data != "":
+        # Convert binary string to UTF-8 encoded text
+        byte_data = bytearray(
+            int(binary_data[i : i + 8], 2)
+            for i in range(0, len(binary_data), 8)
+        )
+        try:
+            if compressed:
+                decoded_data = gzip.decompress(bytes(byte_data)).decode(
+                    "utf-8"
+                )
+            else:
+                decoded_data = byte_data.decode("utf-8", errors="ignore")
+            geninfo = decoded_data
+        except:
+            pass
+        return geninfo
+    else:
+        return None
+
+
+def stealth_png_check(image: Image.Image) -> bool:
+    width, height = image.size
+    if image.mode in {"P", "L", "LA"}:
+        return False
+    pixels = image.load()
+
+    has_alpha = True if image.mode == "RGBA" else False
+    mode = None
+    buffer_a = ""
+    buffer_rgb = ""
+    index_a = 0
+    index_rgb = 0
+    confirming_signature = True
+    read_end = False
+    for x in range(width):
+        for y in range(height):
+            if has_alpha:
+                r, g, b, a = pixels[x, y]
+                buffer_a += str(a & 1)
+                index_a += 1
+            else:
+                r, g, b = pixels[x, y]
+            buffer_rgb += str(r & 1)
+            buffer_rgb += str(g & 1)
+            buffer_rgb += str(b & 1)
+            index_rgb += 3
+            if confirming_signature:
+                if mode is None and y > 120:
+                    # Force stop to prevent reading the entire image
+                    read_end = True
+                    return False
+                if index_a == len("stealth_pnginfo") * 8:
+                    decoded_sig = bytearray(
+                        int(buffer_a[i : i + 8], 2)
+                        for i in range(0, len(buffer_a), 8)
+                    ).decode("utf-8", errors="ignore")
+                    if decoded_sig in {"stealth_pnginfo", "stealth_pngcomp"}:
+                        confirming_signature = False
+                        return True
+                    else:
+                        return False
+                elif index_rgb == len("stealth_pnginfo") * 8:
+                    decoded_sig = bytearray(
+                        int(buffer_rgb[i : i + 8], 2)
+                        for i in range(0, len(buffer_rgb), 8)
+                    ).decode("utf-8", errors="ignore")
+                    if decoded_sig in {"stealth_rgbinfo", "stealth_rgbcomp"}:
+                        confirming_signature = False
+                        return True
+                    else:
+                        return False
+            else:
+                # impossible
+                read_end = True
+                break
+        if read_end:
+            break
+    return False